@@ -1,14 +1,23 @@
 import logging
 import hydra
+import json
 import os
 from hydra.core.config_store import ConfigStore
 from omegaconf import OmegaConf
 from time import perf_counter
 
-from src.vector_store import initialize_vector_db
+from src.vector_store import store_options, initialize_vector_db
 from src.index_pipeline import HaystackIndexer, DocumentLoader
 from src.rag import HaystackRAG
 from src.data_loader import load_qa_from_json
+from src.manifest import IndexManifest
+from src.bm25 import BM25Index
+from src.cache import EmbeddingCache
+from src.dedup import DedupIndex
+from src.domain_gate import create_domain_gate, create_domain_prototypes
+from src.embedder import create_sentence_embedder
+from src.metrics import get_metrics
+from src.model_registry import get_model_registry
 from src.utils import setup_logging
 
 logger = logging.getLogger(__name__)
@@ -22,36 +31,65 @@ def main(cfg):
         ),
         log_dir=os.path.join(original_dir, cfg.log_dir),
     )
-    # Setup or load chroma db
+    get_model_registry().configure(memory_budget_mb=cfg.model_memory_budget_mb)
+    get_metrics().configure(enabled=cfg.metrics_enabled)
+    # Setup or load the document store
     chroma_dir = os.path.join(original_dir, cfg.chromedb_dir)
-    document_store = initialize_vector_db(chroma_dir = chroma_dir)
-    logging.info("Successfully initialize chroma db")
+    document_store = initialize_vector_db(chroma_dir = chroma_dir, backend=cfg.document_store,
+                                          **store_options(cfg))
+    logging.info(f"Successfully initialize {cfg.document_store} document store")
+    lexical_index = BM25Index(os.path.join(chroma_dir, cfg.bm25_index_file))
+    cache_dir = os.path.join(original_dir, cfg.cache_dir)
+    embedding_cache = EmbeddingCache(os.path.join(cache_dir, cfg.embedding_cache_file))
+    # One copy of the embedding model for indexing and retrieval
+    embedder = create_sentence_embedder(cfg.rag_embedding_model_name)
     
     if cfg.indexing:
         corpus_dir = os.path.join(original_dir, cfg.corpus_dir)
-        raw_docs = DocumentLoader(data_dir=corpus_dir).load_documents()
-        indexer = HaystackIndexer(document_store=document_store, model_name=cfg.rag_embedding_model_name)
-        logging.info("Starting to index, duplicate documents would be updated")
-        indexer.index(raw_docs=raw_docs)
-        logging.info("Completed indexing of documents.")
+        doc_loader = DocumentLoader.from_config(cfg, data_dir=corpus_dir, cache_dir=cache_dir)
+        dedup_index = None
+        if cfg.dedup_threshold > 0:
+            dedup_index = DedupIndex(os.path.join(chroma_dir, cfg.dedup_index_file), threshold=cfg.dedup_threshold,
+                                     num_perm=cfg.dedup_num_perm, bands=cfg.dedup_bands)
+        indexer = HaystackIndexer.from_config(cfg, document_store=document_store, lexical_index=lexical_index,
+                                              embedding_cache=embedding_cache, dedup_index=dedup_index,
+                                              embedder=embedder,
+                                              domain_prototypes=create_domain_prototypes(cfg, chroma_dir))
+        indexer.backfill_lexical_index()
+        manifest = IndexManifest(os.path.join(chroma_dir, cfg.index_manifest), root_dir=original_dir)
+        logging.info("Starting to index, unchanged documents would be skipped")
+        index_stats = indexer.index_incremental(doc_loader=doc_loader, manifest=manifest,
+                                                  batch_size=cfg.index_batch_size)
+        logging.info(f"Completed indexing of documents: {index_stats}")
     
-    rag_pipeline = HaystackRAG(document_store=document_store)
+    rag_pipeline = HaystackRAG.from_config(cfg, document_store=document_store, lexical_index=lexical_index,
+                                           embedding_cache=embedding_cache, embedder=embedder,
+                                           domain_gate=create_domain_gate(cfg, chroma_dir))
     
     # Load test questions
     print("test")
     logging.info("Begin evaluation, loading question and answers")
     test_file_path = os.path.join(original_dir, cfg.test_file_path)
     questions, ground_truths = load_qa_from_json(test_file_path)
-    responses = []
-    # contexts =[]
     logging.info("Generating answers for respective questions")
-    for question in questions:
-        res = rag_pipeline.get_generative_answer_with_context(question)
-        responses.append(res['answer'])
-        # contexts.append(res["contexts"])
-        
-    rag_results = rag_pipeline.evaluate_rag(responses=responses, ground_truths=ground_truths)
-    logging.info(f"RAG Results: {rag_results}")
+    timings = {}
+    results = rag_pipeline.get_generative_answers_batch(questions, batch_size=cfg.eval_batch_size, timings=timings)
+    responses = [res['answer'] for res in results]
+
+    start_time = perf_counter()
+    rag_results = rag_pipeline.evaluate_rag(responses=responses, ground_truths=ground_truths,
+                                            num_workers=cfg.eval_workers)
+    timings["scoring"] = perf_counter() - start_time
+    logging.info(f"RAG Results: {rag_results['average_scores']}")
+    logging.info(f"Evaluation stage timings (s): {timings}")
+
+    # Written to the hydra run directory
+    with open(cfg.eval_results_file, "w", encoding="utf-8") as f:
+        json.dump({"num_questions": len(questions), "timings_seconds": timings, **rag_results}, f, indent=2)
+    # Per stage latency histograms and token counts of the run, in the Prometheus text format
+    if cfg.metrics_enabled:
+        with open("metrics.prom", "w", encoding="utf-8") as f:
+            f.write(get_metrics().render())
 
 if __name__ == "__main__":
     start_time = perf_counter()
@@ -1,43 +1,271 @@
-from fastapi import FastAPI, Body
+import os
+import json
+import logging
+import threading
+from contextlib import asynccontextmanager, nullcontext
+from time import perf_counter
+from fastapi import FastAPI, Body, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from haystack.dataclasses import Document
+from omegaconf import OmegaConf
 from pydantic import BaseModel
 from typing import List, Dict, Any
 
-from src.vector_store import initialize_vector_db
-from src.index_pipeline import HaystackIndexer, DocumentLoader
+from src.vector_store import store_options, initialize_vector_db
+from src.bm25 import BM25Index
+from src.cache import EmbeddingCache
+from src.domain_gate import create_domain_gate
+from src.embedder import create_sentence_embedder
+from src.metrics import get_metrics
+from src.model_registry import get_model_registry
+from src.profiler import SlowRequestProfiler
 from src.rag import HaystackRAG
+from src.batching import BatchScheduler
+from src.jobs import IndexJobQueue
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
 
-# Initialize once at startup
-document_store = initialize_vector_db()
-indexer = HaystackIndexer(document_store=document_store)
-rag_pipeline = HaystackRAG(document_store=document_store)
-doc_loader = DocumentLoader()
+cfg = OmegaConf.load(os.path.join("conf", "config.yaml"))
+
+
+class ServingState:
+    """
+    Models and indexes of the API. The query path (document store, embedder, retriever
+    and generator) is loaded in the background when the app starts. Ingestion runs as
+    background jobs in a separate worker process, started by the first job, which builds
+    the indexer and the document loader with its Whisper and OCR models, or in a worker
+    thread sharing the store of the API when that is an embedded Chroma database. Cache hit rates,
+    queue depths and model memory are read from their stats when /metrics is scraped.
+    """
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.document_store = None
+        self.lexical_index = None
+        self.embedding_cache = None
+        self.embedder = None
+        self.rag_pipeline = None
+        self.generation_scheduler = None
+        self.error = None
+        self.jobs = IndexJobQueue(cfg, cpu_share=cfg.index_cpu_share, nice=cfg.index_worker_nice,
+                                  history=cfg.index_job_history)
+        self._ready = threading.Event()
+        self.profiler = None
+        if cfg.profile_slow_ms > 0:
+            self.profiler = SlowRequestProfiler(slow_ms=cfg.profile_slow_ms, interval_ms=cfg.profile_interval_ms,
+                                                output_dir=cfg.profile_dir)
+        get_metrics().configure(enabled=cfg.metrics_enabled)
+        get_metrics().register_collector("serving", self.collect_metrics)
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def load_query_path(self):
+        cfg = self.cfg
+        try:
+            get_model_registry().configure(memory_budget_mb=cfg.model_memory_budget_mb)
+            self.document_store = initialize_vector_db(chroma_dir=cfg.chromedb_dir, backend=cfg.document_store,
+                                                       **store_options(cfg))
+            self.lexical_index = BM25Index(os.path.join(cfg.chromedb_dir, cfg.bm25_index_file))
+            self.embedding_cache = EmbeddingCache(os.path.join(cfg.cache_dir, cfg.embedding_cache_file))
+            self.embedder = create_sentence_embedder(cfg.rag_embedding_model_name)
+            self.rag_pipeline = HaystackRAG.from_config(cfg, document_store=self.document_store,
+                                                        lexical_index=self.lexical_index,
+                                                        embedding_cache=self.embedding_cache, embedder=self.embedder,
+                                                        domain_gate=create_domain_gate(cfg, cfg.chromedb_dir))
+            self.rag_pipeline.warm_up()
+            # Only used when the store may not be opened by a worker process
+            self.jobs.share_components(self.document_store, self.lexical_index, self.embedding_cache, self.embedder)
+            self.generation_scheduler = BatchScheduler(self.rag_pipeline.generate_batch,
+                                                       max_batch_size=cfg.batch_max_size,
+                                                       max_wait_ms=cfg.batch_wait_ms)
+            self._ready.set()
+            logger.info("Query path loaded, ready to answer")
+        except Exception as error:
+            self.error = error
+            logger.exception("Loading the query path failed")
+
+    def require_ready(self):
+        if not self.ready:
+            raise HTTPException(status_code=503, detail=f"Models failed to load: {self.error}" if self.error
+                                else "Models are still loading")
+
+    def collect_metrics(self):
+        """Gauges and cumulative counts read from the stats of the serving components."""
+        jobs = self.jobs.stats()
+        families = [
+            ("index_job_queue_depth", "gauge", "Ingestion jobs waiting for the indexing worker",
+             [({}, jobs["queue_depth"])]),
+            ("index_jobs", "gauge", "Ingestion jobs kept in the job history by status",
+             [({"status": status}, count) for status, count in jobs["jobs"].items()]),
+            ("model_resident_bytes", "gauge", "Resident memory added by each loaded model",
+             [({"model": name}, model["resident_mb"] * 2 ** 20)
+              for name, model in get_model_registry().stats()["loaded"].items()]),
+            ("ready", "gauge", "Whether the query path is loaded", [({}, int(self.ready))]),
+        ]
+        if not self.ready:
+            return families
+        scheduler = self.generation_scheduler.stats()
+        families.append(("generation_queue_depth", "gauge", "Prompts waiting for the generation batch scheduler",
+                          [({}, scheduler["queue_depth"])]))
+        families.append(("generation_batches_total", "counter", "Batches run by the generation batch scheduler",
+                         [({}, scheduler["num_batches"])]))
+        cache_stats = self.rag_pipeline.cache_stats()
+        caches = {name: stats for name, stats in cache_stats.items() if "hit_rate" in stats}
+        if "prompt_prefix" in cache_stats["generator"]:
+            caches["prompt_prefix"] = cache_stats["generator"]["prompt_prefix"]
+        families.append(("cache_hits_total", "counter", "Lookups answered by each cache",
+                         [({"cache": name}, stats["hits"]) for name, stats in caches.items()]))
+        families.append(("cache_misses_total", "counter", "Lookups missed by each cache",
+                         [({"cache": name}, stats["misses"]) for name, stats in caches.items()]))
+        families.append(("cache_hit_ratio", "gauge", "Share of the lookups answered by each cache",
+                         [({"cache": name}, stats["hit_rate"]) for name, stats in caches.items()]))
+        return families
+
+    def loaded_models(self):
+        return {
+            "models": list(get_model_registry().stats()["loaded"]),
+            "indexing_worker": self.jobs.worker_alive,
+        }
+
+
+state = ServingState(cfg)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Loaded in the background so /healthz answers while the models load, /readyz reports when they are
+    threading.Thread(target=state.load_query_path, name="model-loader", daemon=True).start()
+    yield
+    state.jobs.close()
+
+
+class RequestMetricsMiddleware:
+    """
+    Pure ASGI middleware timing and profiling every HTTP request until the last chunk of
+    its response body is sent, so streamed answers are measured over their whole duration.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = perf_counter()
+        profile = state.profiler.profile(f"{scope['method']} {scope['path']}") if state.profiler else nullcontext()
+        try:
+            with profile:
+                # Returns once the body has been sent, or raises when the client went away
+                await self.app(scope, receive, send_with_status)
+        finally:
+            # Templated path of the matched route, so ids do not create a series per request
+            route = scope.get("route")
+            get_metrics().observe("api_request_seconds", perf_counter() - start, method=scope["method"],
+                                  path=route.path if route is not None else "unmatched", status=status)
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(RequestMetricsMiddleware)
 
 class QueryRequest(BaseModel):
     query: str
 
+class DocumentIn(BaseModel):
+    content: str
+    meta: Dict[str, Any] = {}
+
 class AddDocsRequest(BaseModel):
-    documents: List[Dict[str, Any]]
+    documents: List[DocumentIn]
+
+@app.get("/healthz")
+def healthz():
+    # Liveness, the process is up even while the models are loading
+    return {"status": "ok", "ready": state.ready, "models": state.loaded_models()}
+
+@app.get("/readyz")
+def readyz():
+    # Readiness, queries are only answered once the query path is loaded
+    body = {"ready": state.ready, "models": state.loaded_models()}
+    if state.error is not None:
+        body["error"] = str(state.error)
+    return JSONResponse(body, status_code=200 if state.ready else 503)
 
 @app.post("/query")
-def query_rag(request: QueryRequest):
-    answer = rag_pipeline.get_generative_answer(request.query)
+async def query_rag(request: QueryRequest):
+    state.require_ready()
+    rag_pipeline = state.rag_pipeline
+    # Retrieval runs in the threadpool, generation is batched with other concurrent queries
+    query_embedding, documents, prompt, answer = await run_in_threadpool(rag_pipeline.prepare, request.query)
+    if answer is None:
+        answer = await state.generation_scheduler.submit(prompt)
+        rag_pipeline.cache_answer(query_embedding, documents, answer)
     return {"answer": answer}
 
-@app.post("/add-docs")
+@app.post("/query/stream")
+def query_rag_stream(request: QueryRequest):
+    state.require_ready()
+    # Server-sent events: retrieval metadata first, then tokens as they are generated
+    def event_stream():
+        for event, data in state.rag_pipeline.stream_generative_answer(request.query):
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+@app.get("/scheduler-stats")
+def scheduler_stats():
+    state.require_ready()
+    return state.generation_scheduler.stats()
+
+@app.get("/model-stats")
+def model_stats():
+    return get_model_registry().stats()
+
+@app.get("/metrics")
+def metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(get_metrics().render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache-stats")
+def cache_stats():
+    state.require_ready()
+    return state.rag_pipeline.cache_stats()
+
+@app.post("/add-docs", status_code=202)
 def add_documents(request: AddDocsRequest):
-    # Expecting documents as list of dicts with 'content' and 'meta'
-    docs = []
-    for doc in request.documents:
-        # You may want to validate/normalize here
-        docs.append(doc)
-    indexer.index(raw_docs=docs)
-    return {"status": "success", "num_docs_added": len(docs)}
-
-@app.post("/add-from-folder")
+    # Indexed by the background worker, poll GET /jobs/{job_id} for progress
+    docs = [Document(content=doc.content, meta=doc.meta) for doc in request.documents]
+    job = state.jobs.submit_documents(docs)
+    return {"status": job.status, "job_id": job.id, "num_docs": len(docs)}
+
+@app.post("/add-from-folder", status_code=202)
 def add_from_folder():
-    # Loads and indexes all docs from the folder using your loader
-    docs = doc_loader.load_documents()
-    indexer.index(raw_docs=docs)
-    return {"status": "success", "num_docs_added": len(docs)}
\ No newline at end of file
+    # Indexes only new or changed docs from the folder, purging chunks of deleted files
+    job = state.jobs.submit_folder()
+    return {"status": job.status, "job_id": job.id}
+
+@app.get("/jobs")
+def list_jobs():
+    return state.jobs.stats()
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = state.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return job
+
+@app.delete("/jobs/{job_id}")
+def cancel_job(job_id: str):
+    job = state.jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return job
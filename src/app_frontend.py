@@ -1,9 +1,25 @@
 import streamlit as st
 import requests
+import json
 from datetime import datetime
 
 API_URL = "http://localhost:8000"
 
+def stream_answer(question, sources):
+    """Yield answer tokens from the server-sent events of /query/stream, collecting sources on the way."""
+    with requests.post(f"{API_URL}/query/stream", json={"query": question}, stream=True) as response:
+        response.raise_for_status()
+        event = None
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event:"):
+                event = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                data = json.loads(line[len("data:"):])
+                if event == "sources":
+                    sources.extend(data)
+                elif event == "token":
+                    yield data
+
 # Initialize chat history
 if 'qa_history' not in st.session_state:
     st.session_state.qa_history = []
@@ -35,41 +51,42 @@ if prompt := st.chat_input("Enter your question about Edge AI..."):
         st.write(prompt)
         st.caption(f"Asked at: {timestamp}")
     
-    # Get response from backend
+    # Stream response from backend, tokens are rendered as they are generated
     with st.chat_message("assistant"):
-        with st.spinner("Thinking..."):
-            try:
-                response = requests.post(f"{API_URL}/query", json={"query": prompt})
-                if response.status_code == 200:
-                    answer = response.json()["answer"]
-                    st.write(answer)
-                    
-                    # Store in session state
-                    st.session_state.qa_history.append({
-                        "question": prompt,
-                        "answer": answer,
-                        "timestamp": timestamp
-                    })
-                else:
-                    error_msg = f"Error from backend: {response.text}"
-                    st.error(error_msg)
-                    
-                    # Store error in history too
-                    st.session_state.qa_history.append({
-                        "question": prompt,
-                        "answer": error_msg,
-                        "timestamp": timestamp
-                    })
-            except Exception as e:
-                error_msg = f"Connection error: {str(e)}"
-                st.error(error_msg)
-                
-                # Store error in history
-                st.session_state.qa_history.append({
-                    "question": prompt,
-                    "answer": error_msg,
-                    "timestamp": timestamp
-                })
+        sources = []
+        try:
+            answer = st.write_stream(stream_answer(prompt, sources))
+            if sources:
+                with st.expander("Sources"):
+                    for source in sources:
+                        st.caption(f"{source['file_path']} (page {source['page']})")
+            
+            # Store in session state
+            st.session_state.qa_history.append({
+                "question": prompt,
+                "answer": answer,
+                "timestamp": timestamp
+            })
+        except requests.HTTPError as e:
+            error_msg = f"Error from backend: {e.response.text}"
+            st.error(error_msg)
+            
+            # Store error in history too
+            st.session_state.qa_history.append({
+                "question": prompt,
+                "answer": error_msg,
+                "timestamp": timestamp
+            })
+        except Exception as e:
+            error_msg = f"Connection error: {str(e)}"
+            st.error(error_msg)
+            
+            # Store error in history
+            st.session_state.qa_history.append({
+                "question": prompt,
+                "answer": error_msg,
+                "timestamp": timestamp
+            })
 
 # Sidebar for additional controls
 with st.sidebar:
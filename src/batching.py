@@ -0,0 +1,87 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class BatchScheduler:
+    """
+    Dynamic request batching in front of a generator.
+    Prompts submitted within max_wait_ms of the first queued prompt are collected, up to
+    max_batch_size, and run through generate_batch as one batch on a single worker thread.
+    Each caller gets back the reply for its own prompt.
+
+    Args:
+        generate_batch (Callable[[list[str]], list[str]]): Generates one reply per prompt
+        max_batch_size (int): Maximum number of prompts per forward pass
+        max_wait_ms (float): How long the first prompt of a batch waits for others to arrive
+    """
+    def __init__(self, generate_batch, max_batch_size=4, max_wait_ms=20):
+        self.generate_batch = generate_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.num_batches = 0
+        self.num_prompts = 0
+        self._queue = None
+        self._worker = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="generator")
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, prompt):
+        # The queue and worker are created on first use so they bind to the running event loop
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((prompt, future))
+        return await future
+
+    async def _collect_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect_batch()
+            # Callers that disconnected while waiting have cancelled their future
+            batch = [(prompt, future) for prompt, future in batch if not future.done()]
+            if not batch:
+                continue
+            prompts = [prompt for prompt, _ in batch]
+            logger.debug(f"Generating batch of {len(prompts)} prompts, {self.queue_depth} still queued")
+            try:
+                replies = await loop.run_in_executor(self._executor, self.generate_batch, prompts)
+            except Exception as error:
+                logger.error(f"Batch generation failed: {error}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            self.num_batches += 1
+            self.num_prompts += len(prompts)
+            for (_, future), reply in zip(batch, replies):
+                if not future.done():
+                    future.set_result(reply)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "num_batches": self.num_batches,
+            "num_prompts": self.num_prompts,
+            "avg_batch_size": self.num_prompts / self.num_batches if self.num_batches else 0.0,
+        }
@@ -0,0 +1,110 @@
+"""
+Benchmark of the chunking settings on the corpus.
+
+Indexes the corpus into a temporary flat store with every setting and reports the chunk
+count, index size, indexing time and retrieval quality. Retrieval quality is the share
+of the ground truth answer's words found in the top_k retrieved chunks of each test
+question, along with the number of context words those chunks add to the prompt.
+
+    python -m src.bench_chunking --max-files 50 --output chunking_bench.json
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+from time import perf_counter
+
+import numpy as np
+from omegaconf import OmegaConf
+
+from src.bm25 import tokenize
+from src.data_loader import load_qa_from_json
+from src.flat_store import FlatDocumentStore
+from src.index_pipeline import DocumentLoader, HaystackIndexer
+from src.retriever import Retreiver
+
+logger = logging.getLogger(__name__)
+
+SETTINGS = {
+    "sentence-2": {"split_by": "sentence", "split_length": 2},
+    "token-128": {"split_by": "token", "chunk_tokens": 128, "chunk_overlap_tokens": 16},
+    "token-256": {"split_by": "token", "chunk_tokens": 256, "chunk_overlap_tokens": 32},
+    "token-384": {"split_by": "token", "chunk_tokens": 384, "chunk_overlap_tokens": 48},
+}
+
+
+def answer_recall(ground_truth, documents):
+    expected = set(tokenize(ground_truth))
+    if not expected:
+        return 1.0
+    found = set(tokenize(" ".join(doc.content for doc in documents)))
+    return len(expected & found) / len(expected)
+
+
+def run_setting(cfg, raw_docs, query_embeddings, ground_truths, top_k):
+    persist_path = tempfile.mkdtemp(prefix="bench_chunks_")
+    try:
+        store = FlatDocumentStore(persist_path)
+        indexer = HaystackIndexer.from_config(cfg, document_store=store)
+        start = perf_counter()
+        indexer.index(raw_docs)
+        index_seconds = perf_counter() - start
+
+        results = store.search_embeddings(query_embeddings, top_k=top_k)
+        memory = store.memory_stats()
+        context_words = [sum(len(doc.content.split()) for doc in documents) for documents in results]
+        return {
+            "num_chunks": store.count_documents(),
+            "index_mb": (memory["full_precision_bytes"] + memory["content_bytes"]) / 2 ** 20,
+            "index_seconds": index_seconds,
+            f"answer_recall@{top_k}": float(np.mean([answer_recall(truth, documents)
+                                                     for truth, documents in zip(ground_truths, results)])),
+            "context_words": float(np.mean(context_words)),
+        }
+    finally:
+        shutil.rmtree(persist_path, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--config", default=os.path.join("conf", "config.yaml"))
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--max-files", type=int, default=None, help="Only index the first files of the corpus")
+    parser.add_argument("--output", default=None, help="Optional JSON file for the results")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    cfg = OmegaConf.load(args.config)
+    doc_loader = DocumentLoader.from_config(cfg, data_dir=cfg.corpus_dir, cache_dir=cfg.cache_dir)
+    file_paths = doc_loader.list_files()[:args.max_files]
+    raw_docs = doc_loader.load_documents(file_paths)
+    questions, ground_truths = load_qa_from_json(cfg.test_file_path)
+    logger.info(f"Benchmarking {len(SETTINGS)} chunking settings on {len(raw_docs)} documents "
+                f"from {len(file_paths)} files and {len(questions)} questions")
+
+    query_dir = tempfile.mkdtemp(prefix="bench_queries_")
+    try:
+        retriever = Retreiver(FlatDocumentStore(query_dir), model_name=cfg.rag_embedding_model_name)
+        query_embeddings = retriever.embed_queries(questions)
+    finally:
+        shutil.rmtree(query_dir, ignore_errors=True)
+
+    results = {}
+    for name, overrides in SETTINGS.items():
+        results[name] = run_setting(OmegaConf.merge(cfg, overrides), raw_docs, query_embeddings, ground_truths,
+                                    args.top_k)
+        logger.info(f"{name}: {results[name]}")
+
+    columns = list(next(iter(results.values())))
+    print(f"{'setting':<12}" + "".join(f"{column:>20}" for column in columns))
+    for name, row in results.items():
+        print(f"{name:<12}" + "".join(f"{row[column]:>20.4g}" for column in columns))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"num_files": len(file_paths), "num_documents": len(raw_docs), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
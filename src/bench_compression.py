@@ -0,0 +1,123 @@
+"""
+Benchmark of the flat store compression settings on the indexed corpus.
+
+Reads every embedding from the configured document store, embeds the test questions and
+reports recall@k against exact float32 search, the memory scanned by search and the
+query latency of every setting.
+
+    python -m src.bench_compression --top-k 5 --output compression_bench.json
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+from time import perf_counter
+
+import numpy as np
+from haystack.document_stores.types import DuplicatePolicy
+from omegaconf import OmegaConf
+
+from src.data_loader import load_qa_from_json
+from src.flat_store import FlatDocumentStore
+from src.retriever import Retreiver
+from src.vector_store import store_options, initialize_vector_db
+
+logger = logging.getLogger(__name__)
+
+# (name, dtype, compression, compression_params, rerank_factor)
+SETTINGS = [
+    ("float16", "float16", "none", {}, 1),
+    ("int8", "int8", "none", {}, 1),
+    ("pca-128", "float16", "pca", {"dim": 128}, 1),
+    ("pca-128+rerank", "float16", "pca", {"dim": 128}, 4),
+    ("pca-256+rerank", "float16", "pca", {"dim": 256}, 4),
+    ("pq-64", "float16", "pq", {"num_subvectors": 64}, 1),
+    ("pq-64+rerank", "float16", "pq", {"num_subvectors": 64}, 4),
+    ("pq-128+rerank", "float16", "pq", {"num_subvectors": 128}, 4),
+]
+
+
+def exact_top_k(embeddings, queries, top_k):
+    embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    return np.argsort(-(queries @ embeddings.T), axis=1)[:, :top_k]
+
+
+def run_setting(documents, queries, expected, top_k, dtype, compression, compression_params, rerank_factor):
+    persist_path = tempfile.mkdtemp(prefix="bench_flat_")
+    try:
+        store = FlatDocumentStore(persist_path, dtype=dtype, compression=compression,
+                                  compression_params=compression_params, rerank_factor=rerank_factor,
+                                  min_train_size=min(1024, len(documents)))
+        start = perf_counter()
+        store.write_documents(documents, policy=DuplicatePolicy.OVERWRITE)
+        build_seconds = perf_counter() - start
+
+        position = {doc.id: i for i, doc in enumerate(documents)}
+        start = perf_counter()
+        results = [store.search_embeddings([query], top_k=top_k)[0] for query in queries.tolist()]
+        latency_ms = (perf_counter() - start) * 1000 / len(queries)
+        start = perf_counter()
+        store.search_embeddings(queries.tolist(), top_k=top_k)
+        batch_ms = (perf_counter() - start) * 1000
+
+        recall = np.mean([
+            len({position[doc.id] for doc in found} & set(truth.tolist())) / top_k
+            for found, truth in zip(results, expected)
+        ])
+        memory = store.memory_stats()
+        # Compressed stores only scan the codes, re-scoring touches a few full-precision rows
+        scanned_bytes = memory["codes_bytes"] + memory["codebook_bytes"] or memory["full_precision_bytes"]
+        return {
+            f"recall@{top_k}": float(recall),
+            "search_memory_mb": scanned_bytes / 2 ** 20,
+            "disk_mb": memory["full_precision_bytes"] / 2 ** 20,
+            "latency_ms": latency_ms,
+            "batch_latency_ms": batch_ms,
+            "build_seconds": build_seconds,
+        }
+    finally:
+        shutil.rmtree(persist_path, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--config", default=os.path.join("conf", "config.yaml"))
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--output", default=None, help="Optional JSON file for the results")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    cfg = OmegaConf.load(args.config)
+    document_store = initialize_vector_db(chroma_dir=cfg.chromedb_dir, backend=cfg.document_store,
+                                          **store_options(cfg))
+    documents = [doc for doc in document_store.filter_documents() if doc.embedding is not None]
+    if not documents:
+        raise SystemExit(f"No embeddings found in {cfg.chromedb_dir}, index the corpus first")
+    embeddings = np.array([doc.embedding for doc in documents], dtype=np.float32)
+
+    questions, _ = load_qa_from_json(cfg.test_file_path)
+    retriever = Retreiver(document_store, model_name=cfg.rag_embedding_model_name)
+    queries = np.array(retriever.embed_queries(questions), dtype=np.float32)
+    expected = exact_top_k(embeddings, queries, args.top_k)
+    logger.info(f"Benchmarking {len(SETTINGS)} settings on {len(documents)} vectors and {len(queries)} queries")
+
+    results = {}
+    for name, dtype, compression, compression_params, rerank_factor in SETTINGS:
+        results[name] = run_setting(documents, queries, expected, args.top_k, dtype,
+                                    compression, compression_params, rerank_factor)
+        logger.info(f"{name}: {results[name]}")
+
+    columns = list(next(iter(results.values())))
+    print(f"{'setting':<16}" + "".join(f"{column:>18}" for column in columns))
+    for name, row in results.items():
+        print(f"{name:<16}" + "".join(f"{row[column]:>18.4g}" for column in columns))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"num_vectors": len(documents), "num_queries": len(queries), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
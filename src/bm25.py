@@ -0,0 +1,263 @@
+import heapq
+import json
+import logging
+import math
+import os
+import re
+import threading
+import uuid
+from collections import Counter, defaultdict
+from dataclasses import replace
+
+from haystack.dataclasses import Document
+
+logger = logging.getLogger(__name__)
+
+# Keeps model names and versions such as "gte-large" or "v2.1" as single tokens
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-_.][a-z0-9]+)*")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """
+    In-process inverted index scoring chunks with Okapi BM25.
+    The id, content and meta of every chunk are kept so lexical hits can be returned as
+    Documents without a round trip to the vector store. The postings are rebuilt from the
+    stored content on load.
+
+    The index file is a JSON lines log: a generation id, a snapshot of every chunk, then
+    one line per batch of added or removed chunks, so save() appends what changed since
+    the previous save instead of rewriting the index. Once the appended lines outgrow the
+    snapshot, save() writes a new snapshot under a new generation in place of the file.
+    Readers in other processes apply the appended lines, or load the file again when its
+    generation changed, in a background thread
+    and swap the result in, so searches never wait for a reload.
+    """
+    def __init__(self, path=None, k1=1.5, b=0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.documents = {}
+        self.postings = defaultdict(dict)
+        self.doc_lengths = {}
+        self._total_length = 0
+        # Log records of the changes not saved yet
+        self._pending = []
+        # Generation of the file and the byte offset read or written up to, the next save
+        # writes a snapshot when the file is no longer the one read or written
+        self._file_id = None
+        self._offset = 0
+        self._snapshot_bytes = 0
+        self._lock = threading.RLock()
+        self._reload_requested = False
+        self._reloader = None
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.documents)
+
+    def _add(self, doc_id, content, meta):
+        if doc_id in self.documents:
+            self._remove(doc_id)
+        term_counts = Counter(tokenize(content))
+        for term, count in term_counts.items():
+            self.postings[term][doc_id] = count
+        length = sum(term_counts.values())
+        self.doc_lengths[doc_id] = length
+        self._total_length += length
+        self.documents[doc_id] = {"content": content, "meta": meta}
+
+    def _remove(self, doc_id):
+        stored = self.documents.pop(doc_id, None)
+        if stored is None:
+            return
+        for term in set(tokenize(stored["content"])):
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.pop(doc_id, None)
+                if not postings:
+                    del self.postings[term]
+        self._total_length -= self.doc_lengths.pop(doc_id)
+
+    def _apply(self, record):
+        if "documents" in record:
+            self.k1, self.b = record["k1"], record["b"]
+            self.documents, self.postings, self.doc_lengths = {}, defaultdict(dict), {}
+            self._total_length = 0
+            for doc_id, stored in record["documents"].items():
+                self._add(doc_id, stored["content"], stored["meta"])
+        for doc_id in record.get("remove", ()):
+            self._remove(doc_id)
+        for doc_id, stored in record.get("add", {}).items():
+            self._add(doc_id, stored["content"], stored["meta"])
+
+    def add(self, documents):
+        with self._lock:
+            added = {}
+            for doc in documents:
+                if doc.content:
+                    self._add(doc.id, doc.content, dict(doc.meta))
+                    added[doc.id] = self.documents[doc.id]
+            if added and self.path:
+                self._pending.append({"add": added})
+
+    def remove(self, doc_ids):
+        with self._lock:
+            removed = [doc_id for doc_id in doc_ids if doc_id in self.documents]
+            for doc_id in removed:
+                self._remove(doc_id)
+            if removed and self.path:
+                self._pending.append({"remove": removed})
+
+    def rebuild(self, documents):
+        """Replace every chunk of the index with the given Documents, the next save writes a snapshot."""
+        with self._lock:
+            self.documents, self.postings, self.doc_lengths = {}, defaultdict(dict), {}
+            self._total_length = 0
+            self._pending = []
+            self._file_id = None
+            for doc in documents:
+                if doc.content:
+                    self._add(doc.id, doc.content, dict(doc.meta))
+
+    def search(self, query, top_k=5):
+        """Returns up to top_k Documents ordered by BM25 score, with the score set on each."""
+        with self._lock:
+            num_docs = len(self.documents)
+            if not num_docs:
+                return []
+            avg_length = self._total_length / num_docs
+            scores = defaultdict(float)
+            for term in set(tokenize(query)):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (num_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, tf in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / avg_length)
+                    scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+            top = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+            return [
+                Document(id=doc_id, content=self.documents[doc_id]["content"],
+                         meta=dict(self.documents[doc_id]["meta"]), score=score)
+                for doc_id, score in top
+            ]
+
+    def save(self):
+        """Append the changes since the previous save to the index file, or write a new snapshot."""
+        if not self.path:
+            return
+        with self._lock:
+            records, self._pending = self._pending, []
+            generation = self._generation() if os.path.exists(self.path) else None
+            appended = "".join(json.dumps(record) + "\n" for record in records).encode("utf-8")
+            in_sync = (generation is not None and generation == self._file_id
+                       and os.path.getsize(self.path) == self._offset)
+            if in_sync and self._offset + len(appended) <= 2 * self._snapshot_bytes:
+                if appended:
+                    with open(self.path, "ab") as f:
+                        f.write(appended)
+                    self._offset += len(appended)
+                return
+            generation = uuid.uuid4().hex
+            header = (json.dumps({"generation": generation}) + "\n").encode("utf-8")
+            snapshot = (json.dumps({"k1": self.k1, "b": self.b, "documents": self.documents}) + "\n").encode("utf-8")
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(header + snapshot)
+            os.replace(tmp_path, self.path)
+            self._file_id = generation
+            self._offset = len(header) + len(snapshot)
+            self._snapshot_bytes = len(snapshot)
+
+    @staticmethod
+    def _read_generation(f):
+        # Files replaced by a snapshot may reuse the inode of the old one, the generation tells them apart
+        header = f.readline(256)
+        if header.startswith(b'{"generation"') and header.endswith(b"\n"):
+            return json.loads(header)["generation"]
+        return None
+
+    def _generation(self):
+        with open(self.path, "rb") as f:
+            return self._read_generation(f)
+
+    def _read(self, offset=0):
+        """Generation of the file and its bytes from offset, whole and up to the last complete line."""
+        with open(self.path, "rb") as f:
+            file_id = self._read_generation(f)
+            f.seek(offset)
+            data = f.read()
+        return file_id, data[:data.rfind(b"\n") + 1], data
+
+    def load(self):
+        """Read the whole index file into fresh postings, swapped in once built."""
+        file_id, lines, data = self._read()
+        if data and not lines:
+            # Index saved as a single JSON object, the next save replaces it with a snapshot
+            lines = data
+        snapshot_bytes = 0
+        loaded = BM25Index(k1=self.k1, b=self.b)
+        for line in lines.splitlines(keepends=True):
+            record = json.loads(line)
+            if "documents" in record and file_id is not None:
+                snapshot_bytes = len(line)
+            loaded._apply(record)
+        with self._lock:
+            self.k1, self.b = loaded.k1, loaded.b
+            self.documents, self.postings = loaded.documents, loaded.postings
+            self.doc_lengths, self._total_length = loaded.doc_lengths, loaded._total_length
+            self._pending = []
+            self._file_id, self._offset, self._snapshot_bytes = file_id, len(lines), snapshot_bytes
+        logger.info(f"Loaded BM25 index with {len(self.documents)} chunks from {self.path}")
+
+    def reload_if_stale(self):
+        """Apply what another process appended to the index file, or reload it when it was replaced."""
+        if not self.path or not os.path.exists(self.path):
+            return
+        file_id, lines, _ = self._read(self._offset)
+        if file_id is None or file_id != self._file_id:
+            self.load()
+            return
+        records = [json.loads(line) for line in lines.splitlines()]
+        with self._lock:
+            for record in records:
+                self._apply(record)
+            self._offset += len(lines)
+
+    def reload_in_background(self):
+        """Run reload_if_stale in a background thread, searches keep the current index meanwhile."""
+        with self._lock:
+            self._reload_requested = True
+            if self._reloader is not None:
+                return
+            self._reloader = threading.Thread(target=self._reload_loop, name="bm25-reload", daemon=True)
+            self._reloader.start()
+
+    def _reload_loop(self):
+        while True:
+            with self._lock:
+                if not self._reload_requested:
+                    self._reloader = None
+                    return
+                self._reload_requested = False
+            try:
+                self.reload_if_stale()
+            except Exception:
+                logger.exception(f"Reloading the BM25 index from {self.path} failed")
+
+
+def reciprocal_rank_fusion(ranked_lists, top_k=5, k=60):
+    """Merge ranked lists of Documents, scoring each by the sum of 1 / (k + rank) over the lists."""
+    scores = defaultdict(float)
+    documents = {}
+    for ranked in ranked_lists:
+        for rank, doc in enumerate(ranked, start=1):
+            scores[doc.id] += 1.0 / (k + rank)
+            documents.setdefault(doc.id, doc)
+    top = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+    return [replace(documents[doc_id], score=score) for doc_id, score in top]
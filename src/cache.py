@@ -0,0 +1,237 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+import numpy as np
+
+_MISSING = object()
+
+
+class JsonDiskCache:
+    """
+    Stores JSON serialisable values on disk, one file per key.
+    Keys are expected to be content hashes, files are fanned out into
+    sub-folders by the first two characters of the key.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return default
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def set(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+
+
+class LRUCache:
+    """
+    Thread-safe bounded LRU cache with an optional time-to-live in seconds.
+    Hits and misses are counted so cache effectiveness can be reported.
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING and self.ttl is not None and item[1] < time.monotonic():
+                del self._data[key]
+                item = _MISSING
+            if item is _MISSING:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self._data),
+        }
+
+
+class SemanticAnswerCache:
+    """
+    Caches generated answers by query embedding so paraphrased questions can reuse them.
+    A query hits when its embedding is within similarity_threshold cosine similarity of a
+    cached query and the ids of its retrieved documents overlap the cached ones by at least
+    min_context_overlap (Jaccard). The least recently used entry is evicted beyond maxsize
+    and every entry is dropped when the index version changes.
+    """
+    def __init__(self, maxsize=256, similarity_threshold=0.92, min_context_overlap=0.6):
+        self.maxsize = maxsize
+        self.similarity_threshold = similarity_threshold
+        self.min_context_overlap = min_context_overlap
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._next_key = 0
+        self._matrix = None
+        self._matrix_keys = []
+        self._version = None
+        self._lock = threading.Lock()
+
+    def check_version(self, version):
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._matrix = None
+                self._version = version
+
+    def _stacked(self):
+        if self._matrix is None:
+            self._matrix_keys = list(self._entries)
+            vectors = [self._entries[key][0] for key in self._matrix_keys]
+            self._matrix = np.stack(vectors) if vectors else None
+        return self._matrix
+
+    def lookup(self, query_embedding, doc_ids):
+        query = np.array(query_embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        doc_ids = set(doc_ids)
+        with self._lock:
+            matrix = self._stacked()
+            if matrix is not None:
+                similarities = matrix @ query
+                for idx in np.argsort(-similarities):
+                    if similarities[idx] < self.similarity_threshold:
+                        break
+                    key = self._matrix_keys[idx]
+                    _, cached_ids, answer = self._entries[key]
+                    union = doc_ids | cached_ids
+                    if union and len(doc_ids & cached_ids) / len(union) >= self.min_context_overlap:
+                        self._entries.move_to_end(key)
+                        self.hits += 1
+                        return answer
+            self.misses += 1
+            return None
+
+    def add(self, query_embedding, doc_ids, answer):
+        if self.maxsize <= 0:
+            return
+        vector = np.array(query_embedding, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        with self._lock:
+            self._entries[self._next_key] = (vector, frozenset(doc_ids), answer)
+            self._next_key += 1
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self._entries),
+        }
+
+
+def embedding_key(model_name, text, meta_values=()):
+    """
+    Content address of an embedding: the model name, the hash of the whitespace and unicode
+    normalised text and the values of the meta fields embedded along with it.
+    """
+    normalised = " ".join(unicodedata.normalize("NFC", text).split())
+    text_hash = hashlib.sha256(normalised.encode("utf-8")).hexdigest()
+    return hashlib.sha256(json.dumps([model_name, text_hash, list(meta_values)]).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent content-addressed embedding store in SQLite, keyed by embedding_key.
+    Lookups and inserts are done in bulk. The database runs in WAL mode so the indexer
+    and the query path can share it across threads and processes.
+    """
+    # SQLite limits the number of parameters of a single statement
+    MAX_VARIABLES = 900
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB NOT NULL)")
+        self._conn.commit()
+
+    def get_many(self, keys):
+        """Returns a dict of key to embedding for the keys that are cached."""
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), self.MAX_VARIABLES):
+                batch = keys[start:start + self.MAX_VARIABLES]
+                rows = self._conn.execute(
+                    f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                found.update((key, np.frombuffer(blob, dtype=np.float32).tolist()) for key, blob in rows)
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set_many(self, items):
+        """Store (key, embedding) pairs, existing keys are left as they are."""
+        rows = [(key, np.asarray(embedding, dtype=np.float32).tobytes()) for key, embedding in items]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany("INSERT OR IGNORE INTO embeddings (key, embedding) VALUES (?, ?)", rows)
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self),
+        }
@@ -0,0 +1,99 @@
+"""
+Calibration of the out-of-domain gate on a labelled query set.
+
+Scores every query of a JSON list of {"query": ..., "in_domain": true|false} records the
+way the gate does, then reports, for a sweep of thresholds, the precision and recall of
+the refusals against the off-topic queries and the share of in-domain queries wrongly
+refused. The threshold with the best F1 of the refusals is suggested for
+domain_gate_threshold, along with the metrics of the configured threshold.
+
+    python -m src.calibrate_domain_gate --labelled test_data/domain_queries.json --output gate_calibration.json
+"""
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+from omegaconf import OmegaConf
+
+from src.domain_gate import DomainGate, create_domain_prototypes
+from src.retriever import Retreiver
+from src.vector_store import store_options, initialize_vector_db
+
+logger = logging.getLogger(__name__)
+
+
+def refusal_metrics(scores, in_domain, threshold):
+    """Precision and recall of refusing the off-topic queries, and the in-domain false refusal rate."""
+    refused = scores < threshold
+    off_topic = ~in_domain
+    true_refusals = int(np.sum(refused & off_topic))
+    precision = true_refusals / refused.sum() if refused.any() else 1.0
+    recall = true_refusals / off_topic.sum() if off_topic.any() else 1.0
+    return {
+        "threshold": float(threshold),
+        "precision": float(precision),
+        "recall": float(recall),
+        "f1": float(2 * precision * recall / (precision + recall)) if precision + recall else 0.0,
+        "false_refusal_rate": float(np.sum(refused & in_domain) / in_domain.sum()) if in_domain.any() else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--config", default=os.path.join("conf", "config.yaml"))
+    parser.add_argument("--labelled", required=True, help="JSON list of {\"query\", \"in_domain\"} records")
+    parser.add_argument("--refit", action="store_true", help="Refit the domain prototypes on the store first")
+    parser.add_argument("--steps", type=int, default=20, help="Number of thresholds printed")
+    parser.add_argument("--output", default=None, help="Optional JSON file for the results")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    cfg = OmegaConf.load(args.config)
+    with open(args.labelled, "r", encoding="utf-8") as f:
+        records = json.load(f)
+    queries = [record["query"] for record in records]
+    in_domain = np.array([bool(record["in_domain"]) for record in records])
+
+    document_store = initialize_vector_db(chroma_dir=cfg.chromedb_dir, backend=cfg.document_store,
+                                          **store_options(cfg))
+    prototypes = create_domain_prototypes(cfg, cfg.chromedb_dir, required=True)
+    if args.refit or not prototypes.is_fitted:
+        prototypes.fit(document_store)
+    if not prototypes.is_fitted:
+        raise SystemExit(f"No embeddings found in {cfg.chromedb_dir}, index the corpus first")
+    gate = DomainGate(prototypes, threshold=cfg.domain_gate_threshold, retrieval_weight=cfg.domain_gate_weight)
+
+    retriever = Retreiver(document_store, model_name=cfg.rag_embedding_model_name)
+    query_embeddings = retriever.embed_queries(queries)
+    top_similarities = retriever.top_similarities(query_embeddings) if gate.retrieval_weight > 0 else None
+    scores = np.array(gate.scores(query_embeddings, top_similarities))
+    logger.info(f"Scored {in_domain.sum()} in-domain and {(~in_domain).sum()} off-topic queries "
+                f"against {len(prototypes.centroids)} prototypes")
+
+    # Every score is a candidate threshold, nudged up so that query itself is refused
+    candidates = np.unique(np.nextafter(scores, np.inf))
+    sweep = [refusal_metrics(scores, in_domain, threshold) for threshold in candidates]
+    best = max(sweep, key=lambda row: (row["f1"], -row["false_refusal_rate"]))
+    configured = refusal_metrics(scores, in_domain, gate.threshold) if gate.threshold > 0 else None
+
+    columns = ["threshold", "precision", "recall", "f1", "false_refusal_rate"]
+    print("".join(f"{column:>20}" for column in columns))
+    shown = sweep[::max(len(sweep) // args.steps, 1)]
+    if best not in shown:
+        shown.append(best)
+    for row in sorted(shown, key=lambda row: row["threshold"]):
+        print("".join(f"{row[column]:>20.4g}" for column in columns))
+    print(f"Best F1 threshold: {best['threshold']:.4f} {best}")
+    if configured is not None:
+        print(f"Configured threshold: {configured}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"num_in_domain": int(in_domain.sum()), "num_off_topic": int((~in_domain).sum()),
+                       "retrieval_weight": gate.retrieval_weight, "best": best, "configured": configured,
+                       "sweep": sweep}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
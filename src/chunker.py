@@ -0,0 +1,147 @@
+import logging
+import re
+from typing import List
+
+from haystack import component
+from haystack.dataclasses import Document
+
+logger = logging.getLogger(__name__)
+
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9\"'(\[])")
+# File types whose documents are small records packed together rather than split further
+RECORD_FILE_TYPES = ("csv",)
+
+
+def is_code(document):
+    """Code blocks saved by src/scraper.py, split on line boundaries only."""
+    return "_code_" in str(document.meta.get("file_path", "")) or (document.content or "").lstrip().startswith("```")
+
+
+@component
+class TokenChunker:
+    """
+    Packs text into chunks of up to chunk_tokens tokens of the embedding model's tokenizer,
+    repeating up to overlap_tokens tokens of trailing units at the start of the next chunk.
+
+    Chunks never cross the structure of the loaded documents: every input document is a
+    PDF page, a PPTX slide, a transcript window or a text file and is chunked on its own.
+    Prose is split into paragraphs and then sentences, code blocks into lines, and CSV
+    rows are never split, consecutive rows of the same file are packed together instead.
+    Units longer than chunk_tokens are cut at token boundaries as a last resort.
+    """
+    def __init__(self, tokenizer_name="thenlper/gte-large", chunk_tokens=256, overlap_tokens=32):
+        if overlap_tokens >= chunk_tokens:
+            raise ValueError("overlap_tokens must be smaller than chunk_tokens")
+        self.tokenizer_name = tokenizer_name
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.tokenizer = None
+
+    def warm_up(self):
+        if self.tokenizer is None:
+            from transformers import AutoTokenizer
+            self.tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_name)
+
+    def count_tokens(self, texts):
+        if not texts:
+            return []
+        return [len(ids) for ids in self.tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+    def _cut(self, text):
+        """Cut a unit longer than chunk_tokens into pieces at token boundaries."""
+        offsets = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+        step = self.chunk_tokens - self.overlap_tokens
+        pieces = []
+        for start in range(0, len(offsets), step):
+            window = offsets[start:start + self.chunk_tokens]
+            pieces.append(text[window[0][0]:window[-1][1]])
+            if start + self.chunk_tokens >= len(offsets):
+                break
+        return pieces
+
+    def _units(self, text, code):
+        """Split text into units no longer than chunk_tokens, returns (unit, separator, num_tokens) triples."""
+        if code:
+            candidates = [(line, "\n") for line in text.splitlines() if line.strip()]
+        else:
+            candidates = []
+            for paragraph in PARAGRAPH_BREAK.split(text):
+                paragraph = " ".join(paragraph.split())
+                if paragraph:
+                    candidates.append((paragraph, "\n\n"))
+        units = []
+        for (unit, separator), num_tokens in zip(candidates, self.count_tokens([unit for unit, _ in candidates])):
+            if num_tokens <= self.chunk_tokens:
+                units.append((unit, separator, num_tokens))
+                continue
+            sentences = [sentence for sentence in SENTENCE_END.split(unit) if sentence] if not code else [unit]
+            for sentence, sentence_tokens in zip(sentences, self.count_tokens(sentences)):
+                pieces = [sentence] if sentence_tokens <= self.chunk_tokens else self._cut(sentence)
+                units.extend((piece, " ", tokens) for piece, tokens in zip(pieces, self.count_tokens(pieces)))
+        return units
+
+    def _pack(self, units):
+        """Greedily pack (unit, separator, num_tokens) into chunks, returns (text, first_unit, last_unit)."""
+        chunks = []
+        start = 0
+        while start < len(units):
+            end, total = start, 0
+            while end < len(units) and (end == start or total + units[end][2] <= self.chunk_tokens):
+                total += units[end][2]
+                end += 1
+            text = units[start][0]
+            for unit, separator, _ in units[start + 1:end]:
+                text += separator + unit
+            chunks.append((text, start, end - 1))
+            if end >= len(units):
+                break
+            # Step back over trailing units that fit in the overlap, always moving forward and
+            # leaving room for the next new unit
+            next_start, overlap = end, 0
+            while next_start - 1 > start and overlap + units[next_start - 1][2] <= self.overlap_tokens \
+                    and overlap + units[next_start - 1][2] + units[end][2] <= self.chunk_tokens:
+                next_start -= 1
+                overlap += units[next_start][2]
+            start = next_start
+        return chunks
+
+    def _chunk_document(self, document):
+        units = self._units(document.content or "", code=is_code(document))
+        return [
+            Document(content=text, meta={**document.meta, "split_id": i})
+            for i, (text, _, _) in enumerate(self._pack(units))
+        ]
+
+    def _chunk_records(self, documents):
+        """Pack consecutive records of one file, the page meta of a chunk spans its first to last record."""
+        units = [(doc.content, "\n", tokens)
+                 for doc, tokens in zip(documents, self.count_tokens([doc.content for doc in documents]))]
+        return [
+            Document(content=text, meta={**documents[first].meta, "page_end": documents[last].meta.get("page"),
+                                         "split_id": i})
+            for i, (text, first, last) in enumerate(self._pack(units))
+        ]
+
+    @component.output_types(documents=List[Document])
+    def run(self, documents: List[Document]):
+        self.warm_up()
+        chunks = []
+        records = []
+        for doc in documents:
+            if not doc.content or not doc.content.strip():
+                continue
+            if doc.meta.get("file_type") in RECORD_FILE_TYPES:
+                if records and records[-1].meta.get("file_path") != doc.meta.get("file_path"):
+                    chunks.extend(self._chunk_records(records))
+                    records = []
+                records.append(doc)
+                continue
+            if records:
+                chunks.extend(self._chunk_records(records))
+                records = []
+            chunks.extend(self._chunk_document(doc))
+        if records:
+            chunks.extend(self._chunk_records(records))
+        logger.debug(f"Chunked {len(documents)} documents into {len(chunks)} chunks of up to {self.chunk_tokens} tokens")
+        return {"documents": chunks}
@@ -0,0 +1,162 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def kmeans(vectors, num_centroids, iterations=20, seed=0):
+    """Lloyd's k-means, returns the (num_centroids, dim) centroid matrix."""
+    rng = np.random.default_rng(seed)
+    num_centroids = min(num_centroids, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), num_centroids, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = _nearest(vectors, centroids)
+        counts = np.bincount(assignment, minlength=num_centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Empty clusters are restarted from random vectors
+        centroids[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+    return centroids
+
+
+def _nearest(vectors, centroids):
+    # argmin of |x - c|^2 is argmax of x.c - |c|^2 / 2
+    return np.argmax(vectors @ centroids.T - 0.5 * np.sum(centroids ** 2, axis=1), axis=1)
+
+
+class PCACompressor:
+    """
+    Projects vectors onto the dim principal components of the corpus and stores the
+    projections as float16. Inner products with a query are approximated in the
+    projected space, queries are projected once per search.
+    """
+    method = "pca"
+    code_dtype = np.float16
+
+    def __init__(self, dim=256):
+        self.dim = dim
+        self.mean = None
+        self.components = None
+
+    @property
+    def is_fitted(self):
+        return self.components is not None
+
+    @property
+    def code_width(self):
+        return self.dim
+
+    def fit(self, vectors):
+        self.mean = vectors.mean(axis=0)
+        centered = vectors - self.mean
+        _, eigenvectors = np.linalg.eigh(centered.T @ centered)
+        # eigh sorts the eigenvalues in ascending order
+        self.components = np.ascontiguousarray(eigenvectors[:, ::-1][:, :self.dim].T, dtype=np.float32)
+        return self
+
+    def encode(self, vectors):
+        return ((vectors - self.mean) @ self.components.T).astype(self.code_dtype)
+
+    def prepare_queries(self, queries):
+        return queries @ self.components.T, queries @ self.mean
+
+    def score(self, prepared, codes):
+        projected, offset = prepared
+        return projected @ np.asarray(codes, dtype=np.float32).T + offset[:, None]
+
+    def state(self):
+        return {"mean": self.mean, "components": self.components}
+
+    def load_state(self, state):
+        self.mean, self.components = state["mean"], state["components"]
+        self.dim = len(self.components)
+
+    def params(self):
+        return {"dim": self.dim}
+
+
+class ProductQuantizer:
+    """
+    Splits vectors into num_subvectors sub-vectors and replaces each with the index of
+    its nearest centroid in a per-sub-space k-means codebook, one byte per sub-vector.
+    Inner products are approximated with per-query lookup tables (asymmetric distance).
+    """
+    method = "pq"
+    code_dtype = np.uint8
+
+    def __init__(self, num_subvectors=64, num_centroids=256, iterations=20, seed=0):
+        if num_centroids > 256:
+            raise ValueError("Product quantisation codes are stored as bytes, num_centroids must be <= 256")
+        self.num_subvectors = num_subvectors
+        self.num_centroids = num_centroids
+        self.iterations = iterations
+        self.seed = seed
+        self.centroids = None
+
+    @property
+    def is_fitted(self):
+        return self.centroids is not None
+
+    @property
+    def code_width(self):
+        return self.num_subvectors
+
+    def _split(self, vectors):
+        if vectors.shape[1] % self.num_subvectors:
+            raise ValueError(f"Dimension {vectors.shape[1]} is not divisible by {self.num_subvectors} sub-vectors")
+        return vectors.reshape(len(vectors), self.num_subvectors, -1)
+
+    def fit(self, vectors):
+        subvectors = self._split(vectors)
+        codebooks = [
+            kmeans(np.ascontiguousarray(subvectors[:, j]), self.num_centroids, self.iterations, self.seed + j)
+            for j in range(self.num_subvectors)
+        ]
+        # Sub-spaces of tiny corpora can have fewer centroids, pad to one rectangular array
+        size = max(len(codebook) for codebook in codebooks)
+        self.centroids = np.stack([np.pad(codebook, ((0, size - len(codebook)), (0, 0)), mode="edge")
+                                   for codebook in codebooks]).astype(np.float32)
+        return self
+
+    def encode(self, vectors):
+        subvectors = self._split(vectors)
+        codes = np.empty((len(vectors), self.num_subvectors), dtype=self.code_dtype)
+        for j in range(self.num_subvectors):
+            codes[:, j] = _nearest(subvectors[:, j], self.centroids[j])
+        return codes
+
+    def prepare_queries(self, queries):
+        # (num_queries, num_subvectors, num_centroids) inner products of every query sub-vector
+        return np.einsum("qjd,jkd->qjk", self._split(queries), self.centroids)
+
+    def score(self, tables, codes):
+        scores = np.zeros((len(tables), len(codes)), dtype=np.float32)
+        for j in range(self.num_subvectors):
+            scores += tables[:, j, codes[:, j]]
+        return scores
+
+    def state(self):
+        return {"centroids": self.centroids}
+
+    def load_state(self, state):
+        self.centroids = state["centroids"]
+        self.num_subvectors = len(self.centroids)
+
+    def params(self):
+        return {"num_subvectors": self.num_subvectors, "num_centroids": self.num_centroids,
+                "iterations": self.iterations, "seed": self.seed}
+
+
+COMPRESSORS = {"pca": PCACompressor, "pq": ProductQuantizer}
+
+
+def create_compressor(method="none", **params):
+    """Unfitted compressor for the method, None when method is "none"."""
+    if method in (None, "none"):
+        return None
+    if method not in COMPRESSORS:
+        raise ValueError(f"Unknown compression method '{method}', expected one of {['none', *COMPRESSORS]}")
+    return COMPRESSORS[method](**params)
@@ -0,0 +1,100 @@
+import logging
+import re
+import threading
+from dataclasses import replace
+from typing import List
+
+from haystack import component
+from haystack.dataclasses import Document
+
+from src.bm25 import tokenize
+from src.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+@component
+class ContextBudgeter:
+    """
+    Shrinks the retrieved documents before they are rendered into the prompt.
+    Documents are taken in retrieval order, which every retriever returns best first.
+    Sentences already present in a better ranked document, exactly or with a word
+    Jaccard similarity of at least dedup_similarity, are dropped. Documents are then kept
+    until max_tokens tokens of the generator's tokenizer are used, the document crossing
+    the budget is cut at its last fitting sentence. Document ids are preserved.
+
+    Args:
+        tokenizer: Tokenizer of the generator, whitespace words are counted when None
+        max_tokens (int): Token budget of the context, 0 disables the budget
+        dedup_similarity (float): Word Jaccard similarity above which sentences are redundant
+    """
+    def __init__(self, tokenizer=None, max_tokens=1024, dedup_similarity=0.8):
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.dedup_similarity = dedup_similarity
+        self.tokens_in = 0
+        self.tokens_out = 0
+        self._lock = threading.Lock()
+
+    def count_tokens(self, texts):
+        if not texts:
+            return []
+        if self.tokenizer is None:
+            return [len(text.split()) for text in texts]
+        return [len(ids) for ids in self.tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+    def _is_redundant(self, words, kept_words):
+        if not words:
+            return True
+        return any(len(words & seen) / len(words | seen) >= self.dedup_similarity for seen in kept_words)
+
+    @component.output_types(documents=List[Document])
+    def run(self, documents: List[Document]):
+        with get_metrics().time("rag_stage_seconds", stage="context_budget"):
+            return self._run(documents)
+
+    def _run(self, documents):
+        documents = [doc for doc in documents if doc.content]
+        tokens_in = sum(self.count_tokens([doc.content for doc in documents]))
+        kept_words = []
+        budgeted = []
+        used = 0
+        for doc in documents:
+            sentences = []
+            for sentence in SENTENCE_END.split(doc.content.strip()):
+                words = frozenset(tokenize(sentence))
+                if not self._is_redundant(words, kept_words):
+                    kept_words.append(words)
+                    sentences.append(sentence)
+            if not sentences:
+                continue
+            counts = self.count_tokens(sentences)
+            if self.max_tokens > 0 and used + sum(counts) > self.max_tokens:
+                fitting = []
+                for sentence, count in zip(sentences, counts):
+                    if used + count > self.max_tokens:
+                        break
+                    fitting.append(sentence)
+                    used += count
+                if fitting:
+                    budgeted.append(replace(doc, content=" ".join(fitting)))
+                break
+            used += sum(counts)
+            budgeted.append(replace(doc, content=" ".join(sentences)))
+
+        with self._lock:
+            self.tokens_in += tokens_in
+            self.tokens_out += used
+        if tokens_in:
+            logger.info(f"Context budget: {tokens_in} -> {used} tokens from {len(documents)} -> "
+                        f"{len(budgeted)} documents, {1 - used / tokens_in:.0%} of the context saved")
+        return {"documents": budgeted}
+
+    def stats(self):
+        return {
+            "tokens_in": self.tokens_in,
+            "tokens_out": self.tokens_out,
+            "saved_ratio": 1 - self.tokens_out / self.tokens_in if self.tokens_in else 0.0,
+        }
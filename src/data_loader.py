@@ -1,33 +1,140 @@
 from abc import ABC, abstractmethod
 import csv
-from PIL import Image
-import whisper
+import logging
+import mmap
+import multiprocessing
+import os
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image, ImageStat
 from pptx import Presentation
 from PyPDF2 import PdfReader
-from paddleocr import PaddleOCR
 import json
 
+from src.cache import JsonDiskCache
+from src.model_registry import get_model_registry
+from src.utils import hash_file
+
+logger = logging.getLogger(__name__)
+
 class BaseExtractor(ABC):
     @abstractmethod
     def extract(self, file_path: str) -> list[str]:
         """Extracts text content from file and returns list of text chunks or lines."""
         pass
 
+WHISPER_SAMPLE_RATE = 16000
+
+# Whisper model owned by each transcription worker process
+_WORKER_WHISPER = None
+
+def _init_whisper_worker(model_name):
+    import whisper
+    global _WORKER_WHISPER
+    _WORKER_WHISPER = whisper.load_model(model_name)
+
+def _transcribe_piece_in_worker(piece):
+    offset, audio = piece
+    return _segments_from_result(_WORKER_WHISPER.transcribe(audio), offset)
+
+def _segments_from_result(result, offset=0.0):
+    return [
+        {"text": seg["text"].strip(), "start": seg["start"] + offset, "end": seg["end"] + offset}
+        for seg in result["segments"] if seg["text"].strip()
+    ]
+
+def find_silence_cuts(audio, max_samples, frame_samples=WHISPER_SAMPLE_RATE // 10):
+    """
+    Split audio into pieces of at most max_samples, cutting each piece at the
+    quietest frame within the last fifth of the allowed length.
+
+    Returns:
+        list[tuple[int, int]]: (start, end) sample index of every piece
+    """
+    cuts = [0]
+    while len(audio) - cuts[-1] > max_samples:
+        start = cuts[-1] + int(max_samples * 0.8)
+        window = audio[start:cuts[-1] + max_samples]
+        num_frames = max(len(window) // frame_samples, 1)
+        frames = window[:num_frames * frame_samples].reshape(num_frames, -1)
+        energy = np.sqrt(np.mean(frames ** 2, axis=1))
+        cuts.append(start + int(np.argmin(energy)) * frames.shape[1] + frames.shape[1] // 2)
+    cuts.append(len(audio))
+    return list(zip(cuts[:-1], cuts[1:]))
+
+def merge_segments(segments, window_seconds):
+    """Merge consecutive whisper segments into windows of about window_seconds."""
+    if window_seconds <= 0:
+        return segments
+    windows = []
+    for seg in segments:
+        if windows and seg["end"] - windows[-1]["start"] <= window_seconds:
+            windows[-1]["text"] += " " + seg["text"]
+            windows[-1]["end"] = seg["end"]
+        else:
+            windows.append(dict(seg))
+    return windows
+
 class AudioVideoExtractor(BaseExtractor):
     """_summary_
     * Do not pass in video or audio files that does not contain speech
     Perform transcribing for audio and video files.
     In this project we will not be using each frame in the video.
+    Long media is cut at silences into pieces of at most chunk_seconds which are
+    transcribed in parallel when num_workers > 1. Transcripts are cached on disk by
+    file hash and model name, so a file is only ever transcribed once per model.
     
     Args:
         BaseExtractor (_type_): _description_
     """
-    def __init__(self, model_name="base"):
-        self.model = whisper.load_model(model_name)
+    def __init__(self, model_name="base", window_seconds=30.0, chunk_seconds=600.0,
+                 num_workers=1, cache_dir=None):
+        self.model_name = model_name
+        self.window_seconds = window_seconds
+        self.chunk_seconds = chunk_seconds
+        self.num_workers = num_workers
+        self.cache = JsonDiskCache(os.path.join(cache_dir, "transcripts")) if cache_dir else None
 
-    def extract(self, file_path: str) -> list[str]:
-        result = self.model.transcribe(file_path)
-        return result["text"]
+    def _load_model(self):
+        import whisper
+        return whisper.load_model(self.model_name)
+
+    def use_model(self):
+        # Borrowed from the model registry on first use so cached transcripts never pay for the model
+        return get_model_registry().use(f"whisper/{self.model_name}", self._load_model, device="auto")
+
+    def extract(self, file_path: str) -> list[dict]:
+        """Returns transcript windows as dicts with text, start and end in seconds."""
+        cache_key = f"{hash_file(file_path)}_{self.model_name}"
+        segments = self.cache.get(cache_key) if self.cache else None
+        if segments is None:
+            segments = self._transcribe(file_path)
+            if self.cache:
+                self.cache.set(cache_key, segments)
+        else:
+            logger.info(f"Using cached transcript for {file_path}")
+        return merge_segments(segments, self.window_seconds)
+
+    def _transcribe(self, file_path):
+        import whisper
+        audio = whisper.load_audio(file_path)
+        pieces = [
+            (start / WHISPER_SAMPLE_RATE, audio[start:end])
+            for start, end in find_silence_cuts(audio, int(self.chunk_seconds * WHISPER_SAMPLE_RATE))
+        ]
+        logger.info(f"Transcribing {file_path} in {len(pieces)} pieces")
+        if self.num_workers <= 1 or len(pieces) == 1:
+            with self.use_model() as model:
+                results = [_segments_from_result(model.transcribe(piece), offset) for offset, piece in pieces]
+        else:
+            with ProcessPoolExecutor(max_workers=min(self.num_workers, len(pieces)),
+                                     mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=_init_whisper_worker,
+                                     initargs=(self.model_name,)) as pool:
+                results = list(pool.map(_transcribe_piece_in_worker, pieces))
+        return [seg for piece_segments in results for seg in piece_segments]
 
 class CSVExtractor(BaseExtractor):
     def extract(self, file_path: str) -> list[str]:
@@ -42,27 +149,139 @@ class CSVExtractor(BaseExtractor):
 # May not need since we are using multi modal embedding and llm
 class ImageExtractor(BaseExtractor):
     """_summary_
+    Runs PaddleOCR over images in batches. Results are cached on disk by the sha256 of
+    the image bytes so repeated logos and re-uploads are only OCR'd once, and images
+    that are too small or too flat to contain text are skipped before OCR.
+
     Args:
         BaseExtractor (_type_): _description_
     """
-    def __init__(self, model_name="base"):
-        self.ocr = PaddleOCR(
+    def __init__(self, batch_size=8, min_side=32, min_stddev=8.0, cache_dir=None):
+        self.batch_size = batch_size
+        self.min_side = min_side
+        self.min_stddev = min_stddev
+        self.cache = JsonDiskCache(os.path.join(cache_dir, "ocr")) if cache_dir else None
+
+    def _load_ocr(self):
+        # Imported here so paddle is only loaded when an image actually needs OCR
+        from paddleocr import PaddleOCR
+        return PaddleOCR(
             use_doc_orientation_classify=False,
             use_doc_unwarping=False,
-            use_textline_orientation=False)
+            use_textline_orientation=False,
+            text_recognition_batch_size=self.batch_size)
 
-    def extract(self, file_path: str) -> list[str]:
-        result = self.ocr.predict(input=file_path)
-        return ", ".join(result[0]["rec_texts"])
+    def use_ocr(self):
+        return get_model_registry().use(f"paddleocr/batch{self.batch_size}", self._load_ocr, device="auto")
+
+    def may_contain_text(self, file_path):
+        """Cheap pre-filter on image size and grey-level variance, decoding at most a thumbnail."""
+        with Image.open(file_path) as img:
+            if min(img.size) < self.min_side:
+                return False
+            img.draft("L", (128, 128))
+            thumbnail = img.convert("L")
+            thumbnail.thumbnail((128, 128))
+            return ImageStat.Stat(thumbnail).stddev[0] >= self.min_stddev
+
+    def extract(self, file_path: str) -> str:
+        return self.extract_batch([file_path])[file_path]
+
+    def extract_batch(self, file_paths: list[str]) -> dict[str, str]:
+        """OCR several images at once, returns the recognised text of every file path."""
+        texts = {}
+        pending = {}
+        for file_path in file_paths:
+            key = hash_file(file_path)
+            cached = self.cache.get(key) if self.cache else None
+            if cached is not None:
+                texts[file_path] = cached
+            elif key in pending:
+                pending[key].append(file_path)
+            elif not self.may_contain_text(file_path):
+                logger.debug(f"Skipping OCR for {file_path}, image is unlikely to contain text")
+                texts[file_path] = ""
+            else:
+                pending[key] = [file_path]
+
+        keys = list(pending)
+        for start in range(0, len(keys), self.batch_size):
+            batch_keys = keys[start:start + self.batch_size]
+            with self.use_ocr() as ocr:
+                results = ocr.predict(input=[pending[key][0] for key in batch_keys])
+            for key, result in zip(batch_keys, results):
+                text = ", ".join(result["rec_texts"])
+                if self.cache:
+                    self.cache.set(key, text)
+                for file_path in pending[key]:
+                    texts[file_path] = text
+        logger.info(f"OCR'd {len(keys)} of {len(file_paths)} images, the rest were cached, duplicates or skipped")
+        return texts
     
+class PageTimeout(Exception):
+    pass
+
+def _raise_page_timeout(signum, frame):
+    raise PageTimeout()
+
+def _extract_page_text(page, page_timeout):
+    # SIGALRM is only available on unix and only in the main thread of a process
+    if not page_timeout or not hasattr(signal, "setitimer") \
+            or threading.current_thread() is not threading.main_thread():
+        return page.extract_text()
+    previous_handler = signal.signal(signal.SIGALRM, _raise_page_timeout)
+    signal.setitimer(signal.ITIMER_REAL, page_timeout)
+    try:
+        return page.extract_text()
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+def _extract_pdf_pages(args):
+    """Extract text of the given page numbers (1-based), returns (page_number, text) pairs."""
+    file_path, page_numbers, page_timeout = args
+    # Every worker maps the same file, the pages are read from disk once and shared through the page cache
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as pdf_map:
+        reader = PdfReader(pdf_map)
+        texts = []
+        for page_number in page_numbers:
+            try:
+                text = _extract_page_text(reader.pages[page_number - 1], page_timeout)
+            except PageTimeout:
+                logger.warning(f"Skipping page {page_number} of {file_path}, extraction exceeded {page_timeout}s")
+                text = ""
+            texts.append((page_number, text or ""))
+        return texts
+
 class PDFExtractor(BaseExtractor):
+    """
+    Extracts the text of every page, the index in the returned list + 1 is the page number.
+    PDFs with at least min_parallel_pages pages are split into contiguous page ranges and
+    extracted by a pool of num_workers processes. Pages taking longer than page_timeout
+    seconds are skipped and returned as empty strings.
+    """
+    def __init__(self, num_workers=1, page_timeout=30.0, min_parallel_pages=32):
+        self.num_workers = num_workers
+        self.page_timeout = page_timeout
+        self.min_parallel_pages = min_parallel_pages
+
     def extract(self, file_path: str) -> list[str]:
-        reader = PdfReader(file_path)
-        texts=[]
-        for page in reader.pages:
-            text = page.extract_text()
-            texts.append(text)
-        return texts
+        with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as pdf_map:
+            num_pages = len(PdfReader(pdf_map).pages)
+        if self.num_workers <= 1 or num_pages < self.min_parallel_pages:
+            pages = _extract_pdf_pages((file_path, range(1, num_pages + 1), self.page_timeout))
+        else:
+            num_tasks = self.num_workers * 4
+            size = -(-num_pages // num_tasks)
+            tasks = [
+                (file_path, range(start, min(start + size, num_pages + 1)), self.page_timeout)
+                for start in range(1, num_pages + 1, size)
+            ]
+            logger.info(f"Extracting {num_pages} pages of {file_path} with {self.num_workers} workers")
+            with ProcessPoolExecutor(max_workers=self.num_workers,
+                                     mp_context=multiprocessing.get_context("spawn")) as pool:
+                pages = [page for task_pages in pool.map(_extract_pdf_pages, tasks) for page in task_pages]
+        return [text for _, text in pages]
     
 # todo: Account for the actual slide number based on the raw pptx
     
@@ -0,0 +1,210 @@
+import json
+import logging
+import os
+import threading
+import zlib
+from collections import defaultdict
+from dataclasses import replace
+from typing import List
+
+import numpy as np
+from haystack import component
+from haystack.dataclasses import Document
+
+from src.bm25 import tokenize
+
+logger = logging.getLogger(__name__)
+
+_PRIME = (1 << 61) - 1
+# Separator of the source files in meta["file_paths"], Chroma only stores scalar meta values
+FILE_PATHS_SEPARATOR = "|"
+
+
+def source_file_paths(document):
+    """Every source file of a chunk, including the ones of the near-duplicates it replaced."""
+    if document.meta.get("file_paths"):
+        return document.meta["file_paths"].split(FILE_PATHS_SEPARATOR)
+    return [document.meta["file_path"]] if document.meta.get("file_path") else []
+
+
+def with_file_paths(document, file_paths):
+    """Copy of the document whose file_path and file_paths meta reflect the given sources."""
+    meta = dict(document.meta)
+    meta["file_path"] = file_paths[0]
+    if len(file_paths) > 1:
+        meta["file_paths"] = FILE_PATHS_SEPARATOR.join(file_paths)
+    else:
+        meta.pop("file_paths", None)
+    return replace(document, meta=meta)
+
+
+class MinHasher:
+    """MinHash signatures of the word shingles of a text, stable across processes and runs."""
+    def __init__(self, num_perm=128, shingle_size=3, seed=1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        # a * h + b stays below 2**64 for 32-bit shingle hashes
+        self._a = rng.integers(1, 1 << 31, num_perm, dtype=np.uint64)[:, None]
+        self._b = rng.integers(0, 1 << 31, num_perm, dtype=np.uint64)[:, None]
+
+    def signature(self, text):
+        """Returns the uint64 signature, None when the text has no words."""
+        tokens = tokenize(text)
+        if not tokens:
+            return None
+        size = min(self.shingle_size, len(tokens))
+        shingles = {" ".join(tokens[i:i + size]) for i in range(len(tokens) - size + 1)}
+        hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles),
+                             dtype=np.uint64, count=len(shingles))
+        return ((self._a * hashes + self._b) % _PRIME).min(axis=1)
+
+
+class DedupIndex:
+    """
+    LSH index of the MinHash signatures of stored chunks, with the source files of each.
+    Signatures are split into bands, chunks sharing any band are candidates and are
+    near-duplicates when their estimated Jaccard similarity reaches threshold.
+    The index is persisted as npz next to the document store.
+    """
+    def __init__(self, path=None, threshold=0.8, num_perm=128, bands=16):
+        if num_perm % bands:
+            raise ValueError(f"num_perm {num_perm} is not divisible by {bands} bands")
+        self.path = path
+        self.threshold = threshold
+        self.bands = bands
+        self.hasher = MinHasher(num_perm=num_perm)
+        self.signatures = {}
+        self.file_paths = {}
+        self._buckets = defaultdict(set)
+        self._lock = threading.RLock()
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def _band_keys(self, signature):
+        rows = len(signature) // self.bands
+        return [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(self.bands)]
+
+    def add(self, chunk_id, signature, file_paths):
+        with self._lock:
+            self.remove([chunk_id])
+            self.signatures[chunk_id] = signature
+            self.file_paths[chunk_id] = list(file_paths)
+            for key in self._band_keys(signature):
+                self._buckets[key].add(chunk_id)
+
+    def remove(self, chunk_ids):
+        with self._lock:
+            for chunk_id in chunk_ids:
+                signature = self.signatures.pop(chunk_id, None)
+                self.file_paths.pop(chunk_id, None)
+                if signature is None:
+                    continue
+                for key in self._band_keys(signature):
+                    bucket = self._buckets.get(key)
+                    if bucket is not None:
+                        bucket.discard(chunk_id)
+                        if not bucket:
+                            del self._buckets[key]
+
+    def find(self, signature):
+        """Id of the most similar indexed chunk at or above threshold, or None."""
+        with self._lock:
+            candidates = set()
+            for key in self._band_keys(signature):
+                candidates |= self._buckets.get(key, set())
+            best, best_similarity = None, self.threshold
+            for chunk_id in candidates:
+                similarity = float(np.mean(self.signatures[chunk_id] == signature))
+                if similarity >= best_similarity:
+                    best, best_similarity = chunk_id, similarity
+            return best
+
+    def set_file_paths(self, chunk_id, file_paths):
+        with self._lock:
+            if chunk_id in self.signatures:
+                self.file_paths[chunk_id] = list(file_paths)
+
+    def chunks_of_files(self, file_paths):
+        """Ids of the indexed chunks with at least one of the given source files."""
+        file_paths = set(file_paths)
+        with self._lock:
+            return [chunk_id for chunk_id, paths in self.file_paths.items() if file_paths.intersection(paths)]
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            ids = list(self.signatures)
+            signatures = np.stack([self.signatures[chunk_id] for chunk_id in ids]) if ids \
+                else np.empty((0, self.hasher.num_perm), dtype=np.uint64)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp.npz"
+            np.savez(tmp_path, ids=np.array(ids, dtype=str), signatures=signatures,
+                     file_paths=np.array(json.dumps([self.file_paths[chunk_id] for chunk_id in ids])))
+            os.replace(tmp_path, self.path)
+
+    def load(self):
+        with self._lock, np.load(self.path) as data:
+            self.signatures, self.file_paths, self._buckets = {}, {}, defaultdict(set)
+            for chunk_id, signature, file_paths in zip(data["ids"].tolist(), data["signatures"],
+                                                       json.loads(str(data["file_paths"]))):
+                self.add(chunk_id, signature, file_paths)
+            logger.info(f"Loaded near-duplicate index with {len(self.signatures)} chunks from {self.path}")
+
+
+@component
+class NearDuplicateFilter:
+    """
+    Collapses near-duplicate chunks between the splitter and the embedder.
+    A chunk matching an earlier chunk of the batch is dropped and its file_path added to
+    the kept chunk. A chunk matching a chunk stored by an earlier run is dropped too, and
+    the stored chunk is emitted again with the extra file_path so the writer, which must
+    replace documents with the same id, rewrites it.
+    """
+    def __init__(self, dedup_index, document_store):
+        self.dedup_index = dedup_index
+        self.document_store = document_store
+
+    def _stored_document(self, chunk_id):
+        documents = self.document_store.filter_documents(filters={"field": "id", "operator": "==", "value": chunk_id})
+        return documents[0] if documents else None
+
+    @component.output_types(documents=List[Document])
+    def run(self, documents: List[Document]):
+        kept = {}
+        sources = {}
+        for doc in documents:
+            signature = self.dedup_index.hasher.signature(doc.content or "")
+            if signature is None:
+                kept[doc.id] = doc
+                continue
+            match = self.dedup_index.find(signature)
+            if match is None:
+                self.dedup_index.add(doc.id, signature, source_file_paths(doc))
+                kept[doc.id] = doc
+                sources[doc.id] = source_file_paths(doc)
+                continue
+            if match not in kept:
+                stored = self._stored_document(match)
+                if stored is None:
+                    # The index is ahead of the store, e.g. after an interrupted write
+                    self.dedup_index.add(doc.id, signature, source_file_paths(doc))
+                    kept[doc.id] = doc
+                    sources[doc.id] = source_file_paths(doc)
+                    continue
+                kept[match] = stored
+                # The index is the record of the sources, the stored meta may predate an upsert
+                sources[match] = list(self.dedup_index.file_paths.get(match) or source_file_paths(stored))
+            for file_path in source_file_paths(doc):
+                if file_path not in sources[match]:
+                    sources[match].append(file_path)
+            self.dedup_index.set_file_paths(match, sources[match])
+
+        unique = [with_file_paths(doc, sources[doc_id]) if sources.get(doc_id) else doc
+                  for doc_id, doc in kept.items()]
+        if len(unique) != len(documents):
+            logger.info(f"Collapsed {len(documents)} chunks into {len(unique)} after near-duplicate elimination")
+        return {"documents": unique}
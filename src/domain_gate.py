@@ -0,0 +1,155 @@
+import logging
+import os
+import threading
+
+import numpy as np
+
+from src.compression import kmeans
+from src.vector_store import sample_embeddings
+
+logger = logging.getLogger(__name__)
+
+# Reply of the prompt template to questions outside the corpus' domain
+REFUSAL = "I only answer Edge AI questions"
+
+
+class DomainPrototypes:
+    """
+    k-means centroids of the normalised chunk embeddings of the document store, one per
+    topic of the corpus. Fitted by the indexer after every indexing run and persisted
+    as npz next to the store, readers in other processes reload it when it changes.
+    """
+    def __init__(self, path=None, num_prototypes=64, max_samples=50000, iterations=20, seed=0):
+        self.path = path
+        self.num_prototypes = num_prototypes
+        self.max_samples = max_samples
+        self.iterations = iterations
+        self.seed = seed
+        self.centroids = None
+        self._loaded_mtime = None
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load()
+
+    @property
+    def is_fitted(self):
+        return self.centroids is not None
+
+    def fit_embeddings(self, embeddings):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        if len(embeddings) > self.max_samples:
+            rng = np.random.default_rng(self.seed)
+            embeddings = embeddings[rng.choice(len(embeddings), self.max_samples, replace=False)]
+        centroids = kmeans(embeddings, self.num_prototypes, self.iterations, self.seed)
+        with self._lock:
+            self.centroids = centroids / np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+        logger.info(f"Fitted {len(self.centroids)} domain prototypes on {len(embeddings)} chunk embeddings")
+
+    def fit(self, document_store):
+        """Fit on a sample of at most max_samples stored embeddings and save, does nothing when the store is empty."""
+        embeddings = sample_embeddings(document_store, self.max_samples, self.seed)
+        if not len(embeddings):
+            return
+        self.fit_embeddings(embeddings)
+        self.save()
+
+    def save(self):
+        if not self.path or self.centroids is None:
+            return
+        tmp_path = f"{self.path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, centroids=self.centroids)
+        os.replace(tmp_path, self.path)
+        self._loaded_mtime = os.stat(self.path).st_mtime_ns
+
+    def load(self):
+        with self._lock, np.load(self.path) as data:
+            self.centroids = data["centroids"]
+            self._loaded_mtime = os.stat(self.path).st_mtime_ns
+
+    def reload_if_stale(self):
+        """Reload when another process has saved newer prototypes."""
+        if self.path and os.path.exists(self.path) and os.stat(self.path).st_mtime_ns != self._loaded_mtime:
+            self.load()
+
+    def similarity(self, query_embeddings):
+        """Cosine similarity of every query to its closest prototype, None when not fitted."""
+        self.reload_if_stale()
+        centroids = self.centroids
+        if centroids is None:
+            return None
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        return (queries @ centroids.T).max(axis=1)
+
+
+class DomainGate:
+    """
+    Refuses queries outside the corpus' domain before generation. The score of a query is
+    its similarity to the closest domain prototype mixed with the similarity of the top
+    retrieved chunk, weighted by retrieval_weight. Queries scoring below threshold are
+    refused. The threshold is calibrated with python -m src.calibrate_domain_gate.
+
+    Args:
+        prototypes (DomainPrototypes): Prototypes fitted at index time, every query passes until fitted
+        threshold (float): Minimum score of an in-domain query
+        retrieval_weight (float): Weight of the top retrieval similarity in the score
+    """
+    def __init__(self, prototypes, threshold=0.8, retrieval_weight=0.5):
+        self.prototypes = prototypes
+        self.threshold = threshold
+        self.retrieval_weight = retrieval_weight
+        self.checked = 0
+        self.refused = 0
+
+    def scores(self, query_embeddings, top_similarities=None):
+        """Score of every query, None for all of them when the prototypes are not fitted."""
+        prototype_similarities = self.prototypes.similarity(query_embeddings)
+        if prototype_similarities is None:
+            return None
+        scores = []
+        for i, prototype_similarity in enumerate(prototype_similarities.tolist()):
+            top_similarity = top_similarities[i] if top_similarities is not None else None
+            if top_similarity is None:
+                scores.append(prototype_similarity)
+            else:
+                scores.append((1 - self.retrieval_weight) * prototype_similarity
+                              + self.retrieval_weight * top_similarity)
+        return scores
+
+    def accepts(self, query_embeddings, top_similarities=None):
+        """Whether every query is in the domain."""
+        scores = self.scores(query_embeddings, top_similarities)
+        if scores is None:
+            return [True] * len(query_embeddings)
+        accepted = [score >= self.threshold for score in scores]
+        self.checked += len(accepted)
+        self.refused += accepted.count(False)
+        return accepted
+
+    def stats(self):
+        return {
+            "checked": self.checked,
+            "refused": self.refused,
+            "refused_ratio": self.refused / self.checked if self.checked else 0.0,
+            "prototypes": len(self.prototypes.centroids) if self.prototypes.is_fitted else 0,
+        }
+
+
+def create_domain_prototypes(cfg, index_dir, required=False):
+    """
+    Prototypes persisted next to the indexes in index_dir. None when domain_gate_threshold
+    disables the gate, unless required, so indexers only refit them when they are used.
+    """
+    if cfg.domain_gate_threshold <= 0 and not required:
+        return None
+    return DomainPrototypes(os.path.join(index_dir, cfg.domain_prototypes_file),
+                            num_prototypes=cfg.domain_num_prototypes)
+
+
+def create_domain_gate(cfg, index_dir):
+    """DomainGate of the config, None when domain_gate_threshold disables it."""
+    prototypes = create_domain_prototypes(cfg, index_dir)
+    if prototypes is None:
+        return None
+    return DomainGate(prototypes, threshold=cfg.domain_gate_threshold, retrieval_weight=cfg.domain_gate_weight)
@@ -1,6 +1,19 @@
+import logging
+from dataclasses import replace
+from typing import List
+
+from haystack import component
+from haystack.components.embedders import SentenceTransformersDocumentEmbedder
+from haystack.dataclasses import Document
+from sentence_transformers import SentenceTransformer
 from transformers import AutoModel, AutoProcessor
 import torch
 
+from src.cache import embedding_key
+from src.model_registry import get_model_registry
+
+logger = logging.getLogger(__name__)
+
 class MultiModalEmbedder:
     def __init__(self, device="cuda", model="jinaai/jina-clip-v2"):
         self.device = device
@@ -20,4 +33,104 @@ class MultiModalEmbedder:
         inputs = self.processor(images=images, return_tensors="pt").to(self.device)
         with torch.inference_mode():
             outputs = self.model.get_image_features(**inputs).cpu().tolist()
-        return outputs
\ No newline at end of file
+        return outputs
+
+def create_sentence_embedder(model_name="thenlper/gte-large"):
+    """
+    Sentence Transformers embedder that can be shared by HaystackIndexer and Retreiver,
+    the retriever embeds queries with its backend so the model is only loaded once.
+    """
+    return SentenceTransformersDocumentEmbedder(model=model_name, meta_fields_to_embed=["title"])
+
+
+class SentenceTransformerBackend:
+    """
+    Sentence Transformers model of a Haystack embedder, loaded from the embedder's settings
+    by the model registry rather than Haystack's factory, which would keep it for good.
+    """
+    def __init__(self, embedder):
+        self.model = SentenceTransformer(model_name_or_path=embedder.model,
+                                         device=embedder.device.to_torch_str(),
+                                         token=embedder.token.resolve_value() if embedder.token else None,
+                                         trust_remote_code=embedder.trust_remote_code,
+                                         local_files_only=embedder.local_files_only,
+                                         truncate_dim=embedder.truncate_dim,
+                                         model_kwargs=embedder.model_kwargs,
+                                         tokenizer_kwargs=embedder.tokenizer_kwargs,
+                                         config_kwargs=embedder.config_kwargs,
+                                         backend=embedder.backend)
+        if embedder.tokenizer_kwargs and embedder.tokenizer_kwargs.get("model_max_length"):
+            self.model.max_seq_length = embedder.tokenizer_kwargs["model_max_length"]
+
+    def embed(self, texts, **kwargs):
+        return self.model.encode(texts, **kwargs).tolist()
+
+
+def use_embedding_backend(embedder):
+    """
+    Borrow the Sentence Transformers backend of a Haystack embedder from the model registry,
+    every embedder of the same model, device and dtype shares one backend. The embedder's
+    own warm_up is never called, so it holds no reference to the model.
+    """
+    dtype = (embedder.model_kwargs or {}).get("torch_dtype", "float32")
+    return get_model_registry().use(embedder.model, lambda: SentenceTransformerBackend(embedder),
+                                    device=embedder.device.to_torch_str(), dtype=dtype)
+
+
+@component
+class CachedDocumentEmbedder:
+    """
+    Wraps a SentenceTransformersDocumentEmbedder with a persistent EmbeddingCache.
+    Every document is looked up in bulk by model name, content and the values of the
+    meta fields embedded with it, only the misses are encoded, once per distinct key.
+    The model is borrowed from the model registry on a miss, so batches that are fully
+    cached never load it.
+    """
+    def __init__(self, embedder, cache=None):
+        self.embedder = embedder
+        self.cache = cache
+
+    def warm_up(self):
+        # Deferred to the first cache miss
+        pass
+
+    def _meta_values(self, document):
+        return [str(document.meta[key]) for key in self.embedder.meta_fields_to_embed
+                if key in document.meta and document.meta[key]]
+
+    def _embed(self, documents):
+        """Embed the documents the way SentenceTransformersDocumentEmbedder.run does."""
+        embedder = self.embedder
+        texts = [embedder.prefix + embedder.embedding_separator.join(self._meta_values(doc) + [doc.content or ""])
+                 + embedder.suffix for doc in documents]
+        with use_embedding_backend(embedder) as backend:
+            embeddings = backend.embed(texts,
+                                       batch_size=embedder.batch_size,
+                                       show_progress_bar=embedder.progress_bar,
+                                       normalize_embeddings=embedder.normalize_embeddings,
+                                       precision=embedder.precision,
+                                       **(embedder.encode_kwargs or {}))
+        return [replace(doc, embedding=embedding) for doc, embedding in zip(documents, embeddings)]
+
+    def _key(self, document):
+        embedder = self.embedder
+        return embedding_key(embedder.model, embedder.prefix + (document.content or "") + embedder.suffix,
+                             self._meta_values(document))
+
+    @component.output_types(documents=List[Document])
+    def run(self, documents: List[Document]):
+        if self.cache is None:
+            return {"documents": self._embed(documents)}
+        keys = [self._key(doc) for doc in documents]
+        embeddings = self.cache.get_many(keys)
+        missing = {}
+        for key, doc in zip(keys, documents):
+            if key not in embeddings:
+                missing.setdefault(key, doc)
+        if missing:
+            embedded = self._embed([replace(doc, embedding=None) for doc in missing.values()])
+            new_embeddings = {key: doc.embedding for key, doc in zip(missing, embedded)}
+            self.cache.set_many(new_embeddings.items())
+            embeddings.update(new_embeddings)
+        logger.info(f"Embedded {len(missing)} of {len(documents)} chunks, the rest came from the embedding cache")
+        return {"documents": [replace(doc, embedding=embeddings[key]) for key, doc in zip(keys, documents)]}
@@ -0,0 +1,629 @@
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from haystack import component, default_from_dict, default_to_dict
+from haystack.dataclasses import Document
+from haystack.document_stores.errors import DuplicateDocumentError
+from haystack.document_stores.types import DuplicatePolicy
+from haystack.utils.filters import document_matches_filter
+
+from src.compression import create_compressor
+
+logger = logging.getLogger(__name__)
+
+EMBEDDINGS_FILE = "embeddings.bin"
+CONTENT_FILE = "content.bin"
+ROWS_FILE = "rows.bin"
+SCALES_FILE = "scales.bin"
+DOCS_FILE = "docs.jsonl"
+TOMBSTONES_FILE = "tombstones.bin"
+COLUMNS_FILE = "columns.json"
+CODES_FILE = "codes.bin"
+CODEBOOK_FILE = "codebook.npz"
+# Files holding one entry per row, named by the generation of the store
+DATA_FILES = (EMBEDDINGS_FILE, CONTENT_FILE, ROWS_FILE, SCALES_FILE, DOCS_FILE, TOMBSTONES_FILE, CODES_FILE)
+DTYPES = {"float16": np.float16, "int8": np.int8}
+ROW_DTYPE = np.dtype([("content_offset", "<i8"), ("content_length", "<i8"), ("embedding_row", "<i8")])
+SCALE_DTYPE = np.dtype("<f4")
+TOMBSTONE_DTYPE = np.dtype("<i8")
+
+
+def _generation_file(name, generation):
+    """File name of a data file of the generation, stores written before generations use the bare name."""
+    if generation is None:
+        return name
+    root, ext = os.path.splitext(name)
+    return f"{root}.{generation}{ext}"
+
+
+class FlatDocumentStore:
+    """
+    Document store keeping normalised embeddings in a flat memory-mapped matrix.
+    Embeddings are stored as float16, or as int8 with one scale per row in scales.bin, in
+    embeddings.bin. Contents are appended to content.bin, the content offset and length and
+    embedding row of every document to the fixed-width records of rows.bin, its id and meta
+    to docs.jsonl and the rows of deleted documents to tombstones.bin. columns.json only
+    records the dtype, dimension and committed length of every file and is replaced after
+    the data is appended, readers never see rows whose data is not on disk yet. Opening the
+    store parses the ids and meta, the matrix and contents are mapped from disk.
+    Search is a brute-force matrix product in blocks of block_size rows followed by an
+    argpartition top-k, for any number of query vectors at once. Scores are cosine
+    similarities, higher is closer.
+
+    Writes append to the files, so a write costs the size of the batch rather than of the
+    store. Overwritten and deleted documents are tombstoned and the files are compacted
+    once more than compact_ratio of the rows are dead. Compaction writes the live rows to
+    the files of a new generation, switches columns.json to it and then removes the old
+    generation. A process reading the same persist_path reads the rows appended by another
+    process on its next search or filter.
+
+    With compression set to "pca" or "pq" (see src.compression) a codebook is trained on
+    the stored embeddings once there are min_train_size of them, and retrained whenever the
+    store has doubled since. Only the compressed codes are kept in memory and scanned, the
+    top_k * rerank_factor candidates of every query are then re-scored against the
+    full-precision rows read from the memory map.
+    """
+    def __init__(self, persist_path="flat_index", dtype="float16", block_size=65536, compact_ratio=0.3,
+                 compression="none", compression_params=None, rerank_factor=4, min_train_size=1024,
+                 max_train_size=65536):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported dtype '{dtype}', expected one of {list(DTYPES)}")
+        self.persist_path = persist_path
+        self.dtype = dtype
+        self.block_size = block_size
+        self.compact_ratio = compact_ratio
+        self.compression = compression
+        self.compression_params = dict(compression_params or {})
+        self.rerank_factor = rerank_factor
+        self.min_train_size = min_train_size
+        self.max_train_size = max_train_size
+        self.compressor = create_compressor(compression, **self.compression_params)
+        self._lock = threading.RLock()
+        self._loaded_mtime = None
+        os.makedirs(persist_path, exist_ok=True)
+        self._reset()
+        if not os.path.exists(self._path(COLUMNS_FILE)):
+            self._generation = 1
+        else:
+            self._load()
+            if self.compressor is not None and self._codes is None and len(self._scales) >= self.min_train_size:
+                # Compression was switched on for an existing store
+                with self._lock:
+                    self._migrate()
+                    self._update_codes()
+                    self._save_columns()
+
+    def _path(self, name):
+        return os.path.join(self.persist_path, name)
+
+    def _file(self, name):
+        return self._path(_generation_file(name, self._generation))
+
+    def _reset(self):
+        self.dim = None
+        self._ids = []
+        self._meta = []
+        self._content_offset = []
+        self._content_length = []
+        # Row of every document in the embedding matrix, -1 when it has no embedding
+        self._embedding_row = []
+        self._deleted = []
+        self._scales = []
+        self._row_of = {}
+        self._content_size = 0
+        self._docs_bytes = 0
+        self._num_tombstones = 0
+        self._generation = None
+        self._matrix = None
+        self._scale_array = None
+        self._content = None
+        self._row_docs = None
+        self._codes = None
+        self._trained_rows = 0
+
+    def _load(self):
+        """Read the rows committed since the last load, or every row when the store was compacted."""
+        with open(self._path(COLUMNS_FILE), "r", encoding="utf-8") as f:
+            mtime = os.fstat(f.fileno()).st_mtime_ns
+            columns = json.load(f)
+        if columns["dtype"] != self.dtype:
+            raise ValueError(f"Store at {self.persist_path} holds {columns['dtype']} embeddings, not {self.dtype}")
+        if "id" in columns:
+            self._load_legacy(columns)
+        else:
+            full = (columns["generation"] != self._generation or columns["num_rows"] < len(self._ids)
+                    or columns["num_tombstones"] < self._num_tombstones)
+            if full:
+                self._reset()
+                self._generation = columns["generation"]
+            self._load_rows(columns)
+            if self.compressor is not None and columns["codes_method"] == self.compression:
+                num_codes = len(self._codes) if self._codes is not None else None
+                if (columns["codes_rows"], columns["trained_rows"]) != (num_codes, self._trained_rows):
+                    self._load_codes(columns["codes_rows"])
+            else:
+                self._codes = None
+            if full:
+                logger.info(f"Opened flat store with {len(self._row_of)} documents from {self.persist_path}")
+        self._loaded_mtime = mtime
+        # Mapped at once, a compaction by another process removing the files leaves the mappings valid
+        self._embedding_matrix()
+        self._content_bytes()
+
+    def _read_array(self, name, dtype, start, stop):
+        if stop <= start:
+            return np.empty(0, dtype=dtype)
+        return np.fromfile(self._file(name), dtype=dtype, count=stop - start, offset=start * dtype.itemsize)
+
+    def _load_rows(self, columns):
+        first = len(self._ids)
+        rows = self._read_array(ROWS_FILE, ROW_DTYPE, first, columns["num_rows"])
+        docs = b""
+        if columns["docs_bytes"] > self._docs_bytes:
+            with open(self._file(DOCS_FILE), "rb") as f:
+                f.seek(self._docs_bytes)
+                docs = f.read(columns["docs_bytes"] - self._docs_bytes)
+        for row, line in enumerate(docs.splitlines(), start=first):
+            doc = json.loads(line)
+            self._ids.append(doc["id"])
+            self._meta.append(doc["meta"])
+            self._row_of[doc["id"]] = row
+        self._content_offset.extend(rows["content_offset"].tolist())
+        self._content_length.extend(rows["content_length"].tolist())
+        self._embedding_row.extend(rows["embedding_row"].tolist())
+        self._deleted.extend([False] * len(rows))
+        self._scales.extend(self._read_array(SCALES_FILE, SCALE_DTYPE, len(self._scales),
+                                             columns["num_embedding_rows"]).tolist())
+        for row in self._read_array(TOMBSTONES_FILE, TOMBSTONE_DTYPE, self._num_tombstones,
+                                    columns["num_tombstones"]).tolist():
+            self._deleted[row] = True
+            if self._row_of.get(self._ids[row]) == row:
+                del self._row_of[self._ids[row]]
+        self.dim = columns["dim"]
+        self._content_size = columns["content_size"]
+        self._docs_bytes = columns["docs_bytes"]
+        self._num_tombstones = columns["num_tombstones"]
+        self._matrix, self._scale_array, self._content, self._row_docs = None, None, None, None
+
+    def _load_legacy(self, columns):
+        """Columns of a store written before the rows were appended to files, migrated by its next write."""
+        self._reset()
+        self.dim = columns["dim"]
+        self._ids = columns["id"]
+        self._meta = columns["meta"]
+        self._content_offset = columns["content_offset"]
+        self._content_length = columns["content_length"]
+        self._embedding_row = columns["embedding_row"]
+        self._deleted = columns["deleted"]
+        self._scales = columns["scale"]
+        self._content_size = columns["content_size"]
+        self._row_of = {doc_id: row for row, doc_id in enumerate(self._ids) if not self._deleted[row]}
+        if self.compressor is not None and columns.get("codes_method") == self.compression:
+            self._load_codes(columns["codes_rows"])
+        logger.info(f"Opened flat store with {len(self._row_of)} documents from {self.persist_path}")
+
+    def _migrate(self):
+        if self._generation is None:
+            logger.info(f"Rewriting the flat store at {self.persist_path} in the appendable format")
+            self.compact()
+
+    def _load_codes(self, num_rows):
+        with np.load(self._path(CODEBOOK_FILE)) as codebook:
+            self.compressor.load_state({name: codebook[name] for name in codebook.files if name != "trained_rows"})
+            self._trained_rows = int(codebook["trained_rows"])
+        codes = np.fromfile(self._file(CODES_FILE), dtype=self.compressor.code_dtype)
+        self._codes = codes.reshape(-1, self.compressor.code_width)[:num_rows]
+
+    def _reload_if_stale(self):
+        path = self._path(COLUMNS_FILE)
+        if os.path.exists(path) and os.stat(path).st_mtime_ns != self._loaded_mtime:
+            try:
+                self._load()
+            except FileNotFoundError:
+                # Another process compacted the store between reading columns.json and its files
+                self._load()
+
+    def _save_columns(self):
+        columns = {
+            "generation": self._generation,
+            "dtype": self.dtype,
+            "dim": self.dim,
+            "num_rows": len(self._ids),
+            "num_embedding_rows": len(self._scales),
+            "num_tombstones": self._num_tombstones,
+            "content_size": self._content_size,
+            "docs_bytes": self._docs_bytes,
+            "codes_method": self.compression if self._codes is not None else None,
+            "codes_rows": len(self._codes) if self._codes is not None else 0,
+            "trained_rows": self._trained_rows,
+        }
+        # The columns are replaced last, readers never see rows whose data is not on disk yet
+        tmp_path = f"{self._path(COLUMNS_FILE)}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(columns, f)
+        os.replace(tmp_path, self._path(COLUMNS_FILE))
+        self._loaded_mtime = os.stat(self._path(COLUMNS_FILE)).st_mtime_ns
+
+    def _append(self, name, data, committed_bytes):
+        with open(self._file(name), "ab") as f:
+            # Bytes past the committed length are left over from an interrupted write
+            f.truncate(committed_bytes)
+            f.write(data)
+
+    def _embedding_matrix(self):
+        if self._matrix is None and self._scales:
+            self._matrix = np.memmap(self._file(EMBEDDINGS_FILE), dtype=DTYPES[self.dtype], mode="r",
+                                     shape=(len(self._scales), self.dim))
+            self._scale_array = np.asarray(self._scales, dtype=np.float32)
+        return self._matrix
+
+    def _content_bytes(self):
+        if self._content is None and self._content_size:
+            self._content = np.memmap(self._file(CONTENT_FILE), dtype=np.uint8, mode="r",
+                                      shape=(self._content_size,))
+        return self._content
+
+    def _encode(self, embeddings):
+        """Normalise float32 rows and convert them to the storage dtype, returns (rows, scales)."""
+        embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        if self.dtype == "int8":
+            scales = np.maximum(np.abs(embeddings).max(axis=1), 1e-12) / 127.0
+            return np.round(embeddings / scales[:, None]).astype(np.int8), scales
+        return embeddings.astype(np.float16), np.ones(len(embeddings), dtype=np.float32)
+
+    def _decode(self, index):
+        """Full-precision float32 rows of the embedding matrix at index, a slice or an array of rows."""
+        block = np.asarray(self._embedding_matrix()[index], dtype=np.float32)
+        if self.dtype == "int8":
+            block *= self._scale_array[index][:, None]
+        return block
+
+    def _document(self, row, with_embedding=False, score=None):
+        content = None
+        offset, length = self._content_offset[row], self._content_length[row]
+        if offset >= 0:
+            content = bytes(self._content_bytes()[offset:offset + length]).decode("utf-8") if length else ""
+        embedding = None
+        if with_embedding and self._embedding_row[row] >= 0:
+            embedding_row = self._embedding_row[row]
+            embedding = self._decode(slice(embedding_row, embedding_row + 1))[0].tolist()
+        return Document(id=self._ids[row], content=content, meta=dict(self._meta[row]),
+                        embedding=embedding, score=score)
+
+    def count_documents(self) -> int:
+        with self._lock:
+            self._reload_if_stale()
+            return len(self._row_of)
+
+    def _matching_rows(self, filters):
+        if filters and "operator" not in filters and "conditions" not in filters:
+            raise ValueError(
+                "Invalid filter syntax. See https://docs.haystack.deepset.ai/docs/metadata-filtering for details."
+            )
+        rows = sorted(self._row_of.values())
+        if not filters:
+            return rows
+        return [row for row in rows if document_matches_filter(filters=filters, document=self._document(row))]
+
+    def filter_documents(self, filters: Optional[Dict[str, Any]] = None) -> List[Document]:
+        with self._lock:
+            self._reload_if_stale()
+            return [self._document(row, with_embedding=True) for row in self._matching_rows(filters)]
+
+    def write_documents(self, documents: List[Document], policy: DuplicatePolicy = DuplicatePolicy.NONE) -> int:
+        if not isinstance(documents, list) or any(not isinstance(doc, Document) for doc in documents):
+            raise ValueError("Please provide a list of Documents.")
+        if policy == DuplicatePolicy.NONE:
+            policy = DuplicatePolicy.FAIL
+
+        with self._lock:
+            self._reload_if_stale()
+            self._migrate()
+            new_docs = {}
+            for doc in documents:
+                if doc.id in self._row_of or doc.id in new_docs:
+                    if policy == DuplicatePolicy.FAIL:
+                        raise DuplicateDocumentError(f"ID '{doc.id}' already exists.")
+                    if policy == DuplicatePolicy.SKIP:
+                        logger.warning(f"ID '{doc.id}' already exists")
+                        continue
+                new_docs[doc.id] = doc
+            if not new_docs:
+                return 0
+
+            tombstones = [self._row_of.pop(doc_id) for doc_id in new_docs if doc_id in self._row_of]
+            for row in tombstones:
+                self._deleted[row] = True
+
+            with_embedding = [doc for doc in new_docs.values() if doc.embedding is not None]
+            if with_embedding:
+                embeddings = np.array([doc.embedding for doc in with_embedding], dtype=np.float32)
+                if self.dim is None:
+                    self.dim = embeddings.shape[1]
+                elif embeddings.shape[1] != self.dim:
+                    raise ValueError(f"Embedding dimension {embeddings.shape[1]} does not match the store's {self.dim}")
+                rows, scales = self._encode(embeddings)
+                first_row = len(self._scales)
+                self._append(EMBEDDINGS_FILE, rows.tobytes(), first_row * rows.itemsize * self.dim)
+                self._append(SCALES_FILE, scales.astype(SCALE_DTYPE).tobytes(), first_row * SCALE_DTYPE.itemsize)
+                self._scales.extend(scales.tolist())
+                embedding_rows = {doc.id: first_row + i for i, doc in enumerate(with_embedding)}
+            else:
+                embedding_rows = {}
+
+            first_doc, content_size = len(self._ids), self._content_size
+            contents, docs = [], []
+            for doc in new_docs.values():
+                offset, length = -1, 0
+                if doc.content is not None:
+                    data = doc.content.encode("utf-8")
+                    contents.append(data)
+                    offset, length = self._content_size, len(data)
+                    self._content_size += length
+                self._row_of[doc.id] = len(self._ids)
+                self._ids.append(doc.id)
+                self._meta.append(dict(doc.meta))
+                self._content_offset.append(offset)
+                self._content_length.append(length)
+                self._embedding_row.append(embedding_rows.get(doc.id, -1))
+                self._deleted.append(False)
+                docs.append(json.dumps({"id": doc.id, "meta": self._meta[-1]}) + "\n")
+            records = np.array(list(zip(self._content_offset[first_doc:], self._content_length[first_doc:],
+                                        self._embedding_row[first_doc:])), dtype=ROW_DTYPE)
+            docs = "".join(docs).encode("utf-8")
+            self._append(CONTENT_FILE, b"".join(contents), content_size)
+            self._append(ROWS_FILE, records.tobytes(), first_doc * ROW_DTYPE.itemsize)
+            self._append(DOCS_FILE, docs, self._docs_bytes)
+            self._docs_bytes += len(docs)
+            self._append_tombstones(tombstones)
+
+            self._matrix, self._content, self._row_docs = None, None, None
+            self._update_codes()
+            self._save_columns()
+            return len(new_docs)
+
+    def _append_tombstones(self, rows):
+        if rows:
+            self._append(TOMBSTONES_FILE, np.asarray(rows, dtype=TOMBSTONE_DTYPE).tobytes(),
+                         self._num_tombstones * TOMBSTONE_DTYPE.itemsize)
+            self._num_tombstones += len(rows)
+
+    def _write_codes(self, codes):
+        tmp_path = f"{self._file(CODES_FILE)}.{os.getpid()}.tmp"
+        codes.tofile(tmp_path)
+        os.replace(tmp_path, self._file(CODES_FILE))
+
+    def _encode_rows(self, start, end):
+        return np.concatenate(
+            [self.compressor.encode(self._decode(slice(block, min(block + self.block_size, end))))
+             for block in range(start, end, self.block_size)]
+        ) if end > start else np.empty((0, self.compressor.code_width), dtype=self.compressor.code_dtype)
+
+    def _update_codes(self):
+        """Train the codebook when due, otherwise encode the embedding rows added since the last write."""
+        if self.compressor is None:
+            return
+        num_rows = len(self._scales)
+        if self._codes is None or num_rows >= 2 * self._trained_rows:
+            if num_rows < self.min_train_size:
+                return
+            rows = np.flatnonzero(self._live_row_docs() >= 0)
+            if len(rows) > self.max_train_size:
+                rows = np.sort(np.random.default_rng(0).choice(rows, self.max_train_size, replace=False))
+            logger.info(f"Training {self.compression} codebook on {len(rows)} embeddings")
+            self.compressor.fit(self._decode(rows))
+            self._trained_rows = num_rows
+            tmp_path = f"{self._path(CODEBOOK_FILE)}.{os.getpid()}.tmp.npz"
+            np.savez(tmp_path, trained_rows=num_rows, **self.compressor.state())
+            os.replace(tmp_path, self._path(CODEBOOK_FILE))
+            self._codes = self._encode_rows(0, num_rows)
+            self._write_codes(self._codes)
+        elif len(self._codes) < num_rows:
+            new_codes = self._encode_rows(len(self._codes), num_rows)
+            self._append(CODES_FILE, new_codes.tobytes(), self._codes.nbytes)
+            self._codes = np.concatenate([self._codes, new_codes])
+
+    def delete_documents(self, document_ids: List[str]) -> None:
+        with self._lock:
+            self._reload_if_stale()
+            self._migrate()
+            tombstones = []
+            for doc_id in document_ids:
+                row = self._row_of.pop(doc_id, None)
+                if row is not None:
+                    self._deleted[row] = True
+                    tombstones.append(row)
+            if not tombstones:
+                return
+            self._row_docs = None
+            self._append_tombstones(tombstones)
+            if sum(self._deleted) > self.compact_ratio * len(self._ids):
+                self.compact()
+            else:
+                self._save_columns()
+
+    def compact(self):
+        """
+        Rewrite the live rows to the files of a new generation, without the rows of deleted
+        and overwritten documents. columns.json is switched to the new files once they are
+        written and the files of the old generation are removed after.
+        """
+        with self._lock:
+            live_rows = sorted(self._row_of.values())
+            matrix, content = self._embedding_matrix(), self._content_bytes()
+            old_generation = self._generation
+            generation = (old_generation or 0) + 1
+            paths = {name: self._path(_generation_file(name, generation)) for name in DATA_FILES}
+            offsets, embedding_rows, scales, kept_rows = [], [], [], []
+            content_size = 0
+            with open(paths[EMBEDDINGS_FILE], "wb") as embeddings_file, \
+                    open(paths[CONTENT_FILE], "wb") as content_file:
+                for row in live_rows:
+                    offset, length = self._content_offset[row], self._content_length[row]
+                    if offset >= 0:
+                        content_file.write(bytes(content[offset:offset + length]))
+                        offset = content_size
+                        content_size += length
+                    offsets.append(offset)
+                    embedding_row = self._embedding_row[row]
+                    if embedding_row >= 0:
+                        # Raw rows are copied as they are, int8 codes are not quantised twice
+                        embeddings_file.write(np.asarray(matrix[embedding_row]).tobytes())
+                        scales.append(self._scales[embedding_row])
+                        kept_rows.append(embedding_row)
+                        embedding_row = len(scales) - 1
+                    embedding_rows.append(embedding_row)
+            ids = [self._ids[row] for row in live_rows]
+            meta = [self._meta[row] for row in live_rows]
+            lengths = [self._content_length[row] for row in live_rows]
+            np.array(list(zip(offsets, lengths, embedding_rows)), dtype=ROW_DTYPE).tofile(paths[ROWS_FILE])
+            np.asarray(scales, dtype=SCALE_DTYPE).tofile(paths[SCALES_FILE])
+            docs = "".join(json.dumps({"id": doc_id, "meta": doc_meta}) + "\n"
+                           for doc_id, doc_meta in zip(ids, meta)).encode("utf-8")
+            with open(paths[DOCS_FILE], "wb") as f:
+                f.write(docs)
+            open(paths[TOMBSTONES_FILE], "wb").close()
+
+            codes = None
+            if self._codes is not None:
+                # Embedding rows only ever move up, the codes of kept rows stay a prefix
+                codes = self._codes[[row for row in kept_rows if row < len(self._codes)]]
+
+            dim, trained_rows = self.dim, self._trained_rows
+            self._reset()
+            self._generation = generation
+            self.dim, self._codes, self._trained_rows = dim, codes, trained_rows
+            self._ids, self._meta = ids, meta
+            self._content_offset, self._content_length = offsets, lengths
+            self._embedding_row, self._scales = embedding_rows, scales
+            self._deleted = [False] * len(ids)
+            self._content_size = content_size
+            self._docs_bytes = len(docs)
+            self._row_of = {doc_id: row for row, doc_id in enumerate(ids)}
+            if codes is not None:
+                self._write_codes(codes)
+            self._save_columns()
+            for name in DATA_FILES:
+                try:
+                    os.remove(self._path(_generation_file(name, old_generation)))
+                except FileNotFoundError:
+                    pass
+            logger.info(f"Compacted flat store to {len(ids)} documents")
+
+    def sample_embeddings(self, max_samples, seed=0):
+        """Uniform sample of at most max_samples stored embeddings, read from the memory map."""
+        with self._lock:
+            self._reload_if_stale()
+            rows = np.array([self._embedding_row[row] for row in self._row_of.values() if self._embedding_row[row] >= 0],
+                            dtype=np.int64)
+            if len(rows) > max_samples:
+                rows = np.random.default_rng(seed).choice(rows, max_samples, replace=False)
+            if not len(rows):
+                return np.empty((0, self.dim or 0), dtype=np.float32)
+            return self._decode(np.sort(rows))
+
+    def _live_row_docs(self):
+        """Document row of every live embedding row, -1 for rows that are no longer live."""
+        if self._row_docs is None:
+            row_docs = np.full(len(self._scales), -1, dtype=np.int64)
+            for row in self._row_of.values():
+                if self._embedding_row[row] >= 0:
+                    row_docs[self._embedding_row[row]] = row
+            self._row_docs = row_docs
+        return self._row_docs
+
+    def search_embeddings(self, query_embeddings: List[List[float]], top_k: int = 10,
+                          filters: Optional[Dict[str, Any]] = None) -> List[List[Document]]:
+        """Returns the top_k documents of every query embedding, ordered by cosine similarity."""
+        queries = np.array(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1)
+        queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            self._reload_if_stale()
+            row_docs = self._live_row_docs()
+            candidates = row_docs >= 0
+            if filters:
+                allowed = np.zeros(len(self._ids), dtype=bool)
+                allowed[self._matching_rows(filters)] = True
+                candidates &= allowed[np.maximum(row_docs, 0)]
+            num_candidates = int(candidates.sum())
+            if not num_candidates or not len(queries):
+                return [[] for _ in queries]
+
+            # Rows added after the codebook was trained and before they were encoded are scored exactly
+            num_coded = len(self._codes) if self._codes is not None else 0
+            prepared = self.compressor.prepare_queries(queries) if num_coded else None
+            scores = np.empty((len(queries), len(row_docs)), dtype=np.float32)
+            for start in range(0, len(row_docs), self.block_size):
+                end = min(start + self.block_size, len(row_docs))
+                if end <= num_coded:
+                    scores[:, start:end] = self.compressor.score(prepared, self._codes[start:end])
+                else:
+                    scores[:, start:end] = queries @ self._decode(slice(start, end)).T
+            scores[:, ~candidates] = -np.inf
+
+            k = min(top_k, num_candidates)
+            num_rerank = min(k * self.rerank_factor, num_candidates) if num_coded else k
+            top = np.argpartition(-scores, num_rerank - 1, axis=1)[:, :num_rerank]
+            results = []
+            for query, query_scores, query_top in zip(queries, scores, top):
+                if num_coded:
+                    # Full-precision re-scoring of the approximate candidates
+                    query_top = np.sort(query_top)
+                    top_scores = self._decode(query_top) @ query
+                else:
+                    top_scores = query_scores[query_top]
+                order = np.argsort(-top_scores)[:k]
+                results.append([self._document(int(row_docs[i]), score=float(score))
+                                for i, score in zip(query_top[order], top_scores[order])])
+            return results
+
+    def memory_stats(self):
+        """Bytes of the embedding data, the part scanned by search is held in memory when compressed."""
+        with self._lock:
+            full_precision = len(self._scales) * (self.dim or 0) * np.dtype(DTYPES[self.dtype]).itemsize
+            stats = {"num_vectors": len(self._scales), "full_precision_bytes": full_precision,
+                     "content_bytes": self._content_size, "codes_bytes": 0, "codebook_bytes": 0}
+            if self._codes is not None:
+                stats["codes_bytes"] = self._codes.nbytes
+                stats["codebook_bytes"] = sum(array.nbytes for array in self.compressor.state().values())
+            return stats
+
+    def to_dict(self) -> Dict[str, Any]:
+        return default_to_dict(self, persist_path=self.persist_path, dtype=self.dtype,
+                               block_size=self.block_size, compact_ratio=self.compact_ratio,
+                               compression=self.compression, compression_params=self.compression_params,
+                               rerank_factor=self.rerank_factor, min_train_size=self.min_train_size,
+                               max_train_size=self.max_train_size)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "FlatDocumentStore":
+        return default_from_dict(cls, data)
+
+
+@component
+class FlatEmbeddingRetriever:
+    """Retrieves the documents closest to a query embedding from a FlatDocumentStore."""
+    def __init__(self, document_store: FlatDocumentStore, filters: Optional[Dict[str, Any]] = None, top_k: int = 10):
+        self.document_store = document_store
+        self.filters = filters
+        self.top_k = top_k
+
+    @component.output_types(documents=List[Document])
+    def run(self, query_embedding: List[float], filters: Optional[Dict[str, Any]] = None,
+            top_k: Optional[int] = None):
+        documents = self.document_store.search_embeddings(
+            [query_embedding], top_k=top_k or self.top_k, filters=filters or self.filters)[0]
+        return {"documents": documents}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return default_to_dict(self, document_store=self.document_store.to_dict(),
+                               filters=self.filters, top_k=self.top_k)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "FlatEmbeddingRetriever":
+        data["init_parameters"]["document_store"] = FlatDocumentStore.from_dict(data["init_parameters"]["document_store"])
+        return default_from_dict(cls, data)
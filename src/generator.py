@@ -1,9 +1,344 @@
+import copy
+import gc
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from time import perf_counter
+from typing import List
+
 import torch
 from transformers import BitsAndBytesConfig
+from transformers.generation.streamers import BaseStreamer
 
+from haystack import component
 from haystack.components.generators import HuggingFaceLocalGenerator
+from haystack.dataclasses import StreamingChunk
+from haystack.utils import ComponentDevice
+from haystack.utils.hf import HFTokenStreamingHandler
+
+from src.metrics import get_metrics
+from src.model_registry import get_model_registry
+
+logger = logging.getLogger(__name__)
+
+# Start of the first Jinja statement, expression or comment of a prompt template
+TEMPLATE_TAG = re.compile(r"{[{%#]")
+
+
+def template_prefix(template):
+    """
+    Constant text a prompt template renders before its first Jinja tag, cut back to the
+    last line break so the tokens of the prefix stay the same in every rendered prompt.
+    """
+    match = TEMPLATE_TAG.search(template)
+    prefix = template[:match.start()] if match else template
+    return prefix[:prefix.rfind("\n") + 1]
+
+
+class GenerationStats:
+    """Output tokens per second and time to first token of a generator, recorded the same way by every backend."""
+    def __init__(self):
+        self.requests = 0
+        self.prompts = 0
+        self.output_tokens = 0
+        self.seconds = 0.0
+        self.ttft_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, num_prompts, output_tokens, seconds, ttft, prompt_tokens=0):
+        """Record one generate call of num_prompts prompts, ttft and seconds are wall times from its start."""
+        with self._lock:
+            self.requests += 1
+            self.prompts += num_prompts
+            self.output_tokens += output_tokens
+            self.seconds += seconds
+            self.ttft_seconds += ttft
+        metrics = get_metrics()
+        metrics.observe("rag_stage_seconds", seconds, stage="generate")
+        metrics.observe("generator_ttft_seconds", ttft)
+        if num_prompts:
+            # Token counts of a batch are observed as its per prompt average
+            metrics.observe("generator_prompt_tokens", prompt_tokens / num_prompts)
+            metrics.observe("generator_output_tokens", output_tokens / num_prompts)
+        if seconds > 0:
+            metrics.observe("generator_tokens_per_second", output_tokens / seconds)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "prompts": self.prompts,
+            "output_tokens": self.output_tokens,
+            "tokens_per_second": self.output_tokens / self.seconds if self.seconds else 0.0,
+            "avg_ttft_ms": self.ttft_seconds * 1000 / self.requests if self.requests else 0.0,
+        }
+
+
+class TimingStreamer(BaseStreamer):
+    """
+    Records when generate() emits its first new token, generate() puts the prompt ids
+    first and then one tensor of new tokens per step. Forwards to an optional streamer.
+    """
+    def __init__(self, streamer=None):
+        self.streamer = streamer
+        self.start = perf_counter()
+        self.first_token = None
+        self._prompt_seen = False
+
+    def put(self, value):
+        if self._prompt_seen and self.first_token is None:
+            self.first_token = perf_counter()
+        self._prompt_seen = True
+        if self.streamer is not None:
+            self.streamer.put(value)
+
+    def end(self):
+        if self.streamer is not None:
+            self.streamer.end()
+
+    @property
+    def ttft(self):
+        return (self.first_token or perf_counter()) - self.start
+
+
+@component
+class PrefixCachedGenerator:
+    """
+    Generates with a HuggingFaceLocalGenerator borrowed from the model registry and keeps
+    the key/value cache of the constant prefix of every registered prompt template, keyed
+    by the template's hash. A prompt starting with a registered prefix resumes generation
+    from a copy of its cache, so only the tokens after the prefix are prefilled. Other
+    prompts are generated from scratch. The caches are dropped when the registry unloads
+    the model and computed again on the next use.
+
+    Args:
+        load_generator (Callable[[], HuggingFaceLocalGenerator]): Loads a warmed up generator
+        model_name (str): Name of the model, device and dtype key it in the model registry
+        max_prefixes (int): Number of template prefix caches kept, least recently used ones are dropped
+        backend (str): Name of the backend the generator was created by, for the stats
+    """
+    def __init__(self, load_generator, model_name, device="auto", dtype="auto", max_prefixes=4, backend="hf"):
+        self.load_generator = load_generator
+        self.model_name = model_name
+        self.device = device
+        self.dtype = dtype
+        self.backend = backend
+        self.max_prefixes = max_prefixes
+        # template hash -> prefix text
+        self._templates = OrderedDict()
+        # template hash -> (prefix token ids, key/value cache) computed with the loaded model
+        self._prefixes = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.prefill_tokens_saved = 0
+        self.timing = GenerationStats()
+        with self._use() as generator:
+            # The tokenizer is small and kept, the model is released by the registry
+            self.tokenizer = generator.pipeline.tokenizer
+            self.generation_kwargs = generator.generation_kwargs
+            self.stop_words = generator.stop_words
+
+    def _use(self):
+        return get_model_registry().use(self.model_name, self.load_generator, device=self.device, dtype=self.dtype,
+                                        on_unload=self._drop_prefixes)
+
+    def _drop_prefixes(self):
+        with self._lock:
+            self._prefixes.clear()
+
+    def _count_tokens(self, replies):
+        return sum(len(ids) for ids in self.tokenizer(replies, add_special_tokens=False)["input_ids"]) if replies else 0
+
+    def register_template(self, template):
+        """Compute and keep the key/value cache of the template's constant prefix, returns its key."""
+        key = hashlib.sha256(template.encode("utf-8")).hexdigest()
+        prefix = template_prefix(template)
+        if not prefix.strip():
+            return None
+        with self._lock:
+            self._templates[key] = prefix
+        with self._use() as generator:
+            self._prefix_entry(key, generator.pipeline.model)
+        return key
+
+    def _prefix_entry(self, key, model):
+        """(prefix token ids, key/value cache) of the template, prefilled with the model if needed."""
+        with self._lock:
+            if key in self._prefixes:
+                self._prefixes.move_to_end(key)
+                return self._prefixes[key]
+            prefix = self._templates[key]
+        prefix_ids = self.tokenizer(prefix, return_tensors="pt").input_ids.to(model.device)
+        with torch.inference_mode():
+            cache = model(input_ids=prefix_ids, use_cache=True).past_key_values
+        with self._lock:
+            self._prefixes[key] = (prefix_ids[0], cache)
+            while len(self._prefixes) > self.max_prefixes:
+                self._prefixes.popitem(last=False)
+        logger.info(f"Cached the key/value cache of a {prefix_ids.shape[1]} token prompt template prefix")
+        return prefix_ids[0], cache
+
+    def _prefix_cache(self, prompt, input_ids, model):
+        """Copy of the cache of the registered prefix the prompt starts with, or None."""
+        with self._lock:
+            key = next((key for key, prefix in self._templates.items() if prompt.startswith(prefix)), None)
+        if key is None:
+            return None
+        prefix_ids, cache = self._prefix_entry(key, model)
+        # Keep the tokens the prefix and the prompt agree on, at least one token is left to prefill
+        length = min(len(prefix_ids), len(input_ids) - 1)
+        matching = (prefix_ids[:length] == input_ids[:length]).long()
+        length = int(matching.cumprod(0).sum())
+        if length == 0:
+            return None
+        cache = copy.deepcopy(cache)
+        if length < len(prefix_ids):
+            cache.crop(length)
+        self.prefill_tokens_saved += length
+        return cache
+
+    @component.output_types(replies=List[str])
+    def run(self, prompt: str, streaming_callback=None, generation_kwargs=None):
+        if not prompt:
+            return {"replies": []}
+        tokenizer = self.tokenizer
+        kwargs = {**self.generation_kwargs, **(generation_kwargs or {})}
+        # Pipeline only arguments, only the new tokens are decoded below
+        kwargs.pop("return_full_text", None)
+        kwargs["num_return_sequences"] = 1
+        streamer = None
+        if streaming_callback is not None:
+            streamer = HFTokenStreamingHandler(tokenizer=tokenizer, stream_handler=streaming_callback,
+                                               stop_words=self.stop_words)
+        timer = TimingStreamer(streamer)
+
+        with self._use() as generator:
+            model = generator.pipeline.model
+            inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+            cache = self._prefix_cache(prompt, inputs.input_ids[0], model)
+            if cache is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            with torch.inference_mode():
+                output = model.generate(**inputs, past_key_values=cache,
+                                        stopping_criteria=generator.stopping_criteria_list, streamer=timer, **kwargs)
+        new_tokens = output[0, inputs.input_ids.shape[1]:]
+        self.timing.record(1, len(new_tokens), perf_counter() - timer.start, timer.ttft,
+                           prompt_tokens=inputs.input_ids.shape[1])
+        return {"replies": [self._strip_stop_words(tokenizer.decode(new_tokens, skip_special_tokens=True))]}
+
+    def _strip_stop_words(self, reply):
+        for stop_word in self.stop_words or []:
+            reply = reply.replace(stop_word, "").rstrip()
+        return reply
+
+    def generate_batch(self, prompts):
+        """
+        Generate replies for several prompts in one padded forward pass, returns one reply
+        per prompt. A single prompt goes through run, which resumes from the cached template prefix.
+        """
+        if len(prompts) == 1:
+            return self.run(prompts[0])["replies"]
+        timer = TimingStreamer()
+        with self._use() as generator:
+            # The tokenizer is shared with run and every other user of the model, its padding is restored
+            tokenizer = generator.pipeline.tokenizer
+            padding_side, pad_token = tokenizer.padding_side, tokenizer.pad_token
+            if tokenizer.pad_token_id is None:
+                tokenizer.pad_token = tokenizer.eos_token
+            # Decoder-only models must be padded on the left so generation continues from the prompt
+            tokenizer.padding_side = "left"
+            try:
+                outputs = generator.pipeline(prompts,
+                                             batch_size=len(prompts),
+                                             stopping_criteria=generator.stopping_criteria_list,
+                                             streamer=timer,
+                                             **self.generation_kwargs)
+            finally:
+                tokenizer.padding_side = padding_side
+                if pad_token is None:
+                    tokenizer.pad_token = None
+        # Stripped like the replies of run, a prompt gets the same reply batched or not
+        replies = [self._strip_stop_words(output[0]["generated_text"]) for output in outputs]
+        self.timing.record(len(prompts), self._count_tokens(replies), perf_counter() - timer.start, timer.ttft,
+                           prompt_tokens=self._count_tokens(prompts))
+        return replies
 
-def create_generator(hf_gen_model="HuggingFaceH4/zephyr-7b-beta", bnb_quantize=True):
+    def stats(self):
+        return {
+            "backend": self.backend,
+            **self.timing.stats(),
+            "prompt_prefix": {
+                "prefixes": len(self._prefixes),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0,
+                "prefill_tokens_saved": self.prefill_tokens_saved,
+            },
+        }
+
+
+@component
+class StubGenerator:
+    """
+    Deterministic stand-in for the generation model, for load testing the serving stack on
+    machines without model weights. Every generate call waits ttft_ms before the first
+    token and token_ms between tokens, a batch shares those waits like a forward pass does.
+    The reply has num_tokens words and only depends on the prompt.
+    """
+    backend = "stub"
+
+    def __init__(self, ttft_ms=200, token_ms=20, num_tokens=32):
+        self.ttft = ttft_ms / 1000
+        self.token_interval = token_ms / 1000
+        self.num_tokens = num_tokens
+        # Context budgets are counted in words without a tokenizer
+        self.tokenizer = None
+        self.timing = GenerationStats()
+
+    def register_template(self, template):
+        return None
+
+    def _reply_words(self, prompt):
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+        return [f"stub-{digest}"] + [f"token{i}" for i in range(1, self.num_tokens)]
+
+    def _generate(self, prompts, streaming_callback=None):
+        start = perf_counter()
+        replies = [self._reply_words(prompt) for prompt in prompts]
+        time.sleep(self.ttft)
+        ttft = perf_counter() - start
+        for i in range(self.num_tokens):
+            if i:
+                time.sleep(self.token_interval)
+            if streaming_callback is not None:
+                streaming_callback(StreamingChunk(content=replies[0][i] + " ", index=0, start=i == 0))
+        # Without a tokenizer prompts are counted in whitespace words
+        self.timing.record(len(prompts), self.num_tokens * len(prompts), perf_counter() - start, ttft,
+                           prompt_tokens=sum(len(prompt.split()) for prompt in prompts))
+        return [" ".join(words) for words in replies]
+
+    @component.output_types(replies=List[str])
+    def run(self, prompt: str, streaming_callback=None, generation_kwargs=None):
+        if not prompt:
+            return {"replies": []}
+        return {"replies": self._generate([prompt], streaming_callback)}
+
+    def generate_batch(self, prompts):
+        return self._generate(prompts)
+
+    def stats(self):
+        return {"backend": self.backend, **self.timing.stats()}
+
+
+def create_hf_generator(hf_gen_model="HuggingFaceH4/zephyr-7b-beta", bnb_quantize=True, max_new_tokens=350,
+                        max_prefixes=4):
+    """Hugging Face model placed with device_map="auto", 4-bit bitsandbytes quantisation needs a CUDA GPU."""
+    huggingface_pipeline_kwargs = {"device_map": "auto"}
     if bnb_quantize:
         bnb_config = BitsAndBytesConfig(
             load_in_4bit=True,
@@ -11,19 +346,82 @@ def create_generator(hf_gen_model="HuggingFaceH4/zephyr-7b-beta", bnb_quantize=T
             bnb_4bit_quant_type="nf4",
             bnb_4bit_compute_dtype=torch.bfloat16
         )
+        huggingface_pipeline_kwargs["model_kwargs"] = {"quantization_config": bnb_config}
+
+    def load_generator():
         generator = HuggingFaceLocalGenerator(hf_gen_model,
-                                    huggingface_pipeline_kwargs={
-                                        "device_map":"auto",
-                                        "model_kwargs": {
-                                            "quantization_config": bnb_config
-                                            }
-                                        },
-                                        generation_kwargs={"max_new_tokens": 350})
-    else:
+                                              huggingface_pipeline_kwargs=huggingface_pipeline_kwargs,
+                                              generation_kwargs={"max_new_tokens": max_new_tokens})
+        generator.warm_up()
+        return generator
+
+    return PrefixCachedGenerator(load_generator, hf_gen_model, device="auto", dtype="nf4" if bnb_quantize else "auto",
+                                 max_prefixes=max_prefixes, backend="hf")
+
+
+def create_cpu_int8_generator(hf_gen_model="HuggingFaceH4/zephyr-7b-beta", cpu_threads=0, max_new_tokens=350,
+                              max_prefixes=4):
+    """
+    Hugging Face model on the CPU with the weights of its linear layers dynamically quantised
+    to int8, activations are quantised on the fly. The model is loaded in float32 first, so
+    loading peaks at about 4 bytes per parameter before settling near 1 byte per linear
+    weight. low_cpu_mem_usage keeps the loader from holding a second randomly initialised
+    copy on top of that.
+
+    cpu_threads sets the number of torch intra-op threads, 0 keeps the default of one per
+    core. The setting is process wide and also applies to the embedding model and any other
+    torch work of the process, it is applied when the generator is loaded.
+    """
+    def load_generator():
+        if cpu_threads > 0 and torch.get_num_threads() != cpu_threads:
+            logger.info(f"Setting the torch threads of the process from {torch.get_num_threads()} to {cpu_threads}")
+            torch.set_num_threads(cpu_threads)
         generator = HuggingFaceLocalGenerator(hf_gen_model,
-                                    huggingface_pipeline_kwargs={
-                                        "device_map":"auto"
-                                        },
-                                        generation_kwargs={"max_new_tokens": 350})
-    generator.warm_up()
-    return generator
\ No newline at end of file
+                                              device=ComponentDevice.from_str("cpu"),
+                                              huggingface_pipeline_kwargs={
+                                                  "torch_dtype": torch.float32,
+                                                  "model_kwargs": {"low_cpu_mem_usage": True}},
+                                              generation_kwargs={"max_new_tokens": max_new_tokens})
+        generator.warm_up()
+        torch.ao.quantization.quantize_dynamic(generator.pipeline.model, {torch.nn.Linear}, dtype=torch.qint8,
+                                               inplace=True)
+        # Release the float32 weights replaced by the quantised layers
+        gc.collect()
+        logger.info(f"Quantised the linear layers of {hf_gen_model} to int8 on {torch.get_num_threads()} CPU threads")
+        return generator
+
+    return PrefixCachedGenerator(load_generator, hf_gen_model, device="cpu", dtype="qint8",
+                                 max_prefixes=max_prefixes, backend="cpu_int8")
+
+
+GENERATOR_BACKENDS = {"hf": create_hf_generator, "cpu_int8": create_cpu_int8_generator, "stub": StubGenerator}
+
+
+def create_generator(backend="hf", **params):
+    """
+    Warmed up generator of the backend. Every backend is a component with run and
+    generate_batch, a tokenizer attribute (None counts words), register_template for
+    prompt templates and stats reporting tokens per second and time to first token.
+    """
+    if backend not in GENERATOR_BACKENDS:
+        raise ValueError(f"Unknown generator backend '{backend}', expected one of {list(GENERATOR_BACKENDS)}")
+    return GENERATOR_BACKENDS[backend](**params)
+
+
+def generator_options(cfg):
+    """create_generator keyword arguments of the backend selected in the hydra config."""
+    backend = cfg.generator_backend
+    if backend == "stub":
+        params = {"ttft_ms": cfg.stub_ttft_ms, "token_ms": cfg.stub_token_ms, "num_tokens": cfg.stub_num_tokens}
+    elif backend == "cpu_int8":
+        params = {"hf_gen_model": cfg.hf_gen_model, "cpu_threads": cfg.cpu_threads,
+                  "max_new_tokens": cfg.max_new_tokens}
+    else:
+        params = {"hf_gen_model": cfg.hf_gen_model, "bnb_quantize": cfg.bnb_quantize,
+                  "max_new_tokens": cfg.max_new_tokens}
+    return {"backend": backend, **params}
+
+
+def generate_batch(generator, prompts):
+    """Generate one reply per prompt with any generator backend."""
+    return generator.generate_batch(prompts)
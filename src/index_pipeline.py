@@ -1,87 +1,520 @@
 import os
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
 from haystack import Pipeline
-from haystack.components.converters import PyPDFToDocument, TextFileToDocument
+from haystack.components.converters import TextFileToDocument
 from haystack.components.preprocessors import DocumentCleaner, DocumentSplitter
-from haystack.components.embedders import SentenceTransformersDocumentEmbedder
-from haystack.components.writers import DocumentWriter
 from haystack.dataclasses import Document
-from haystack.document_stores.types import DuplicatePolicy
 
-from src.data_loader import AudioVideoExtractor, PPTXExtractor, CSVExtractor, ImageExtractor
+from src.chunker import TokenChunker
+from src.dedup import NearDuplicateFilter, source_file_paths, with_file_paths
+from src.embedder import CachedDocumentEmbedder, create_sentence_embedder
+from src.manifest import canonical_path
+from src.metrics import get_metrics
+from src.vector_store import (UpsertDocumentWriter, get_documents_by_id, get_index_version, iter_documents,
+                              upsert_documents)
+from src.data_loader import AudioVideoExtractor, PPTXExtractor, CSVExtractor, ImageExtractor, PDFExtractor
+
+logger = logging.getLogger(__name__)
+
+# Maps file extension to the extractor that handles it
+EXTRACTOR_TYPES = {
+    "pdf": "pdf",
+    "txt": "text",
+    "mp3": "av",
+    "mp4": "av",
+    "jpg": "image",
+    "png": "image",
+    "pptx": "pptx",
+    "csv": "csv",
+}
+SUPPORTED_EXTENSIONS = tuple(EXTRACTOR_TYPES)
+
+EXTRACTOR_FACTORIES = {
+    "pdf": PDFExtractor,
+    "text": TextFileToDocument,
+    "av": AudioVideoExtractor,
+    "image": ImageExtractor,
+    "pptx": PPTXExtractor,
+    "csv": CSVExtractor,
+}
+
+# Extractors that load a model, their files are dispatched first as they take the longest
+HEAVY_EXTRACTORS = ("av", "image")
 
 class HaystackIndexer:
-    def __init__(self, document_store, model_name="thenlper/gte-large"):
+    """
+    Cleans, splits, embeds and writes documents to the document store. When a lexical
+    index is given it is kept in sync with every write and delete. With an embedding
+    cache only chunks whose content has never been embedded by the model are encoded.
+    With a dedup index near-duplicate chunks are collapsed before embedding, the kept
+    chunk lists every source file in meta["file_paths"].
+
+    split_by "token" chunks with the structure-aware TokenChunker, packing up to
+    chunk_tokens tokens of the embedding model's tokenizer. Any other value is passed to
+    Haystack's DocumentSplitter along with split_length.
+
+    embedder is an optional SentenceTransformersDocumentEmbedder of model_name shared with
+    the retriever, one is created otherwise. With domain_prototypes, the DomainPrototypes
+    used by the query-time domain gate are refitted on the store after every indexing run.
+    """
+    def __init__(self, document_store, model_name="thenlper/gte-large", lexical_index=None, embedding_cache=None,
+                 dedup_index=None, split_by="sentence", split_length=2, chunk_tokens=256, chunk_overlap_tokens=32,
+                 embedder=None, domain_prototypes=None):
+        self.document_store = document_store
+        self.lexical_index = lexical_index
+        self.dedup_index = dedup_index
+        self.domain_prototypes = domain_prototypes
+        self.index_version = get_index_version(document_store)
         self.pipeline = Pipeline()
-        self.pipeline.add_component("cleaner", DocumentCleaner())
-        self.pipeline.add_component("splitter", DocumentSplitter(split_by='sentence', split_length=2))
-        self.pipeline.add_component("doc_embedder", SentenceTransformersDocumentEmbedder(model=model_name, meta_fields_to_embed=["title"]))
-        self.pipeline.add_component("writer", DocumentWriter(document_store=document_store, policy=DuplicatePolicy.OVERWRITE))
+        if split_by == "token":
+            # Line and paragraph breaks are structure the chunker splits on, keep them
+            self.pipeline.add_component("cleaner", DocumentCleaner(remove_empty_lines=False,
+                                                                   remove_extra_whitespaces=False))
+            self.pipeline.add_component("splitter", TokenChunker(tokenizer_name=model_name, chunk_tokens=chunk_tokens,
+                                                                 overlap_tokens=chunk_overlap_tokens))
+        else:
+            self.pipeline.add_component("cleaner", DocumentCleaner())
+            self.pipeline.add_component("splitter", DocumentSplitter(split_by=split_by, split_length=split_length))
+        if embedder is None:
+            embedder = create_sentence_embedder(model_name)
+        self.embedder = embedder
+        self.pipeline.add_component("doc_embedder", CachedDocumentEmbedder(embedder, cache=embedding_cache))
+        # Chunks collapsed with near-duplicates are written again under their stored id
+        self.pipeline.add_component("writer", UpsertDocumentWriter(document_store))
         self.pipeline.connect("cleaner", "splitter")
-        self.pipeline.connect("splitter", "doc_embedder")
+        # Name of the stage whose output chunks are embedded and written
+        self.chunk_stage = "splitter"
+        if dedup_index is not None:
+            self.pipeline.add_component("dedup", NearDuplicateFilter(dedup_index, document_store=document_store))
+            self.pipeline.connect("splitter", "dedup")
+            self.chunk_stage = "dedup"
+        self.pipeline.connect(self.chunk_stage, "doc_embedder")
         self.pipeline.connect("doc_embedder", "writer")
 
-    def index(self, raw_docs):
-        return self.pipeline.run({"cleaner": {"documents": raw_docs}})
+    @classmethod
+    def from_config(cls, cfg, document_store, lexical_index=None, embedding_cache=None, dedup_index=None,
+                    embedder=None, domain_prototypes=None):
+        return cls(document_store=document_store,
+                   model_name=cfg.rag_embedding_model_name,
+                   lexical_index=lexical_index,
+                   embedding_cache=embedding_cache,
+                   dedup_index=dedup_index,
+                   split_by=cfg.split_by,
+                   split_length=cfg.split_length,
+                   chunk_tokens=cfg.chunk_tokens,
+                   chunk_overlap_tokens=cfg.chunk_overlap_tokens,
+                   embedder=embedder,
+                   domain_prototypes=domain_prototypes)
+
+    def index(self, raw_docs, persist=True):
+        metrics = get_metrics()
+        with metrics.time("indexer_run_seconds"):
+            result = self.pipeline.run({"cleaner": {"documents": raw_docs}}, include_outputs_from={self.chunk_stage})
+        metrics.inc("indexer_documents_total", len(raw_docs))
+        metrics.inc("indexer_chunks_total", result["writer"]["documents_written"])
+        if self.lexical_index is not None:
+            self.lexical_index.add(result[self.chunk_stage]["documents"])
+        if persist:
+            self.persist()
+            self.refit_prototypes()
+        self.index_version.bump()
+        return result
+
+    def backfill_lexical_index(self):
+        """
+        Rebuild the lexical index from every stored chunk when it holds fewer chunks than
+        the store, e.g. when its file was lost or the store was indexed without it.
+        """
+        if self.lexical_index is None:
+            return False
+        num_stored = self.document_store.count_documents()
+        if len(self.lexical_index) >= num_stored:
+            return False
+        logger.info(f"Lexical index has {len(self.lexical_index)} of {num_stored} stored chunks, rebuilding it")
+        self.lexical_index.rebuild(iter_documents(self.document_store))
+        self.lexical_index.save()
+        return True
+
+    def refit_prototypes(self):
+        """Refit the domain prototypes on every chunk of the store, once per indexing run."""
+        if self.domain_prototypes is not None:
+            self.domain_prototypes.fit(self.document_store)
+
+    def persist(self):
+        """Save the indexes kept by the indexer itself, the document store persists on its own."""
+        if self.lexical_index is not None:
+            self.lexical_index.save()
+        if self.dedup_index is not None:
+            self.dedup_index.save()
+
+    def delete_files(self, file_paths):
+        """
+        Remove every stored chunk that was produced from the given source files. Collapsed
+        chunks that still have other source files are kept and rewritten without them.
+        """
+        if not file_paths:
+            return 0
+        docs = self.document_store.filter_documents(
+            filters={"field": "meta.file_path", "operator": "in", "value": list(file_paths)}
+        )
+        if self.dedup_index is not None:
+            # Chunks listing the files as secondary sources are only found through the dedup index
+            found = {doc.id for doc in docs}
+            missing = [chunk_id for chunk_id in self.dedup_index.chunks_of_files(file_paths) if chunk_id not in found]
+            docs.extend(get_documents_by_id(self.document_store, missing))
+        removed = set(file_paths)
+        doc_ids, rewritten = [], []
+        for doc in docs:
+            sources = source_file_paths(doc)
+            if self.dedup_index is not None:
+                sources = self.dedup_index.file_paths.get(doc.id) or sources
+            remaining = [path for path in sources if path not in removed]
+            if remaining:
+                rewritten.append(with_file_paths(doc, remaining))
+            else:
+                doc_ids.append(doc.id)
+        if doc_ids:
+            self.document_store.delete_documents(doc_ids)
+        if rewritten:
+            upsert_documents(self.document_store, rewritten)
+        if self.dedup_index is not None:
+            self.dedup_index.remove(doc_ids)
+            for doc in rewritten:
+                self.dedup_index.set_file_paths(doc.id, source_file_paths(doc))
+        if docs:
+            if self.lexical_index is not None:
+                self.lexical_index.remove(doc_ids)
+                self.lexical_index.add(rewritten)
+            self.persist()
+            self.index_version.bump()
+        return len(doc_ids)
+
+    def index_stream(self, file_documents, batch_size=64, on_commit=None, total_files=None, should_stop=None):
+        """
+        Index a stream of (file_path, documents) pairs in micro-batches so that only one
+        batch is held in memory at a time. Each batch is cleaned, split, embedded and
+        written before the next one is read from the stream.
+
+        Args:
+            file_documents (Iterable[tuple[str, list[Document]]]): Documents grouped by source file
+            batch_size (int): Number of raw documents per micro-batch
+            on_commit (Callable[[list[str]], None], optional): Called after every batch with the
+                files whose documents have all been written, used to checkpoint progress
+            total_files (int, optional): Number of files in the stream, used for progress logs
+            should_stop (Callable[[], bool], optional): Checked after every batch, the rest of
+                the stream is left unread when it returns True
+
+        Returns:
+            dict: Number of batches, files and documents indexed and whether it was stopped
+        """
+        stats = {"num_batches": 0, "num_files": 0, "num_docs_added": 0, "stopped": False}
+        batch, batch_files = [], []
+
+        def commit():
+            # A single file may yield more than batch_size documents, keep each run bounded
+            for start in range(0, len(batch), batch_size):
+                self.index(raw_docs=batch[start:start + batch_size], persist=False)
+                stats["num_batches"] += 1
+            self.persist()
+            self.index_version.bump()
+            stats["num_files"] += len(batch_files)
+            stats["num_docs_added"] += len(batch)
+            if on_commit is not None:
+                on_commit(list(batch_files))
+            logger.info(
+                f"Committed batch {stats['num_batches']}: {stats['num_docs_added']} documents from "
+                f"{stats['num_files']}/{total_files if total_files is not None else '?'} files"
+            )
+            batch.clear()
+            batch_files.clear()
+
+        for file_path, docs in file_documents:
+            batch.extend(docs)
+            batch_files.append(file_path)
+            if len(batch) >= batch_size:
+                commit()
+                if should_stop is not None and should_stop():
+                    stats["stopped"] = True
+                    logger.info(f"Indexing stopped after {stats['num_files']} files")
+                    break
+        # Empty after a stop, the stopping batch was committed
+        if batch_files:
+            commit()
+        if stats["num_batches"]:
+            self.refit_prototypes()
+        return stats
+
+    def index_incremental(self, doc_loader, manifest, batch_size=64, on_progress=None, should_stop=None):
+        """
+        Index only the files in the loader's folder that were added or changed since the
+        last run, purge the chunks of changed and deleted files, then update the manifest.
+        Files are streamed through index_stream and recorded in the manifest as soon as
+        their batch is written, so an interrupted run resumes from the last committed batch.
+
+        Args:
+            doc_loader (DocumentLoader): Loader pointing at the corpus folder
+            manifest (IndexManifest): Manifest of previously indexed files
+            batch_size (int): Number of raw documents per micro-batch
+            on_progress (Callable[[int, int], None], optional): Called with the number of files
+                indexed so far and the number to index after every batch
+            should_stop (Callable[[], bool], optional): Stops the run after the current batch,
+                the next run resumes from there
+
+        Returns:
+            dict: Number of files in each state and number of documents indexed
+        """
+        changes = manifest.diff(doc_loader.list_files())
+        logger.info(
+            f"Manifest diff: {len(changes.added)} added, {len(changes.changed)} changed, "
+            f"{len(changes.unchanged)} unchanged, {len(changes.deleted)} deleted"
+        )
+        to_load = changes.added + changes.changed
+        # Added files are purged too, in case an interrupted run left some of their chunks behind
+        num_removed = self.delete_files(manifest.spellings(to_load + changes.deleted))
+        manifest.remove(changes.deleted)
+        manifest.save()
+
+        num_done = 0
+
+        def commit(file_paths):
+            nonlocal num_done
+            for file_path in file_paths:
+                manifest.record(file_path)
+            manifest.save()
+            num_done += len(file_paths)
+            if on_progress is not None:
+                on_progress(num_done, len(to_load))
+
+        stream_stats = self.index_stream(
+            doc_loader.iter_documents(file_paths=to_load),
+            batch_size=batch_size,
+            on_commit=commit,
+            total_files=len(to_load),
+            should_stop=should_stop,
+        )
+        return {
+            "files_added": len(changes.added),
+            "files_changed": len(changes.changed),
+            "files_unchanged": len(changes.unchanged),
+            "files_deleted": len(changes.deleted),
+            "chunks_removed": num_removed,
+            "num_batches": stream_stats["num_batches"],
+            "num_docs_added": stream_stats["num_docs_added"],
+            "stopped": stream_stats["stopped"],
+        }
+
+# Loader owned by each worker process, so a heavy model is loaded at most once per worker
+_WORKER_LOADER = None
+
+def _init_worker(data_dir, extractor_kwargs):
+    global _WORKER_LOADER
+    _WORKER_LOADER = DocumentLoader(data_dir=data_dir, extractor_kwargs=extractor_kwargs)
+
+def _load_files_in_worker(file_paths):
+    # Metrics of the worker travel back with the documents
+    return _WORKER_LOADER.load_files(file_paths), get_metrics().drain()
 
 class DocumentLoader:
-    def __init__(self, data_dir="corpus/edge_ai"):
-        self.data_dir = data_dir
-        self.av_extractor = AudioVideoExtractor()
-        self.csv_extractor = CSVExtractor()
-        self.pptx_extractor = PPTXExtractor()
-        self.img_extractor = ImageExtractor()
-        self.pdf_converter = PyPDFToDocument()
-        self.text_converter = TextFileToDocument()
-
-    def load_documents(self):
-        raw_docs = []
-        for file_name in os.listdir(self.data_dir):
+    """
+    Loads every supported file in a folder into Haystack documents.
+    Extractors are only built the first time a file of their type is seen. With
+    num_workers > 1, files are grouped by extractor type and dispatched to a process
+    pool, load_documents returns results in the same order as the input files while
+    iter_documents streams them in a deterministic dispatch order.
+    """
+    def __init__(self, data_dir="corpus/edge_ai", num_workers=1, extractor_kwargs=None):
+        # Files are listed under the canonical path, the key of the manifest and of chunk meta
+        self.data_dir = canonical_path(data_dir)
+        # 0 or a negative count from the config means extracting in the main process
+        self.num_workers = max(1, int(num_workers or 1))
+        self.extractor_kwargs = extractor_kwargs or {}
+        self._extractors = {}
+
+    @classmethod
+    def from_config(cls, cfg, data_dir, cache_dir):
+        """Build a loader with extractor settings taken from the hydra config."""
+        extractor_kwargs = {
+            "av": {
+                "model_name": cfg.whisper_model,
+                "window_seconds": cfg.transcribe_window_seconds,
+                "chunk_seconds": cfg.transcribe_chunk_seconds,
+                "num_workers": cfg.transcribe_workers,
+                "cache_dir": cache_dir,
+            },
+            "pdf": {
+                "num_workers": cfg.pdf_workers,
+                "page_timeout": cfg.pdf_page_timeout,
+                "min_parallel_pages": cfg.pdf_min_parallel_pages,
+            },
+            "image": {
+                "batch_size": cfg.ocr_batch_size,
+                "min_side": cfg.ocr_min_side,
+                "min_stddev": cfg.ocr_min_stddev,
+                "cache_dir": cache_dir,
+            },
+        }
+        return cls(data_dir=data_dir, num_workers=cfg.loader_workers, extractor_kwargs=extractor_kwargs)
+
+    def _get_extractor(self, extractor_type):
+        if extractor_type not in self._extractors:
+            logger.info(f"Initialising {extractor_type} extractor")
+            kwargs = self.extractor_kwargs.get(extractor_type, {})
+            self._extractors[extractor_type] = EXTRACTOR_FACTORIES[extractor_type](**kwargs)
+        return self._extractors[extractor_type]
+
+    def _plan_tasks(self, file_paths, max_task_size=None):
+        """
+        Group files by extractor type and split each group into at most num_workers tasks,
+        each holding no more than max_task_size files.
+        """
+        groups = {}
+        for file_path in file_paths:
+            extractor_type = EXTRACTOR_TYPES[file_path.split(".")[-1].lower()]
+            groups.setdefault(extractor_type, []).append(file_path)
+        ordered_types = sorted(groups, key=lambda t: (t not in HEAVY_EXTRACTORS, -len(groups[t])))
+        tasks = []
+        for extractor_type in ordered_types:
+            group = groups[extractor_type]
+            num_tasks = min(self.num_workers, len(group))
+            size = -(-len(group) // num_tasks)
+            if max_task_size is not None:
+                size = min(size, max_task_size)
+            tasks.extend(group[i:i + size] for i in range(0, len(group), size))
+        return tasks
+
+    def list_files(self):
+        """Sorted paths of every supported file in the data directory."""
+        file_paths = []
+        for file_name in sorted(os.listdir(self.data_dir)):
             file_path = os.path.join(self.data_dir, file_name)
-            file_ext = file_name.split(".")[-1].lower()
-            if file_ext == "pdf":
-                docs = self.pdf_converter.run(sources=[file_path])["documents"]
-                for doc in docs:
-                    doc.meta["file_type"] = "pdf"
-                    doc.meta["file_path"] = file_path
-                    if "page" not in doc.meta and "page_number" in doc.meta:
-                        doc.meta["page"] = doc.meta["page_number"]
-                    raw_docs.append(doc)
-            elif file_ext == "txt":
-                docs = self.text_converter.run(sources=[file_path])["documents"]
-                for doc in docs:
-                    doc.meta["file_type"] = "txt"
-                    doc.meta["file_path"] = file_path
-                    doc.meta["page"] = 1
-                    raw_docs.append(doc)
-            elif file_ext in ["mp3", "mp4"]:
-                texts = self.av_extractor.extract(file_path)
-                for i, text in enumerate(texts):
+            if os.path.isfile(file_path) and file_name.split(".")[-1].lower() in SUPPORTED_EXTENSIONS:
+                file_paths.append(file_path)
+        return file_paths
+
+    def load_documents(self, file_paths=None):
+        """Load documents from the given files, or from every supported file in the data directory."""
+        if file_paths is None:
+            file_paths = self.list_files()
+        results = dict(self.iter_documents(file_paths=file_paths))
+        return [doc for file_path in file_paths for doc in results[file_path]]
+
+    def iter_documents(self, file_paths=None, max_task_size=8):
+        """
+        Lazily load documents file by file, yielding (file_path, documents) pairs.
+        In parallel mode at most two tasks per worker are in flight, so memory stays
+        bounded by the task size rather than the corpus size.
+        """
+        if file_paths is None:
+            file_paths = self.list_files()
+        tasks = self._plan_tasks(file_paths, max_task_size=max_task_size)
+        if self.num_workers <= 1 or len(tasks) <= 1:
+            for task in tasks:
+                yield from self.load_files(task)
+            return
+
+        tasks = iter(tasks)
+        # spawn so workers do not inherit torch/paddle thread state from the parent
+        pool = ProcessPoolExecutor(max_workers=self.num_workers,
+                                   mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_init_worker,
+                                   initargs=(self.data_dir, self.extractor_kwargs))
+        try:
+            pending = deque(pool.submit(_load_files_in_worker, task)
+                            for _, task in zip(range(self.num_workers * 2), tasks))
+            while pending:
+                results, metrics = pending.popleft().result()
+                get_metrics().merge(metrics)
+                next_task = next(tasks, None)
+                if next_task is not None:
+                    pending.append(pool.submit(_load_files_in_worker, next_task))
+                for file_path, docs in results:
+                    logger.debug(f"Loaded {len(docs)} documents from {file_path}")
+                    yield file_path, docs
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+    def load_files(self, file_paths):
+        """Load several files, returning (file_path, documents) pairs. Images are OCR'd as one batch."""
+        image_paths = [path for path in file_paths if EXTRACTOR_TYPES[path.split(".")[-1].lower()] == "image"]
+        image_texts = {}
+        if image_paths:
+            start = perf_counter()
+            image_texts = self._get_extractor("image").extract_batch(image_paths)
+            # The batch is observed as its per image average
+            seconds = (perf_counter() - start) / len(image_paths)
+            for _ in image_paths:
+                get_metrics().observe("extractor_seconds", seconds, extractor="image")
+        results = []
+        for file_path in file_paths:
+            if file_path in image_texts:
+                results.append((file_path, self._image_documents(file_path, image_texts[file_path])))
+            else:
+                results.append((file_path, self.load_file(file_path)))
+        return results
+
+    def _image_documents(self, file_path, text):
+        if not text:
+            return []
+        return [Document(content=text, meta={
+            "file_type": file_path.split(".")[-1].lower(),
+            "file_path": file_path,
+            "page": 0
+        })]
+
+    def load_file(self, file_path):
+        file_ext = file_path.split(".")[-1].lower()
+        with get_metrics().time("extractor_seconds", extractor=EXTRACTOR_TYPES[file_ext]):
+            return self._load_file(file_path, file_ext)
+
+    def _load_file(self, file_path, file_ext):
+        raw_docs = []
+        if file_ext == "pdf":
+            texts = self._get_extractor("pdf").extract(file_path)
+            for i, text in enumerate(texts):
+                if text.strip():
                     raw_docs.append(Document(content=text, meta={
-                        "file_type": file_ext,
+                        "file_type": "pdf",
                         "file_path": file_path,
-                        "page": 0
+                        "page": i+1
                     }))
-            elif file_ext in ["jpg", "png"]:
-                texts = self.img_extractor.extract(file_path=file_path)
-                raw_docs.append(Document(content=texts, meta={
+        elif file_ext == "txt":
+            docs = self._get_extractor("text").run(sources=[file_path])["documents"]
+            for doc in docs:
+                doc.meta["file_type"] = "txt"
+                doc.meta["file_path"] = file_path
+                doc.meta["page"] = 1
+                raw_docs.append(doc)
+        elif file_ext in ["mp3", "mp4"]:
+            segments = self._get_extractor("av").extract(file_path)
+            for segment in segments:
+                raw_docs.append(Document(content=segment["text"], meta={
                     "file_type": file_ext,
                     "file_path": file_path,
-                    "page": 0
+                    "page": 0,
+                    "start_time": segment["start"],
+                    "end_time": segment["end"]
+                }))
+        elif file_ext in ["jpg", "png"]:
+            text = self._get_extractor("image").extract(file_path=file_path)
+            raw_docs.extend(self._image_documents(file_path, text))
+        elif file_ext == "pptx":
+            texts = self._get_extractor("pptx").extract(file_path)
+            for i, text in enumerate(texts):
+                raw_docs.append(Document(content=text, meta={
+                    "file_type": file_ext,
+                    "file_path": file_path,
+                    "page": i+1
+                }))
+        elif file_ext == "csv":
+            texts = self._get_extractor("csv").extract(file_path)
+            for i, text in enumerate(texts):
+                raw_docs.append(Document(content=text, meta={
+                    "file_type": file_ext,
+                    "file_path": file_path,
+                    "page": i+1
                 }))
-            elif file_ext == "pptx":
-                texts = self.pptx_extractor.extract(file_path)
-                for i, text in enumerate(texts):
-                    raw_docs.append(Document(content=text, meta={
-                        "file_type": file_ext,
-                        "file_path": file_path,
-                        "page": i+1
-                    }))
-            elif file_ext == "csv":
-                texts = self.csv_extractor.extract(file_path)
-                for i, text in enumerate(texts):
-                    raw_docs.append(Document(content=text, meta={
-                        "file_type": file_ext,
-                        "file_path": file_path,
-                        "page": i+1
-                    }))
         return raw_docs
\ No newline at end of file
@@ -0,0 +1,427 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+from uuid import uuid4
+
+from src.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+# Job kinds
+DOCUMENTS = "documents"
+FOLDER = "folder"
+
+# Job statuses
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+
+@dataclass
+class IndexJob:
+    """State of one ingestion request, as reported by GET /jobs/{id}."""
+    id: str
+    kind: str
+    status: str = QUEUED
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    # Documents or files indexed so far and in total
+    progress: dict = field(default_factory=lambda: {"done": 0, "total": None})
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    # Number of other requests merged into this job
+    num_merged: int = 0
+    # Running jobs stop after their current micro-batch
+    cancel_requested: bool = False
+    fingerprint: Optional[str] = field(default=None, repr=False)
+    documents: list = field(default_factory=list, repr=False)
+
+    def to_dict(self):
+        data = asdict(self)
+        del data["fingerprint"], data["documents"]
+        return data
+
+
+def documents_fingerprint(documents):
+    """Hash of the content and meta of the documents, identical requests have the same fingerprint."""
+    digest = hashlib.sha256()
+    for doc in documents:
+        digest.update(json.dumps([doc.content, doc.meta], sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _limit_cpu(cpu_share, nice):
+    """Pin this process to a share of the available cores and lower its priority."""
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    num_cpus = max(1, int(len(cpus) * cpu_share))
+    # Read by the thread pools of torch and numpy when they are first imported
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[variable] = str(num_cpus)
+    if hasattr(os, "sched_setaffinity"):
+        # The last cores, where the lower priority keeps the worker behind the serving process
+        os.sched_setaffinity(0, cpus[-num_cpus:])
+    if nice and hasattr(os, "nice"):
+        os.nice(nice)
+    return num_cpus
+
+
+def _build_indexer(cfg, document_store, lexical_index, embedding_cache, embedder=None):
+    """Indexer, document loader and manifest of a worker, over the given store and indexes."""
+    from src.dedup import DedupIndex
+    from src.domain_gate import create_domain_prototypes
+    from src.index_pipeline import DocumentLoader, HaystackIndexer
+    from src.manifest import IndexManifest
+
+    dedup_index = None
+    if cfg.dedup_threshold > 0:
+        dedup_index = DedupIndex(os.path.join(cfg.chromedb_dir, cfg.dedup_index_file), threshold=cfg.dedup_threshold,
+                                 num_perm=cfg.dedup_num_perm, bands=cfg.dedup_bands)
+    indexer = HaystackIndexer.from_config(cfg, document_store=document_store, lexical_index=lexical_index,
+                                          embedding_cache=embedding_cache, dedup_index=dedup_index, embedder=embedder,
+                                          domain_prototypes=create_domain_prototypes(cfg, cfg.chromedb_dir))
+    indexer.backfill_lexical_index()
+    doc_loader = DocumentLoader.from_config(cfg, data_dir=cfg.corpus_dir, cache_dir=cfg.cache_dir)
+    manifest = IndexManifest(os.path.join(cfg.chromedb_dir, cfg.index_manifest))
+    return indexer, doc_loader, manifest
+
+
+def _worker_main(cfg_container, cpu_share, nice, tasks, results, cancels):
+    """
+    Indexing worker process. Runs one task at a time, a task being either a list of
+    (job_id, documents) pairs merged from several requests or one folder ingest. The
+    metrics recorded by the worker are sent to the serving process after every batch.
+    """
+    num_cpus = _limit_cpu(cpu_share, nice)
+    # Heavy imports happen after the CPU limit so the thread pools are sized by it
+    import torch
+    from omegaconf import OmegaConf
+
+    from src.bm25 import BM25Index
+    from src.cache import EmbeddingCache
+    from src.model_registry import get_model_registry
+    from src.vector_store import store_options, initialize_vector_db
+
+    torch.set_num_threads(num_cpus)
+    cfg = OmegaConf.create(cfg_container)
+    get_model_registry().configure(memory_budget_mb=cfg.model_memory_budget_mb)
+    get_metrics().configure(enabled=cfg.metrics_enabled)
+    document_store = initialize_vector_db(chroma_dir=cfg.chromedb_dir, backend=cfg.document_store,
+                                          **store_options(cfg))
+    indexer, doc_loader, manifest = _build_indexer(
+        cfg, document_store, BM25Index(os.path.join(cfg.chromedb_dir, cfg.bm25_index_file)),
+        EmbeddingCache(os.path.join(cfg.cache_dir, cfg.embedding_cache_file)))
+    logger.info(f"Indexing worker {os.getpid()} started on {num_cpus} CPUs")
+    _run_tasks(cfg, indexer, doc_loader, manifest, tasks, results, cancels)
+
+
+def _thread_worker_main(cfg, components, tasks, results, cancels):
+    """
+    Indexing worker thread of the serving process, for stores a second process may not
+    open. The indexer shares the serving process's document store, lexical index, cache
+    and embedder, its metrics are recorded in the process's own registry.
+    """
+    indexer, doc_loader, manifest = _build_indexer(cfg, **components)
+    logger.info("Indexing worker thread started in the serving process")
+    _run_tasks(cfg, indexer, doc_loader, manifest, tasks, results, cancels, send_metrics=False)
+
+
+def _run_tasks(cfg, indexer, doc_loader, manifest, tasks, results, cancels, send_metrics=True):
+    """Run the tasks of the queue until it sends None, reporting progress and outcomes on results."""
+    cancelled = set()
+
+    def poll_cancels():
+        while True:
+            try:
+                cancelled.add(cancels.get_nowait())
+            except queue.Empty:
+                return
+
+    while (task := tasks.get()) is not None:
+        kind, payload = task
+        poll_cancels()
+        try:
+            if kind == FOLDER:
+                job_id = payload
+
+                def on_progress(done, total, job_id=job_id):
+                    results.put(("progress", [job_id], done, total))
+                    if send_metrics:
+                        results.put(("metrics", get_metrics().drain()))
+
+                def should_stop(job_id=job_id):
+                    poll_cancels()
+                    return job_id in cancelled
+
+                stats = indexer.index_incremental(doc_loader=doc_loader, manifest=manifest,
+                                                  batch_size=cfg.index_batch_size,
+                                                  on_progress=on_progress, should_stop=should_stop)
+                results.put(("finished", {job_id: CANCELLED if stats["stopped"] else SUCCEEDED}, stats))
+            else:
+                job_ids = [job_id for job_id, _ in payload]
+                committed = []
+
+                def job_documents():
+                    for job_id, documents in payload:
+                        poll_cancels()
+                        if job_id not in cancelled:
+                            yield job_id, documents
+
+                def on_commit(done_ids):
+                    committed.extend(done_ids)
+                    results.put(("progress", list(done_ids), None, None))
+                    if send_metrics:
+                        results.put(("metrics", get_metrics().drain()))
+
+                def should_stop():
+                    poll_cancels()
+                    return cancelled.issuperset(job_ids)
+
+                stats = indexer.index_stream(job_documents(), batch_size=cfg.index_batch_size, on_commit=on_commit,
+                                             total_files=len(payload), should_stop=should_stop)
+                results.put(("finished", {job_id: SUCCEEDED if job_id in committed else CANCELLED
+                                          for job_id in job_ids}, stats))
+        except Exception as error:
+            logger.exception("Indexing task failed")
+            job_ids = [payload] if kind == FOLDER else [job_id for job_id, _ in payload]
+            results.put(("failed", job_ids, f"{type(error).__name__}: {error}"))
+
+
+class IndexJobQueue:
+    """
+    Queue of ingestion jobs run one task at a time by a separate worker process, which
+    is pinned to cpu_share of the cores at a lower priority so queries keep theirs.
+    The worker is started by the first job and owns the indexer, the document loader
+    and their models, the serving process never loads them.
+
+    Requests identical to a queued or running job return that job. Consecutive queued
+    document jobs are merged into one indexing run when the worker picks them up, and
+    a folder ingest requested while one is queued joins it. Queued jobs are cancelled
+    at once, running ones after their current micro-batch.
+
+    The worker writes to the document store while the serving process reads it, which
+    needs the flat store or a Chroma server. With an embedded Chroma database, which only
+    one process may open, the worker is a thread of the serving process instead. It shares
+    the store, indexes and embedder passed to share_components(), jobs queued before wait
+    for them, and it runs at the priority of the serving process.
+
+    Args:
+        cfg (DictConfig): Hydra config the worker builds its indexer from
+        cpu_share (float): Share of the cores the worker may use
+        nice (int): Niceness added to the worker's priority
+        history (int): Number of finished jobs kept for GET /jobs/{id}
+    """
+    def __init__(self, cfg, cpu_share=0.5, nice=10, history=100):
+        from omegaconf import OmegaConf
+        from src.vector_store import supports_concurrent_writers
+        self.cfg = cfg
+        self.cfg_container = OmegaConf.to_container(cfg, resolve=True)
+        self.in_process = not supports_concurrent_writers(cfg.document_store, cfg.chroma_host)
+        # Keyword arguments of _build_indexer shared with the worker thread when in_process
+        self._components = None
+        self.cpu_share = cpu_share
+        self.nice = nice
+        self.history = history
+        self.jobs = OrderedDict()
+        self._pending = deque()
+        # Ids of the jobs of the task the worker is running
+        self._running = []
+        self._lock = threading.RLock()
+        self._context = multiprocessing.get_context("spawn")
+        self._process = None
+        self._tasks = self._results = self._cancels = None
+        self._listener = None
+        self._closed = False
+
+    @property
+    def worker_alive(self):
+        return self._process is not None and self._process.is_alive()
+
+    @property
+    def queue_depth(self):
+        return len(self._pending)
+
+    def share_components(self, document_store, lexical_index, embedding_cache, embedder):
+        """Store, indexes and embedder of the serving process, used by the worker thread when in_process."""
+        with self._lock:
+            self._components = {"document_store": document_store, "lexical_index": lexical_index,
+                                "embedding_cache": embedding_cache, "embedder": embedder}
+        self._dispatch()
+
+    def _start_worker(self):
+        if self.in_process:
+            self._tasks, self._results, self._cancels = queue.Queue(), queue.Queue(), queue.Queue()
+            self._process = threading.Thread(target=_thread_worker_main, name="index-worker", daemon=True,
+                                             args=(self.cfg, self._components, self._tasks, self._results,
+                                                   self._cancels))
+        else:
+            self._start_worker_process()
+        self._process.start()
+        if self._listener is None:
+            self._listener = threading.Thread(target=self._listen, name="index-jobs", daemon=True)
+            self._listener.start()
+
+    def _start_worker_process(self):
+        self._tasks = self._context.Queue()
+        self._results = self._context.Queue()
+        self._cancels = self._context.Queue()
+        self._process = self._context.Process(target=_worker_main, name="index-worker", daemon=True,
+                                              args=(self.cfg_container, self.cpu_share, self.nice,
+                                                    self._tasks, self._results, self._cancels))
+
+    def _find(self, kind, statuses, fingerprint=None):
+        for job in self.jobs.values():
+            if job.kind == kind and job.status in statuses and job.fingerprint == fingerprint:
+                return job
+        return None
+
+    def submit_documents(self, documents):
+        """Queue documents for indexing, returns the job, an existing one for a duplicate request."""
+        fingerprint = documents_fingerprint(documents)
+        with self._lock:
+            job = self._find(DOCUMENTS, (QUEUED, RUNNING), fingerprint)
+            if job is not None:
+                job.num_merged += 1
+                return job
+            job = IndexJob(id=uuid4().hex, kind=DOCUMENTS, fingerprint=fingerprint, documents=list(documents),
+                           progress={"done": 0, "total": len(documents)})
+            return self._enqueue(job)
+
+    def submit_folder(self):
+        """Queue an incremental ingest of the corpus folder, joining a queued one if there is one."""
+        with self._lock:
+            job = self._find(FOLDER, (QUEUED,))
+            if job is not None:
+                job.num_merged += 1
+                return job
+            return self._enqueue(IndexJob(id=uuid4().hex, kind=FOLDER))
+
+    def _enqueue(self, job):
+        self.jobs[job.id] = job
+        self._pending.append(job)
+        self._dispatch()
+        return job
+
+    def _dispatch(self):
+        """Send the next task to the worker when it is idle."""
+        with self._lock:
+            if self._running or not self._pending or self._closed:
+                return
+            if self.in_process and self._components is None:
+                # Dispatched by share_components() once the serving process has opened the store
+                return
+            if not self.worker_alive:
+                self._start_worker()
+            if self._pending[0].kind == FOLDER:
+                batch = [self._pending.popleft()]
+                task = (FOLDER, batch[0].id)
+            else:
+                batch = []
+                while self._pending and self._pending[0].kind == DOCUMENTS:
+                    batch.append(self._pending.popleft())
+                task = (DOCUMENTS, [(job.id, job.documents) for job in batch])
+            now = time.time()
+            for job in batch:
+                job.status = RUNNING
+                job.started_at = now
+            self._running = [job.id for job in batch]
+            self._tasks.put(task)
+            if len(batch) > 1:
+                logger.info(f"Merged {len(batch)} queued document jobs into one indexing run")
+
+    def _finish(self, job_id, status, result=None, error=None):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return
+        job.status = status
+        job.finished_at = time.time()
+        job.result = result
+        job.error = error
+        # Documents are only needed until they are indexed
+        job.documents = []
+
+    def _listen(self):
+        while not self._closed:
+            try:
+                message = self._results.get(timeout=1.0)
+            except queue.Empty:
+                with self._lock:
+                    if self._running and not self.worker_alive:
+                        for job_id in self._running:
+                            self._finish(job_id, FAILED, error="Indexing worker exited")
+                        self._running = []
+                        self._dispatch()
+                continue
+            if message[0] == "metrics":
+                get_metrics().merge(message[1])
+                continue
+            with self._lock:
+                if message[0] == "progress":
+                    _, job_ids, done, total = message
+                    for job_id in job_ids:
+                        job = self.jobs[job_id]
+                        job.progress = {"done": done, "total": total} if done is not None \
+                            else {"done": job.progress["total"], "total": job.progress["total"]}
+                    continue
+                if message[0] == "finished":
+                    _, statuses, stats = message
+                    for job_id, status in statuses.items():
+                        self._finish(job_id, status, result=stats)
+                else:
+                    _, job_ids, error = message
+                    for job_id in job_ids:
+                        self._finish(job_id, FAILED, error=error)
+                self._running = []
+                self._prune()
+                self._dispatch()
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in FINISHED]
+        for job_id in finished[:max(len(finished) - self.history, 0)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return job.to_dict() if job is not None else None
+
+    def cancel(self, job_id):
+        """Cancel the job, returns its state or None when it is unknown."""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if job.status == QUEUED:
+                self._pending.remove(job)
+                self._finish(job_id, CANCELLED)
+            elif job.status == RUNNING and not job.cancel_requested:
+                job.cancel_requested = True
+                self._cancels.put(job_id)
+            return job.to_dict()
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return {"queue_depth": self.queue_depth, "running": list(self._running),
+                    "worker_alive": self.worker_alive, "jobs": counts, "in_process": self.in_process}
+
+    def close(self):
+        self._closed = True
+        if self.worker_alive:
+            self._tasks.put(None)
+            self._process.join(timeout=5)
+            if self._process.is_alive() and not self.in_process:
+                self._process.terminate()
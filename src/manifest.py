@@ -0,0 +1,102 @@
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+
+from src.utils import hash_file
+
+logger = logging.getLogger(__name__)
+
+
+def canonical_path(path, root_dir=None):
+    """
+    Key of a file in the manifest and in chunk meta, the resolved absolute path, so the
+    CLI and the API agree whichever working directory or relative corpus_dir they use.
+    Relative paths are taken from root_dir, the working directory by default.
+    """
+    return os.path.realpath(os.path.join(root_dir or os.getcwd(), path))
+
+
+@dataclass
+class ManifestDiff:
+    """Result of comparing the files on disk against the manifest."""
+    added: list = field(default_factory=list)
+    changed: list = field(default_factory=list)
+    unchanged: list = field(default_factory=list)
+    deleted: list = field(default_factory=list)
+
+
+class IndexManifest:
+    """
+    Persistent record of every file that has been indexed, keyed by canonical path.
+    Each entry keeps the size, mtime and sha256 of the file at the time it was indexed
+    so that re-indexing only has to touch files that were added, changed or deleted.
+    The content hash is only computed when size or mtime differ, so an unchanged
+    corpus is checked with a single stat call per file.
+
+    Manifests written before keys were canonical are migrated on load, their relative
+    paths being relative to root_dir, the project folder the config paths start from.
+    """
+    def __init__(self, manifest_path, root_dir=None):
+        self.manifest_path = manifest_path
+        self.root_dir = root_dir or os.getcwd()
+        self.entries = {}
+        self._pending_hashes = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                # Older manifests kept paths as given, relative or absolute
+                self.entries = {self.canonical(path): entry for path, entry in json.load(f).items()}
+
+    def canonical(self, file_path):
+        return canonical_path(file_path, self.root_dir)
+
+    def spellings(self, file_paths):
+        """Canonical paths along with the relative spelling chunks of older runs may carry in meta."""
+        canonical = [self.canonical(file_path) for file_path in file_paths]
+        return canonical + [os.path.relpath(file_path, self.root_dir) for file_path in canonical]
+
+    def diff(self, file_paths):
+        changes = ManifestDiff()
+        file_paths = [self.canonical(file_path) for file_path in file_paths]
+        for file_path in file_paths:
+            entry = self.entries.get(file_path)
+            if entry is None:
+                changes.added.append(file_path)
+                continue
+            stat = os.stat(file_path)
+            if stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime_ns"]:
+                changes.unchanged.append(file_path)
+                continue
+            sha256 = hash_file(file_path)
+            self._pending_hashes[file_path] = sha256
+            if sha256 == entry["sha256"]:
+                # Touched but not modified, refresh the stat so it is not hashed again
+                self.record(file_path)
+                changes.unchanged.append(file_path)
+            else:
+                changes.changed.append(file_path)
+        seen = set(file_paths)
+        changes.deleted = [path for path in self.entries if path not in seen]
+        return changes
+
+    def record(self, file_path):
+        file_path = self.canonical(file_path)
+        stat = os.stat(file_path)
+        sha256 = self._pending_hashes.pop(file_path, None) or hash_file(file_path)
+        self.entries[file_path] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": sha256,
+        }
+
+    def remove(self, file_paths):
+        for file_path in file_paths:
+            self.entries.pop(self.canonical(file_path), None)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.manifest_path) or ".", exist_ok=True)
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+        logger.debug(f"Saved index manifest with {len(self.entries)} files to {self.manifest_path}")
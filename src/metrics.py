@@ -0,0 +1,229 @@
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the latency histogram buckets, from a cached lookup to a long generation
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Upper bounds of token count histograms
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+# Upper bounds of generation throughput histograms, in tokens per second
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Help text and buckets of the recorded metrics, by name
+HISTOGRAMS = {
+    "rag_stage_seconds": ("Wall time of a stage of the query path", LATENCY_BUCKETS),
+    "api_request_seconds": ("Wall time of an API request until its whole response body is sent", LATENCY_BUCKETS),
+    "generator_prompt_tokens": ("Prompt tokens of a generated prompt", TOKEN_BUCKETS),
+    "generator_output_tokens": ("Output tokens of a generated prompt", TOKEN_BUCKETS),
+    "generator_tokens_per_second": ("Output tokens per second of a generate call", RATE_BUCKETS),
+    "generator_ttft_seconds": ("Time to the first new token of a generate call", LATENCY_BUCKETS),
+    "indexer_run_seconds": ("Wall time of an indexing pipeline run", LATENCY_BUCKETS),
+    "extractor_seconds": ("Wall time of extracting the text of one file", LATENCY_BUCKETS),
+}
+COUNTERS = {
+    "rag_answers_total": "Answered queries by where the answer came from",
+    "indexer_documents_total": "Raw documents run through the indexing pipeline",
+    "indexer_chunks_total": "Chunks written by the indexing pipeline",
+}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic count per label set."""
+    type = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+    def drain(self):
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    def merge(self, values):
+        with self._lock:
+            for key, value in values.items():
+                self._values[key] = self._values.get(key, 0) + value
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of observations per label set."""
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # label set -> [per bucket counts including +Inf, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        samples = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", key + (("le", _format_value(float(bound))),), cumulative))
+            samples.append((f"{self.name}_sum", key, total))
+            samples.append((f"{self.name}_count", key, cumulative))
+        return samples
+
+    def drain(self):
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    def merge(self, values):
+        with self._lock:
+            for key, (counts, total) in values.items():
+                entry = self._values.get(key)
+                if entry is None:
+                    entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+
+
+class MetricsRegistry:
+    """
+    Prometheus metrics of the process, rendered in the text exposition format by render().
+    Counters and histograms are recorded on the hot path, which only takes a lock and
+    bumps a number, nothing is recorded when disabled. Gauges such as cache hit rates
+    and queue depths are read from the components' own stats by collectors when the
+    metrics are scraped.
+
+    Worker processes drain() their counts and histograms and send them to the serving
+    process, which merge()s them, so every metric is exposed by a single endpoint.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._metrics = {}
+        self._collectors = {}
+        self._lock = threading.Lock()
+
+    def configure(self, enabled=True):
+        self.enabled = enabled
+
+    def _get(self, cls, name, help, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, **kwargs)
+            return metric
+
+    def counter(self, name):
+        return self._get(Counter, name, COUNTERS[name])
+
+    def histogram(self, name):
+        help, buckets = HISTOGRAMS[name]
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def inc(self, name, value=1, **labels):
+        if self.enabled:
+            self.counter(name).inc(value, **labels)
+
+    def observe(self, name, value, **labels):
+        if self.enabled:
+            self.histogram(name).observe(value, **labels)
+
+    @contextmanager
+    def time(self, name, **labels):
+        """Observe the wall time of the block in seconds, also when it raises."""
+        if not self.enabled:
+            yield
+            return
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.histogram(name).observe(perf_counter() - start, **labels)
+
+    def register_collector(self, name, collect):
+        """
+        collect() returns (metric name, type, help, [(labels dict, value)]) tuples read at
+        scrape time. Registering a name again replaces its collector.
+        """
+        with self._lock:
+            self._collectors[name] = collect
+
+    def drain(self):
+        """Counts and histograms recorded since the last drain, for merge() in another process."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return [(metric.type, metric.name, metric.drain()) for metric in metrics]
+
+    def merge(self, drained):
+        for kind, name, values in drained:
+            if values:
+                (self.counter(name) if kind == "counter" else self.histogram(name)).merge(values)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format, version 0.0.4."""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+            collectors = list(self._collectors.values())
+        families = [(metric.name, metric.type, metric.help, metric.samples()) for metric in metrics]
+        for collect in collectors:
+            try:
+                for name, kind, help, values in collect():
+                    families.append((name, kind, help,
+                                     [(name, tuple(sorted(labels.items())), value) for labels, value in values]))
+            except Exception:
+                logger.exception("Metrics collector failed")
+        lines = []
+        for name, kind, help, samples in families:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(f"{sample}{_format_labels(labels)} {_format_value(value)}" for sample, labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+
+_METRICS = MetricsRegistry()
+
+
+def get_metrics():
+    """The registry every metric of this process is recorded in."""
+    return _METRICS
@@ -0,0 +1,213 @@
+import gc
+import logging
+import os
+import sys
+import threading
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from time import monotonic, perf_counter
+
+logger = logging.getLogger(__name__)
+
+
+def _rss_bytes():
+    """Resident set size of this process, None where /proc is not available."""
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _parameter_bytes(model):
+    """
+    Size of the parameters and buffers of the torch modules found on the model, 0 when
+    there are none. Dynamically quantised linear layers keep their int8 weights in packed
+    params rather than parameters, they count one byte per weight and a float32 bias.
+    """
+    for candidate in (model, getattr(model, "model", None), getattr(getattr(model, "pipeline", None), "model", None)):
+        if hasattr(candidate, "parameters") and hasattr(candidate, "buffers"):
+            tensors = [*candidate.parameters(), *candidate.buffers()]
+            packed = sum(module.in_features * module.out_features + 4 * module.out_features
+                         for module in candidate.modules()
+                         if hasattr(module, "_packed_params") and hasattr(module, "in_features"))
+            return sum(tensor.numel() * tensor.element_size() for tensor in tensors) + packed
+    return 0
+
+
+class _Entry:
+    def __init__(self, model, resident_bytes):
+        self.model = model
+        self.resident_bytes = resident_bytes
+        self.refs = 0
+        self.last_used = monotonic()
+        self.on_unload = []
+
+
+class ModelRegistry:
+    """
+    Process wide registry of loaded models, shared by (name, device, dtype).
+    Models are borrowed with use(), which loads them on first use and marks them busy
+    until the block exits, owners never keep a reference of their own. The resident
+    memory of every model is the size of its torch parameters and buffers, or the growth
+    of the process RSS while it loaded for models without torch modules. When the total
+    exceeds memory_budget_mb, idle models are unloaded least recently used first and are
+    loaded again by their next use. Before a model is loaded again, idle models are
+    unloaded to make room for the size it had at its previous load, so the process does
+    not peak above the budget while both are resident.
+
+    Args:
+        memory_budget_mb (float): RAM budget of the loaded models, 0 disables eviction
+    """
+    def __init__(self, memory_budget_mb=0):
+        self.memory_budget = memory_budget_mb * 2 ** 20
+        # key -> _Entry, least recently used first
+        self._models = OrderedDict()
+        # key -> resident bytes of the last load, the room made before loading it again
+        self._sizes = {}
+        self._counters = defaultdict(lambda: {"loads": 0, "unloads": 0, "load_seconds": 0.0, "unload_seconds": 0.0})
+        self._lock = threading.Lock()
+        # Loads run one at a time so room is made for one model at a time and the RSS
+        # growth of models without torch modules is attributed to the right one
+        self._load_lock = threading.Lock()
+
+    def configure(self, memory_budget_mb=0):
+        with self._lock:
+            self.memory_budget = memory_budget_mb * 2 ** 20
+        self._evict()
+
+    @staticmethod
+    def _name(key):
+        name, device, dtype = key
+        return f"{name} ({device}, {dtype})"
+
+    @property
+    def resident_bytes(self):
+        return sum(entry.resident_bytes for entry in self._models.values())
+
+    def is_loaded(self, name, device="cpu", dtype="float32"):
+        return (name, str(device), str(dtype)) in self._models
+
+    @contextmanager
+    def use(self, name, loader, device="cpu", dtype="float32", on_unload=None):
+        """
+        Borrow the model, calling loader() to load it if needed. on_unload is called
+        without arguments when the model is unloaded, for owners with state derived from it.
+        """
+        key = (name, str(device), str(dtype))
+        entry = self._acquire(key, loader)
+        if on_unload is not None and on_unload not in entry.on_unload:
+            entry.on_unload.append(on_unload)
+        try:
+            yield entry.model
+        finally:
+            with self._lock:
+                entry.refs -= 1
+                entry.last_used = monotonic()
+            self._evict()
+
+    def _acquire(self, key, loader):
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is not None:
+                entry.refs += 1
+                self._models.move_to_end(key)
+                return entry
+        with self._load_lock:
+            with self._lock:
+                entry = self._models.get(key)
+                if entry is not None:
+                    entry.refs += 1
+                    self._models.move_to_end(key)
+                    return entry
+            self._evict(reserve=self._sizes.get(key, 0))
+            rss_before = _rss_bytes()
+            start = perf_counter()
+            model = loader()
+            seconds = perf_counter() - start
+            rss_after = _rss_bytes()
+            resident_bytes = _parameter_bytes(model)
+            if not resident_bytes and rss_before is not None and rss_after is not None:
+                resident_bytes = max(rss_after - rss_before, 0)
+            with self._lock:
+                entry = _Entry(model, resident_bytes)
+                entry.refs = 1
+                self._models[key] = entry
+                self._sizes[key] = resident_bytes
+                counters = self._counters[self._name(key)]
+                counters["loads"] += 1
+                counters["load_seconds"] += seconds
+        logger.info(f"Loaded {self._name(key)} in {seconds:.1f}s, {resident_bytes / 2 ** 20:.0f} MB resident")
+        return entry
+
+    def _evict(self, reserve=0):
+        """
+        Unload idle models, least recently used first, until the loaded models fit the
+        budget with reserve bytes left for a model about to be loaded.
+        """
+        while True:
+            with self._lock:
+                if not self.memory_budget or self.resident_bytes + reserve <= self.memory_budget:
+                    return
+                idle = [key for key, entry in self._models.items() if entry.refs == 0]
+                if not idle:
+                    logger.warning(f"Loaded models use {self.resident_bytes / 2 ** 20:.0f} MB, "
+                                   f"{reserve / 2 ** 20:.0f} MB more are needed for a load, over the budget of "
+                                   f"{self.memory_budget / 2 ** 20:.0f} MB, but every model is in use")
+                    return
+                key = idle[0]
+                entry = self._models.pop(key)
+            self._unload(key, entry)
+
+    def unload(self, name, device="cpu", dtype="float32"):
+        """Unload the model if it is loaded and idle, returns whether it was unloaded."""
+        key = (name, str(device), str(dtype))
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is None or entry.refs:
+                return False
+            del self._models[key]
+        self._unload(key, entry)
+        return True
+
+    def _unload(self, key, entry):
+        start = perf_counter()
+        for callback in entry.on_unload:
+            callback()
+        resident_bytes = entry.resident_bytes
+        entry.model = None
+        gc.collect()
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        seconds = perf_counter() - start
+        with self._lock:
+            counters = self._counters[self._name(key)]
+            counters["unloads"] += 1
+            counters["unload_seconds"] += seconds
+        logger.info(f"Unloaded {self._name(key)}, freeing about {resident_bytes / 2 ** 20:.0f} MB")
+
+    def stats(self):
+        with self._lock:
+            now = monotonic()
+            return {
+                "memory_budget_mb": self.memory_budget / 2 ** 20,
+                "resident_mb": self.resident_bytes / 2 ** 20,
+                "loaded": {
+                    self._name(key): {
+                        "resident_mb": entry.resident_bytes / 2 ** 20,
+                        "in_use": entry.refs,
+                        "idle_seconds": 0.0 if entry.refs else now - entry.last_used,
+                    }
+                    for key, entry in self._models.items()
+                },
+                "counters": {name: dict(counters) for name, counters in self._counters.items()},
+            }
+
+
+_REGISTRY = ModelRegistry()
+
+
+def get_model_registry():
+    """The registry every model of this process is loaded through."""
+    return _REGISTRY
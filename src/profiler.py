@@ -0,0 +1,95 @@
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from time import perf_counter
+
+logger = logging.getLogger(__name__)
+
+
+class SlowRequestProfiler:
+    """
+    Sampling profiler dumping flamegraphs of slow requests. While at least one profiled
+    request is running, a background thread samples the stack of every other thread of
+    the process each interval_ms, so work handed to thread pools and the generation
+    worker is captured too. A request taking at least slow_ms has the stacks sampled
+    during it written to output_dir in the folded format read by flamegraph.pl and
+    speedscope, one "thread;frame;frame count" line per distinct stack. Faster requests
+    are discarded, and nothing is sampled between requests.
+
+    Args:
+        slow_ms (float): Minimum duration of a request whose profile is written
+        interval_ms (float): Time between two samples
+        output_dir (str): Folder of the .folded files
+    """
+    def __init__(self, slow_ms=2000, interval_ms=10, output_dir="logs/profiles"):
+        self.slow = slow_ms / 1000
+        self.interval = interval_ms / 1000
+        self.output_dir = output_dir
+        self.num_dumped = 0
+        # id -> Counter of folded stacks of the requests being profiled
+        self._active = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._sampler = None
+
+    def _ensure_sampler(self):
+        if self._sampler is None or not self._sampler.is_alive():
+            self._sampler = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+            self._sampler.start()
+
+    def _sample_loop(self):
+        own_id = threading.get_ident()
+        while True:
+            self._wake.wait()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                frames.append(names.get(thread_id, str(thread_id)))
+                stacks.append(";".join(reversed(frames)))
+            with self._lock:
+                for samples in self._active.values():
+                    samples.update(stacks)
+                if not self._active:
+                    self._wake.clear()
+            time.sleep(self.interval)
+
+    @contextmanager
+    def profile(self, name):
+        """Sample the process while the block runs, writing the profile when it took at least slow_ms."""
+        samples = Counter()
+        key = object()
+        with self._lock:
+            self._active[key] = samples
+            self._ensure_sampler()
+            self._wake.set()
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - start
+            with self._lock:
+                del self._active[key]
+            if seconds >= self.slow and samples:
+                self._dump(name, seconds, samples)
+
+    def _dump(self, name, seconds, samples):
+        os.makedirs(self.output_dir, exist_ok=True)
+        slug = re.sub(r"[^A-Za-z0-9]+", "_", name).strip("_") or "request"
+        path = os.path.join(self.output_dir, f"{time.strftime('%Y%m%d-%H%M%S')}_{slug}_{seconds * 1000:.0f}ms.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+        self.num_dumped += 1
+        logger.info(f"{name} took {seconds * 1000:.0f} ms, wrote {sum(samples.values())} stack samples to {path}")
@@ -1,12 +1,21 @@
 import os
 import logging
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
 from haystack import Pipeline
-from haystack_integrations.components.retrievers.chroma import ChromaEmbeddingRetriever
 from haystack.components.builders import PromptBuilder
 from haystack.components.embedders import SentenceTransformersTextEmbedder
 from haystack.utils import ComponentDevice
-from src.generator import create_generator
+from src.generator import create_generator, generate_batch, generator_options
 from src.retriever import Retreiver
+from src.cache import SemanticAnswerCache
+from src.context import ContextBudgeter
+from src.domain_gate import REFUSAL
+from src.metrics import get_metrics
+from src.vector_store import get_index_version
 from uuid import uuid4
 import nltk
 from rouge_score import rouge_scorer
@@ -21,6 +30,24 @@ try:
 except LookupError:
     nltk.download('punkt')
 
+# Scorer of the current process, built once per evaluation worker
+_ROUGE_SCORER = None
+
+def score_response(pair):
+    """Compute ROUGE-1/2/L F1 and BLEU of a (response, ground_truth) pair."""
+    global _ROUGE_SCORER
+    if _ROUGE_SCORER is None:
+        _ROUGE_SCORER = rouge_scorer.RougeScorer(['rouge1', 'rouge2', 'rougeL'], use_stemmer=True)
+    response, ground_truth = pair
+    rouge_scores = _ROUGE_SCORER.score(ground_truth, response)
+    # Tokenize reference and candidate, BLEU expects reference as list of lists
+    reference_tokens = nltk.word_tokenize(ground_truth.lower())
+    candidate_tokens = nltk.word_tokenize(response.lower())
+    bleu_score = sentence_bleu([reference_tokens], candidate_tokens,
+                               smoothing_function=SmoothingFunction().method1)
+    return (rouge_scores['rouge1'].fmeasure, rouge_scores['rouge2'].fmeasure,
+            rouge_scores['rougeL'].fmeasure, bleu_score)
+
 class HaystackRAG():
     DEFAULT_PROMPT_TEMPLATE = """
         Using the information contained in the context, give a short and concise answer to the question.
@@ -29,42 +56,199 @@ class HaystackRAG():
         
         Context:
         {% for doc in documents %}
-        {{ doc.content }} URL:{{ doc.meta['url'] }}\n
+        {{ doc.content }}\n
         {% endfor %};
         Question: {{query}}
         Answer:
         """
-    def __init__(self, document_store, prompt_template=None):
-        self.retreiver = Retreiver(document_store=document_store)
+    def __init__(self, document_store, prompt_template=None, retriever=None, answer_cache=None,
+                 context_max_tokens=1024, context_dedup_similarity=0.8, generator=None, domain_gate=None):
+        if retriever is None:
+            retriever = Retreiver(document_store=document_store)
+        self.retreiver = retriever
+        # Optional SemanticAnswerCache, skips generation for paraphrases of answered questions
+        self.answer_cache = answer_cache
+        # Optional DomainGate, off-topic queries get the refusal without retrieval or generation
+        self.domain_gate = domain_gate
+        self.index_version = get_index_version(document_store)
         if prompt_template is None:
             prompt_template = self.DEFAULT_PROMPT_TEMPLATE
         prompt_builder = PromptBuilder(template=prompt_template)
-        generator = create_generator()
+        if generator is None:
+            generator = create_generator()
+        # Prefill of the template's constant instructions is computed once and reused by every query
+        generator.register_template(prompt_template)
+        self.prompt_builder = prompt_builder
+        self.generator = generator
+        # Cuts redundant sentences and caps the context at a token budget of the generator's tokenizer
+        self.context_budgeter = ContextBudgeter(tokenizer=generator.tokenizer,
+                                                max_tokens=context_max_tokens,
+                                                dedup_similarity=context_dedup_similarity)
+        # Serialises access to the model between streaming and batched generation
+        self._generation_lock = threading.Lock()
         
         self.rag = Pipeline()
+        self.rag.add_component("context_budgeter", self.context_budgeter)
         self.rag.add_component("prompt_builder", prompt_builder)
         self.rag.add_component("llm", generator)
+        self.rag.connect("context_budgeter.documents", "prompt_builder.documents")
         self.rag.connect("prompt_builder.prompt", "llm.prompt")
     
-    def get_generative_answer(self, query):
-        documents  = self.retreiver.get_documents(query=query)
-        results = self.rag.run({
-            "prompt_builder": {"documents": documents, "query": query}
-            }
-        )
+    @classmethod
+    def from_config(cls, cfg, document_store, lexical_index=None, embedding_cache=None, embedder=None,
+                    domain_gate=None):
+        answer_cache = None
+        if cfg.answer_cache_size > 0:
+            answer_cache = SemanticAnswerCache(maxsize=cfg.answer_cache_size,
+                                               similarity_threshold=cfg.answer_cache_similarity,
+                                               min_context_overlap=cfg.answer_cache_min_overlap)
+        return cls(document_store=document_store,
+                   retriever=Retreiver.from_config(cfg, document_store=document_store,
+                                                   lexical_index=lexical_index,
+                                                   embedding_cache=embedding_cache,
+                                                   embedder=embedder),
+                   answer_cache=answer_cache,
+                   context_max_tokens=cfg.context_max_tokens,
+                   context_dedup_similarity=cfg.context_dedup_similarity,
+                   generator=create_generator(**generator_options(cfg)),
+                   domain_gate=domain_gate)
+
+    def warm_up(self):
+        """Load the query embedding model, the generator is loaded when the pipeline is built."""
+        self.retreiver.warm_up()
+
+    def in_domain(self, query_embeddings, dense=None):
+        """
+        Whether the domain gate accepts every query embedding, all are accepted without a gate.
+        dense are the dense search results of the embeddings, the gate scores the top one of
+        each, they are searched here when the gate needs them and they are not given.
+        """
+        if self.domain_gate is None:
+            return [True] * len(query_embeddings)
+        with get_metrics().time("rag_stage_seconds", stage="domain_gate"):
+            top_similarities = None
+            if self.domain_gate.retrieval_weight > 0:
+                if dense is None:
+                    top_similarities = self.retreiver.top_similarities(query_embeddings)
+                else:
+                    top_similarities = [self.retreiver.top_similarity(documents) for documents in dense]
+            return self.domain_gate.accepts(query_embeddings, top_similarities)
+
+    def _retrieve(self, query):
+        """
+        Retrieve documents for the query, returns the cached answer as well if there is one.
+        Queries refused by the domain gate get the refusal as cached answer and no documents.
+        """
+        query_embedding = None
+        dense = None
+        if self.domain_gate is not None:
+            query_embedding = self.retreiver.embed_query(query)
+            if self.domain_gate.retrieval_weight > 0:
+                # One dense search scores the gate and is reused by retrieval
+                dense = self.retreiver.search(query_embedding)
+            if not self.in_domain([query_embedding], None if dense is None else [dense])[0]:
+                get_metrics().inc("rag_answers_total", source="refused")
+                return query_embedding, [], REFUSAL
+        query_embedding, documents = self.retreiver.retrieve(query, query_embedding, dense)
+        cached_answer = None
+        # The lexical fast path skips the encoder, there is no embedding to look up then
+        if self.answer_cache is not None and query_embedding is not None:
+            self.answer_cache.check_version(self.index_version.value)
+            cached_answer = self.answer_cache.lookup(query_embedding, [doc.id for doc in documents])
+        get_metrics().inc("rag_answers_total", source="generated" if cached_answer is None else "answer_cache")
+        return query_embedding, documents, cached_answer
+
+    def cache_answer(self, query_embedding, documents, answer):
+        if self.answer_cache is not None and query_embedding is not None:
+            self.answer_cache.add(query_embedding, [doc.id for doc in documents], answer)
+
+    def _answer(self, query):
+        """Retrieve documents for the query and answer it, from the answer cache when possible."""
+        with get_metrics().time("rag_stage_seconds", stage="answer"):
+            query_embedding, documents, answer = self._retrieve(query)
+            if answer is not None:
+                return answer, documents
+
+            with self._generation_lock:
+                results = self.rag.run({
+                    "context_budgeter": {"documents": documents},
+                    "prompt_builder": {"query": query}
+                    }
+                )
+            answer = results["llm"]["replies"][0]
+            self.cache_answer(query_embedding, documents, answer)
+            return answer, documents
+
+    def prepare(self, query):
+        """
+        Retrieve documents and render the prompt without generating, for callers that batch
+        generation themselves. Returns (query_embedding, documents, prompt, cached_answer).
+        """
+        query_embedding, documents, cached_answer = self._retrieve(query)
+        prompt = None
+        if cached_answer is None:
+            prompt = self.build_prompt(query, documents)
+        return query_embedding, documents, prompt, cached_answer
+
+    def build_prompt(self, query, documents):
+        """Render the prompt from the budgeted context, the same way the rag pipeline does."""
+        documents = self.context_budgeter.run(documents=documents)["documents"]
+        return self.prompt_builder.run(documents=documents, query=query)["prompt"]
+
+    def generate_batch(self, prompts):
+        with self._generation_lock:
+            return generate_batch(self.generator, prompts)
+
+    def stream_generative_answer(self, query):
+        """
+        Generator of (event, data) pairs for streaming an answer. A "sources" event with the
+        retrieved documents' metadata comes first, then one "token" event per generated chunk
+        and finally a "done" event with the full answer.
+        """
+        query_embedding, documents, answer = self._retrieve(query)
+        yield "sources", [
+            {"file_path": doc.meta.get("file_path"), "page": doc.meta.get("page"), "score": float(doc.score) if doc.score is not None else None}
+            for doc in documents
+        ]
+        if answer is not None:
+            yield "token", answer
+            yield "done", answer
+            return
+
+        tokens = queue.Queue()
+        result = {}
+
+        def generate():
+            try:
+                with self._generation_lock:
+                    results = self.rag.run({
+                        "context_budgeter": {"documents": documents},
+                        "prompt_builder": {"query": query},
+                        "llm": {"streaming_callback": lambda chunk: tokens.put(chunk.content)}
+                        }
+                    )
+                result["answer"] = results["llm"]["replies"][0]
+            except Exception as error:
+                result["error"] = error
+            finally:
+                tokens.put(None)
 
-        answer = results["llm"]["replies"][0]
+        threading.Thread(target=generate, daemon=True).start()
+        while (token := tokens.get()) is not None:
+            if token:
+                yield "token", token
+        if "error" in result:
+            raise result["error"]
+        self.cache_answer(query_embedding, documents, result["answer"])
+        yield "done", result["answer"]
+
+    def get_generative_answer(self, query):
+        answer, _ = self._answer(query)
         return answer
     
     def get_generative_answer_with_context(self, query):
         """Enhanced method that returns both answer and retrieved context"""
-        retrieved_docs  = self.retreiver.get_documents(query=query)
-        results = self.rag.run({
-            "prompt_builder": {"documents": retrieved_docs, "query": query}
-            }
-        )
-        
-        answer = results["llm"]["replies"][0]
+        answer, retrieved_docs = self._answer(query)
         contexts = [doc.content for doc in retrieved_docs]
         
         return {
@@ -73,62 +257,108 @@ class HaystackRAG():
             "source_documents": retrieved_docs
         }
     
-    def evaluate_rag(self, responses, ground_truths=None):
+    def get_generative_answers_batch(self, queries, batch_size=8, timings=None):
+        """
+        Answer many queries at once: one batched embedding pass, one multi-query retrieval
+        and generation in batches of batch_size. The answer cache is bypassed so every
+        query is generated, except the ones refused by the domain gate.
+
+        Args:
+            queries: List of questions
+            batch_size: Number of prompts per generation batch
+            timings: Optional dict, wall time in seconds of every stage is added to it
+
+        Returns:
+            List of dicts with answer, contexts and source_documents, in query order
+        """
+        timings = timings if timings is not None else {}
+        start = perf_counter()
+        query_embeddings = self.retreiver.embed_queries(queries)
+        timings["embedding"] = perf_counter() - start
+
+        start = perf_counter()
+        dense = None
+        if self.domain_gate is not None and self.domain_gate.retrieval_weight > 0:
+            # One dense search scores the gate and is reused by retrieval
+            dense = self.retreiver.dense_search_batch(query_embeddings)
+        accepted = [i for i, ok in enumerate(self.in_domain(query_embeddings, dense)) if ok]
+        timings["domain_gate"] = perf_counter() - start
+        metrics = get_metrics()
+        metrics.inc("rag_answers_total", len(queries) - len(accepted), source="refused")
+        metrics.inc("rag_answers_total", len(accepted), source="generated")
+
+        start = perf_counter()
+        retrieved = [[] for _ in queries]
+        if accepted:
+            found = self.retreiver.search_batch([query_embeddings[i] for i in accepted],
+                                                queries=[queries[i] for i in accepted],
+                                                dense=None if dense is None else [dense[i] for i in accepted])
+            for i, documents in zip(accepted, found):
+                retrieved[i] = documents
+        timings["retrieval"] = perf_counter() - start
+
+        start = perf_counter()
+        prompts = [self.build_prompt(queries[i], retrieved[i]) for i in accepted]
+        timings["prompt_building"] = perf_counter() - start
+
+        start = perf_counter()
+        answers = [REFUSAL] * len(queries)
+        generated = []
+        for i in range(0, len(prompts), batch_size):
+            generated.extend(self.generate_batch(prompts[i:i + batch_size]))
+            logging.info(f"Generated {len(generated)}/{len(prompts)} answers")
+        for i, answer in zip(accepted, generated):
+            answers[i] = answer
+        timings["generation"] = perf_counter() - start
+
+        return [
+            {"answer": answer, "contexts": [doc.content for doc in documents], "source_documents": documents}
+            for answer, documents in zip(answers, retrieved)
+        ]
+
+    def cache_stats(self):
+        stats = self.retreiver.cache_stats()
+        if self.answer_cache is not None:
+            stats["answers"] = self.answer_cache.stats()
+        if self.domain_gate is not None:
+            stats["domain_gate"] = self.domain_gate.stats()
+        stats["context_budget"] = self.context_budgeter.stats()
+        stats["generator"] = self.generator.stats()
+        return stats
+
+    def evaluate_rag(self, responses, ground_truths=None, num_workers=1):
         """
         Calculate ROUGE and BLEU scores for RAG evaluation
         
         Args:
             responses: List of generated responses
             ground_truths: List of reference answers
+            num_workers: Number of processes scoring the pairs, 1 scores in this process
         
         Returns:
             Dictionary with average ROUGE and BLEU scores
         """
-        # Initialize ROUGE scorer
-        rouge_scorer_obj = rouge_scorer.RougeScorer(['rouge1', 'rouge2', 'rougeL'], use_stemmer=True)
+        logging.info("=== ROUGE and BLEU Evaluation ===")
+        logging.info(f"Evaluating {len(responses)} response pairs...")
         
-        # Initialize smoothing function for BLEU
-        smoothing = SmoothingFunction().method1
+        pairs = list(zip(responses, ground_truths))
+        if num_workers > 1 and len(pairs) > 1:
+            with ProcessPoolExecutor(max_workers=num_workers,
+                                     mp_context=multiprocessing.get_context("spawn")) as pool:
+                scores = list(pool.map(score_response, pairs, chunksize=max(len(pairs) // (num_workers * 4), 1)))
+        else:
+            scores = [score_response(pair) for pair in pairs]
         
         # Storage for scores
-        rouge1_scores = []
-        rouge2_scores = []
-        rougeL_scores = []
-        bleu_scores = []
-        
-        logging.info("=== ROUGE and BLEU Evaluation ===")
-        logging.info(f"Evaluating {len(responses)} response pairs...")
+        rouge1_scores = [score[0] for score in scores]
+        rouge2_scores = [score[1] for score in scores]
+        rougeL_scores = [score[2] for score in scores]
+        bleu_scores = [score[3] for score in scores]
         
-        for i, (response, ground_truth) in enumerate(zip(responses, ground_truths)):
-            logging.info(f"\n--- Question {i+1} ---")
-            logging.info(f"Response: {response[:100]}..." if len(response) > 100 else f"Response: {response}")
-            logging.info(f"Ground Truth: {ground_truth[:100]}..." if len(ground_truth) > 100 else f"Ground Truth: {ground_truth}")
-            
-            # Calculate ROUGE scores
-            rouge_scores = rouge_scorer_obj.score(ground_truth, response)
-            
-            rouge1_f1 = rouge_scores['rouge1'].fmeasure
-            rouge2_f1 = rouge_scores['rouge2'].fmeasure
-            rougeL_f1 = rouge_scores['rougeL'].fmeasure
-            
-            rouge1_scores.append(rouge1_f1)
-            rouge2_scores.append(rouge2_f1)
-            rougeL_scores.append(rougeL_f1)
-            
-            # Calculate BLEU score
-            # Tokenize reference and candidate
-            reference_tokens = nltk.word_tokenize(ground_truth.lower())
-            candidate_tokens = nltk.word_tokenize(response.lower())
-            
-            # BLEU expects reference as list of lists
-            bleu_score = sentence_bleu([reference_tokens], candidate_tokens, 
-                                    smoothing_function=smoothing)
-            bleu_scores.append(bleu_score)
-            
-            logging.info(f"ROUGE-1 F1: {rouge1_f1:.3f}")
-            logging.info(f"ROUGE-2 F1: {rouge2_f1:.3f}")
-            logging.info(f"ROUGE-L F1: {rougeL_f1:.3f}")
-            logging.info(f"BLEU Score: {bleu_score:.3f}")
+        for i, ((response, ground_truth), score) in enumerate(zip(pairs, scores)):
+            logging.debug(f"Question {i+1} | Response: {response[:100]} | Ground Truth: {ground_truth[:100]} | "
+                          f"ROUGE-1 F1: {score[0]:.3f} ROUGE-2 F1: {score[1]:.3f} "
+                          f"ROUGE-L F1: {score[2]:.3f} BLEU Score: {score[3]:.3f}")
         
         # Calculate averages
         avg_rouge1 = np.mean(rouge1_scores)
@@ -1,22 +1,200 @@
-from haystack_integrations.components.retrievers.chroma import ChromaEmbeddingRetriever
+import numpy as np
 from haystack.components.embedders import SentenceTransformersTextEmbedder
-from haystack import Pipeline
+
+from src.bm25 import reciprocal_rank_fusion
+from src.cache import LRUCache, embedding_key
+from src.embedder import use_embedding_backend
+from src.metrics import get_metrics
+from src.vector_store import create_embedding_retriever, get_index_version, score_to_similarity
 
 class Retreiver():
-    def __init__(self, document_store):
-        self.retreiver_pipeline = Pipeline()
-        retriever = ChromaEmbeddingRetriever(document_store, top_k=5)
-        embedder = SentenceTransformersTextEmbedder(
-                    model="thenlper/gte-large"
-                    )
-
-        self.retreiver_pipeline.add_component("text_embedder", embedder)
-        self.retreiver_pipeline.add_component("retriever", retriever)
-        self.retreiver_pipeline.connect("text_embedder", "retriever")
-    
+    """
+    Embeds the query and retrieves the top_k closest documents from the store.
+    Query embeddings are cached by model name and normalised query text, retrieved
+    documents are cached by query embedding and top_k. The document cache is cleared
+    whenever the index version changes, i.e. after every write by HaystackIndexer.
+    Query embeddings missing from memory are looked up in the persistent embedding_cache
+    shared with the indexer before running the encoder. embedder is an optional Sentence
+    Transformers embedder of model_name, e.g. the indexer's, whose backend embeds the
+    queries so the model is only loaded once.
+
+    With a lexical index, mode selects how it is used:
+    - "dense": embedding search only
+    - "hybrid": BM25 and dense hits merged through reciprocal rank fusion
+    - "lexical_first": BM25 answers alone when its top hit is ahead of the second by at
+      least lexical_confidence (relative margin), otherwise falls back to hybrid
+    """
+    def __init__(self, document_store, model_name="thenlper/gte-large", top_k=5,
+                 cache_size=1024, cache_ttl=3600, lexical_index=None, mode="dense",
+                 rrf_k=60, lexical_confidence=0.5, embedding_cache=None, embedder=None):
+        self.model_name = model_name
+        self.top_k = top_k
+        self.lexical_index = lexical_index
+        self.mode = mode if lexical_index is not None else "dense"
+        self.rrf_k = rrf_k
+        self.lexical_confidence = lexical_confidence
+        self.retriever = create_embedding_retriever(document_store, top_k=top_k)
+        if embedder is None:
+            embedder = SentenceTransformersTextEmbedder(model=model_name)
+        self.text_embedder = embedder
+        self.index_version = get_index_version(document_store)
+        self.embedding_cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+        self.persistent_cache = embedding_cache
+        self.document_cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+        self._document_cache_version = self.index_version.value
+
+    @classmethod
+    def from_config(cls, cfg, document_store, lexical_index=None, embedding_cache=None, embedder=None):
+        return cls(document_store=document_store,
+                   model_name=cfg.rag_embedding_model_name,
+                   cache_size=cfg.query_cache_size,
+                   cache_ttl=cfg.query_cache_ttl,
+                   lexical_index=lexical_index,
+                   mode=cfg.retrieval_mode,
+                   rrf_k=cfg.rrf_k,
+                   lexical_confidence=cfg.lexical_confidence,
+                   embedding_cache=embedding_cache,
+                   embedder=embedder)
+
+    def _check_index_version(self):
+        version = self.index_version.value
+        if version != self._document_cache_version:
+            self.document_cache.clear()
+            if self.lexical_index is not None:
+                # Off the request path, searches use the current postings until the reload is swapped in
+                self.lexical_index.reload_in_background()
+            self._document_cache_version = version
+
+    def _embedding_key(self, query):
+        return (self.model_name, " ".join(query.lower().split()))
+
+    def _persistent_key(self, query):
+        return embedding_key(self.model_name, self.text_embedder.prefix + query + self.text_embedder.suffix)
+
+    def warm_up(self):
+        """Load the query embedding model into the model registry."""
+        with use_embedding_backend(self.text_embedder):
+            pass
+
+    def embed_query(self, query):
+        return self.embed_queries([query])[0]
+
+    def embed_queries(self, queries, batch_size=32):
+        """Embed several queries in one batch, reusing and filling the query embedding cache."""
+        with get_metrics().time("rag_stage_seconds", stage="embed"):
+            return self._embed_queries(queries, batch_size)
+
+    def _embed_queries(self, queries, batch_size):
+        keys = [self._embedding_key(query) for query in queries]
+        embeddings = [self.embedding_cache.get(key) for key in keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing and self.persistent_cache is not None:
+            persistent_keys = {i: self._persistent_key(queries[i]) for i in missing}
+            stored = self.persistent_cache.get_many(persistent_keys.values())
+            for i in missing:
+                if persistent_keys[i] in stored:
+                    embeddings[i] = stored[persistent_keys[i]]
+                    self.embedding_cache.set(keys[i], embeddings[i])
+            missing = [i for i in missing if embeddings[i] is None]
+        if missing:
+            embedder = self.text_embedder
+            with use_embedding_backend(embedder) as backend:
+                new_embeddings = backend.embed(
+                    [embedder.prefix + queries[i] + embedder.suffix for i in missing],
+                    batch_size=batch_size,
+                    normalize_embeddings=embedder.normalize_embeddings,
+                )
+            for i, embedding in zip(missing, new_embeddings):
+                embeddings[i] = embedding
+                self.embedding_cache.set(keys[i], embedding)
+            if self.persistent_cache is not None:
+                self.persistent_cache.set_many((self._persistent_key(queries[i]), embeddings[i]) for i in missing)
+        return embeddings
+
+    def search_batch(self, query_embeddings, queries=None, dense=None):
+        """
+        Retrieve the top_k documents of several query embeddings in one request to the store,
+        fusing with BM25 hits of the query texts when running in a lexical mode. dense are
+        results of dense_search_batch for the same embeddings, searched here when not given.
+        """
+        if dense is None:
+            dense = self.dense_search_batch(query_embeddings)
+        if self.mode == "dense" or queries is None:
+            return dense
+        with get_metrics().time("rag_stage_seconds", stage="lexical_search"):
+            lexical = [self.lexical_index.search(query, top_k=self.top_k) for query in queries]
+        return [
+            reciprocal_rank_fusion([documents, hits], top_k=self.top_k, k=self.rrf_k)
+            for documents, hits in zip(dense, lexical)
+        ]
+
+    def dense_search_batch(self, query_embeddings):
+        """Dense top_k documents of several query embeddings, in one request to the store."""
+        self._check_index_version()
+        with get_metrics().time("rag_stage_seconds", stage="dense_search"):
+            return self.retriever.document_store.search_embeddings(query_embeddings, top_k=self.top_k)
+
+    def top_similarity(self, documents):
+        """Cosine similarity of the first of dense search results, None when there are none."""
+        if not documents:
+            return None
+        return score_to_similarity(self.retriever.document_store, documents[0].score)
+
+    def top_similarities(self, query_embeddings):
+        """Cosine similarity of the closest stored chunk to every query embedding, None when there is none."""
+        results = self.retriever.document_store.search_embeddings(query_embeddings, top_k=1)
+        return [self.top_similarity(documents) for documents in results]
+
+    def search(self, query_embedding):
+        self._check_index_version()
+        key = (np.asarray(query_embedding, dtype=np.float32).tobytes(), self.top_k)
+        documents = self.document_cache.get(key)
+        if documents is None:
+            with get_metrics().time("rag_stage_seconds", stage="dense_search"):
+                documents = self.retriever.run(query_embedding=query_embedding)["documents"]
+            self.document_cache.set(key, documents)
+        return documents
+
+    def _lexical_is_confident(self, documents):
+        if not documents or documents[0].score <= 0:
+            return False
+        if len(documents) == 1:
+            return True
+        return (documents[0].score - documents[1].score) / documents[0].score >= self.lexical_confidence
+
+    def retrieve(self, query, query_embedding=None, dense=None):
+        """
+        Returns (query_embedding, documents). query_embedding is None when the lexical
+        fast path answered without running the dense encoder. A query_embedding already
+        computed and its dense search results are reused rather than searched again.
+        """
+        with get_metrics().time("rag_stage_seconds", stage="retrieve"):
+            return self._retrieve(query, query_embedding, dense)
+
+    def _retrieve(self, query, query_embedding=None, dense=None):
+        lexical = None
+        if self.mode != "dense":
+            self._check_index_version()
+            with get_metrics().time("rag_stage_seconds", stage="lexical_search"):
+                lexical = self.lexical_index.search(query, top_k=self.top_k)
+            if self.mode == "lexical_first" and self._lexical_is_confident(lexical):
+                return None, lexical
+        if query_embedding is None:
+            query_embedding = self.embed_query(query)
+        if dense is None:
+            dense = self.search(query_embedding)
+        if lexical is None:
+            return query_embedding, dense
+        return query_embedding, reciprocal_rank_fusion([dense, lexical], top_k=self.top_k, k=self.rrf_k)
+
     def get_documents(self, query):
-        results = self.retreiver_pipeline.run({
-            "text_embedder": {"text": query}
-            })
-        
-        return results["retriever"]["documents"]
\ No newline at end of file
+        return self.retrieve(query)[1]
+
+    def cache_stats(self):
+        stats = {
+            "query_embedding": self.embedding_cache.stats(),
+            "documents": self.document_cache.stats(),
+        }
+        if self.persistent_cache is not None:
+            stats["persistent_embedding"] = self.persistent_cache.stats()
+        return stats
@@ -1,6 +1,7 @@
 import numpy as np
 import torch
 
+import hashlib
 import random
 import logging
 import logging.config
@@ -50,3 +51,20 @@ def setup_logging(
         )
         logger.error(error)
         logger.error("Logging config file is not found. Basic config is being used.")
+
+
+def hash_file(file_path, chunk_size=1 << 20):
+    """Compute the sha256 hex digest of a file, reading it in chunks.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the file to hash.
+    chunk_size : int, optional
+        Number of bytes read per iteration, by default 1MB
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -1,10 +1,221 @@
 import os
+import threading
+from typing import List
+
+import numpy as np
+from haystack import component
+from haystack.dataclasses import Document
+from haystack.document_stores.types import DuplicatePolicy
+from haystack_integrations.components.retrievers.chroma import ChromaEmbeddingRetriever
 from haystack_integrations.document_stores.chroma import ChromaDocumentStore
 
-def initialize_vector_db(chroma_dir = "chromadb"):
+from src.flat_store import FlatDocumentStore, FlatEmbeddingRetriever
+
+# Index version of every document store in this process, keyed by id of the store
+_INDEX_VERSIONS = {}
+
+
+class IndexVersion:
+    """
+    Generation counter bumped every time documents are written to or deleted from the index.
+    Caches compare it against the version they were filled at to know when to invalidate.
+    When backed by a file the counter is shared by every process using the same store.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return int(f.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    @property
+    def value(self):
+        return self._read() if self.path else self._value
+
+    def bump(self):
+        with self._lock:
+            if not self.path:
+                self._value += 1
+                return self._value
+            value = self._read() + 1
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(str(value))
+            os.replace(tmp_path, self.path)
+            return value
+
+
+def get_index_version(document_store):
+    """Index version shared by every component reading from or writing to the document store."""
+    key = id(document_store)
+    if key not in _INDEX_VERSIONS:
+        _INDEX_VERSIONS[key] = (document_store, IndexVersion())
+    return _INDEX_VERSIONS[key][1]
+
+
+def store_options(cfg):
+    """Keyword arguments of initialize_vector_db for the Chroma server and flat store settings of the config."""
+    compression_params = {
+        "none": {},
+        "pca": {"dim": cfg.flat_store_pca_dim},
+        "pq": {"num_subvectors": cfg.flat_store_pq_subvectors},
+    }
+    return {
+        "chroma_host": cfg.chroma_host,
+        "chroma_port": cfg.chroma_port,
+        "flat_dtype": cfg.flat_store_dtype,
+        "flat_compression": cfg.flat_store_compression,
+        "flat_compression_params": compression_params.get(cfg.flat_store_compression, {}),
+        "flat_rerank_factor": cfg.flat_store_rerank_factor,
+    }
+
+
+def initialize_vector_db(chroma_dir = "chromadb", backend="chroma", chroma_host=None, chroma_port=8000,
+                         flat_dtype="float16", flat_compression="none", flat_compression_params=None,
+                         flat_rerank_factor=4):
+    """
+    Open the document store kept in chroma_dir.
+
+    Args:
+        chroma_dir (str): Directory of the index, shared with the BM25 index and manifest
+        backend (str): "chroma" for ChromaDocumentStore or "flat" for the memory-mapped FlatDocumentStore
+        chroma_host (str): Host of a Chroma server holding the collection instead of chroma_dir, required
+            when several processes use the store, as the embedded client is single process
+        chroma_port (int): Port of the Chroma server
+        flat_dtype (str): Storage dtype of the flat store embeddings, "float16" or "int8"
+        flat_compression (str): Compression of the flat store search codes, "none", "pca" or "pq"
+        flat_compression_params (dict): Parameters of the compressor, see src.compression
+        flat_rerank_factor (int): Candidates per result re-scored at full precision when compressed
+    """
     os.makedirs(chroma_dir, exist_ok=True)
-    document_store = ChromaDocumentStore(
-        persist_path=chroma_dir,
-        distance_function="cosine"
-    )
+    if backend == "flat":
+        document_store = FlatDocumentStore(persist_path=os.path.join(chroma_dir, "flat_index"), dtype=flat_dtype,
+                                           compression=flat_compression,
+                                           compression_params=flat_compression_params,
+                                           rerank_factor=flat_rerank_factor)
+    elif backend == "chroma" and chroma_host:
+        document_store = ChromaDocumentStore(
+            host=chroma_host,
+            port=chroma_port,
+            distance_function="cosine"
+        )
+    elif backend == "chroma":
+        document_store = ChromaDocumentStore(
+            persist_path=chroma_dir,
+            distance_function="cosine"
+        )
+    else:
+        raise ValueError(f"Unknown document store backend '{backend}', expected 'chroma' or 'flat'")
+    _INDEX_VERSIONS[id(document_store)] = (document_store, IndexVersion(os.path.join(chroma_dir, "index_version")))
     return document_store
+
+
+def supports_concurrent_writers(backend="chroma", chroma_host=None):
+    """
+    Whether another process may write to the store while this one reads it. The flat
+    store reloads files written by other processes. An embedded Chroma client keeps its
+    HNSW index in memory and must be the only process opening chroma_dir, a Chroma
+    server is shared by every client.
+    """
+    return backend == "flat" or bool(chroma_host)
+
+
+def score_to_similarity(document_store, score):
+    """Cosine similarity of a dense search score, the flat store scores by similarity and Chroma by cosine distance."""
+    if isinstance(document_store, FlatDocumentStore):
+        return float(score)
+    return 1.0 - float(score)
+
+
+def sample_embeddings(document_store, max_samples=50000, seed=0, page_size=2048):
+    """
+    Uniform sample of at most max_samples stored embeddings as a float32 matrix. Chroma
+    collections are read page by page into a reservoir, so memory is bounded by the
+    sample rather than the store.
+    """
+    if isinstance(document_store, FlatDocumentStore):
+        return document_store.sample_embeddings(max_samples, seed)
+    # The Haystack store only reads whole documents, page through its Chroma collection
+    document_store._ensure_initialized()
+    collection = document_store._collection
+    rng = np.random.default_rng(seed)
+    sample = []
+    seen = 0
+    for offset in range(0, collection.count(), page_size):
+        for embedding in collection.get(include=["embeddings"], limit=page_size, offset=offset)["embeddings"]:
+            if len(sample) < max_samples:
+                sample.append(np.asarray(embedding, dtype=np.float32))
+            else:
+                slot = rng.integers(0, seen + 1)
+                if slot < max_samples:
+                    sample[slot] = np.asarray(embedding, dtype=np.float32)
+            seen += 1
+    return np.stack(sample) if sample else np.empty((0, 0), dtype=np.float32)
+
+
+def iter_documents(document_store, page_size=2048):
+    """Every stored Document without its embedding, read from Chroma collections page by page."""
+    if isinstance(document_store, FlatDocumentStore):
+        yield from document_store.filter_documents()
+        return
+    document_store._ensure_initialized()
+    collection = document_store._collection
+    for offset in range(0, collection.count(), page_size):
+        page = collection.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+        for doc_id, content, meta in zip(page["ids"], page["documents"], page["metadatas"]):
+            yield Document(id=doc_id, content=content, meta=meta or {})
+
+
+def upsert_documents(document_store, documents):
+    """
+    Write the documents, replacing stored documents with the same id. The Haystack Chroma
+    store ignores the duplicate policy and adds to its collection, which keeps the stored
+    version, so Chroma documents are upserted into the collection directly.
+    """
+    if isinstance(document_store, FlatDocumentStore):
+        return document_store.write_documents(documents, policy=DuplicatePolicy.OVERWRITE)
+    document_store._ensure_initialized()
+    written = 0
+    for doc in documents:
+        data = document_store._convert_document_to_chroma(doc)
+        if data is not None:
+            document_store._collection.upsert(**data)
+            written += 1
+    return written
+
+
+def get_documents_by_id(document_store, document_ids):
+    """
+    Stored Documents with the given ids, with their embeddings, in one read. The Haystack
+    Chroma filters only match a single id, so Chroma collections are read by ids directly.
+    """
+    if not document_ids:
+        return []
+    if isinstance(document_store, FlatDocumentStore):
+        return document_store.filter_documents(filters={"field": "id", "operator": "in", "value": list(document_ids)})
+    document_store._ensure_initialized()
+    result = document_store._collection.get(ids=list(document_ids), include=["embeddings", "documents", "metadatas"])
+    return document_store._get_result_to_documents(result)
+
+
+@component
+class UpsertDocumentWriter:
+    """Document writer replacing stored documents with the same id on every backend, see upsert_documents."""
+    def __init__(self, document_store):
+        self.document_store = document_store
+
+    @component.output_types(documents_written=int)
+    def run(self, documents: List[Document]):
+        return {"documents_written": upsert_documents(self.document_store, documents)}
+
+
+def create_embedding_retriever(document_store, top_k=5):
+    """Embedding retriever component matching the document store backend."""
+    if isinstance(document_store, FlatDocumentStore):
+        return FlatEmbeddingRetriever(document_store, top_k=top_k)
+    return ChromaEmbeddingRetriever(document_store, top_k=top_k)
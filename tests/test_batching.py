@@ -0,0 +1,33 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from src.batching import BatchScheduler
+from src.generator import create_generator, generate_batch
+
+PROMPTS = [f"Question {i}: which accelerator runs int8 transformers at the edge?" for i in range(6)]
+
+
+@pytest.fixture
+def generator():
+    return create_generator("stub", ttft_ms=0, token_ms=0, num_tokens=8)
+
+
+def test_generate_batch_matches_run(generator):
+    expected = [generator.run(prompt)["replies"][0] for prompt in PROMPTS]
+    assert generate_batch(generator, PROMPTS) == expected
+
+
+def test_scheduler_replies_match_unbatched_run(generator):
+    expected = [generator.run(prompt)["replies"][0] for prompt in PROMPTS]
+    scheduler = BatchScheduler(lambda prompts: generate_batch(generator, prompts), max_batch_size=4, max_wait_ms=50)
+
+    async def submit_all():
+        return await asyncio.gather(*(scheduler.submit(prompt) for prompt in PROMPTS))
+
+    assert asyncio.run(submit_all()) == expected
+    # The prompts were generated in batches, not one by one
+    assert scheduler.stats()["num_batches"] < len(PROMPTS)
@@ -0,0 +1,52 @@
+from dataclasses import replace
+
+import pytest
+
+pytest.importorskip("chromadb")
+pytest.importorskip("torch")
+
+from haystack.dataclasses import Document
+from haystack_integrations.document_stores.chroma import ChromaDocumentStore
+
+from src.dedup import DedupIndex, source_file_paths
+from src.embedder import CachedDocumentEmbedder, create_sentence_embedder
+from src.index_pipeline import HaystackIndexer
+
+TEXT = ("edge devices run quantised transformer models on the npu with int8 weights "
+        "and calibrated activations to keep latency low")
+
+
+@pytest.fixture
+def indexer(tmp_path, monkeypatch):
+    # Every chunk gets the same embedding, the tests are about what is written and deleted
+    monkeypatch.setattr(CachedDocumentEmbedder, "_embed",
+                        lambda self, documents: [replace(doc, embedding=[1.0, 0.0, 0.0]) for doc in documents])
+    store = ChromaDocumentStore(persist_path=str(tmp_path / "chroma"), distance_function="cosine")
+    return HaystackIndexer(store, dedup_index=DedupIndex(threshold=0.8), split_by="passage", split_length=1,
+                           embedder=create_sentence_embedder())
+
+
+def test_near_duplicate_is_kept_when_its_first_source_is_deleted(indexer):
+    indexer.index([Document(content=TEXT, meta={"file_path": "a.txt"})])
+    indexer.index([Document(content=TEXT + " today", meta={"file_path": "b.txt"})])
+
+    stored = indexer.document_store.filter_documents()
+    assert len(stored) == 1
+    assert source_file_paths(stored[0]) == ["a.txt", "b.txt"]
+
+    indexer.delete_files(["a.txt"])
+
+    stored = indexer.document_store.filter_documents()
+    assert len(stored) == 1
+    assert stored[0].content == TEXT
+    assert source_file_paths(stored[0]) == ["b.txt"]
+    assert indexer.dedup_index.file_paths[stored[0].id] == ["b.txt"]
+
+
+def test_deleting_every_source_removes_the_chunk(indexer):
+    indexer.index([Document(content=TEXT, meta={"file_path": "a.txt"})])
+    indexer.index([Document(content=TEXT + " today", meta={"file_path": "b.txt"})])
+
+    assert indexer.delete_files(["b.txt"]) == 0
+    assert indexer.delete_files(["a.txt"]) == 1
+    assert indexer.document_store.count_documents() == 0